@@ -0,0 +1,22 @@
+"""
+ASGI config for api_endpoint project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Django 2.2 has no ASGI support of its own, so the WSGI application is served
+from a bounded thread pool by handler.asgi.ClicksInfoASGI, e.g.
+
+    uvicorn api_endpoint.asgi:application
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api_endpoint.settings')
+
+wsgi_application = get_wsgi_application()
+
+# imported once django is set up
+from handler.asgi import ClicksInfoASGI
+
+application = ClicksInfoASGI(wsgi_application)
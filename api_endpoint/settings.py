@@ -80,9 +80,111 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # every worker thread keeps its connection open for this many seconds, instead of opening one per request
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
     }
 }
 
+# Optional read only database the clicks info api reads from while LoadDB writes to the default one (see handler/database.py),
+# the path of the default database itself (opened read only) or of a copy of it
+
+CLICKS_INFO_READ_REPLICA = os.environ.get('CLICKS_INFO_READ_REPLICA')
+
+if CLICKS_INFO_READ_REPLICA:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:{}?mode=ro'.format(CLICKS_INFO_READ_REPLICA),
+        'CONN_MAX_AGE': DATABASES['default']['CONN_MAX_AGE'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['handler.database.ReadReplicaRouter']
+
+# Pragmas run on every new sqlite connection
+# WAL lets readers keep reading while a load writes, synchronous = NORMAL is safe in WAL mode (a power loss can only lose the last commits),
+# and the page cache (64MB, negative values are KiB), memory mapped reads (256MB) and in memory temporary tables speed up the large scans
+
+CLICKS_INFO_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+
+# Engine used to execute the API rules
+# 'sql' runs them as a database query, 'numpy' keeps the whole clicks table in memory as numpy columns (requires numpy)
+
+CLICKS_INFO_ENGINE = os.environ.get('CLICKS_INFO_ENGINE', 'sql')
+
+# Directory of the memory mapped snapshot the numpy engine starts from, written by the export_snapshot command
+# (the engine loads the table from the database instead while there is no snapshot of the current data)
+
+CLICKS_INFO_SNAPSHOT = os.environ.get('CLICKS_INFO_SNAPSHOT', os.path.join(BASE_DIR, 'database', 'snapshot'))
+
+# Export the snapshot again after every committed data change, once it was exported the first time
+# (False leaves it to the export_snapshot command, the engine loads from the database until the next export)
+
+CLICKS_INFO_SNAPSHOT_REFRESH = True
+
+# Parallel scans of the sql engine (see handler/parallel.py)
+# requests scanning more rows than CLICKS_INFO_PARALLEL_ROWS (estimated from the partition catalog) are split by date range
+# across CLICKS_INFO_PARALLEL_WORKERS processes, 1 (the default) always scans in the request thread
+# (sums and averages of money combined from the ranges can differ from a single query in the last float digits)
+
+CLICKS_INFO_PARALLEL_WORKERS = int(os.environ.get('CLICKS_INFO_PARALLEL_WORKERS', 1))
+
+CLICKS_INFO_PARALLEL_ROWS = int(os.environ.get('CLICKS_INFO_PARALLEL_ROWS', 200000))
+
+
+# Cache of executed API results
+# entries are keyed by the normalized rules and the data version, the local memory cache evicts the least recently used entries
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'clicks-info-results',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+CLICKS_INFO_CACHE = 'default'
+
+# Largest result (in rows) kept in the cache, larger results are executed again (with the full table in a few sort orders,
+# the entries would otherwise hold many copies of the data), None caches every result
+
+CLICKS_INFO_CACHE_MAX_ROWS = int(os.environ.get('CLICKS_INFO_CACHE_MAX_ROWS', 1000))
+
+# Identical requests arriving together execute once (see SingleFlight in handler/caching.py), and the result is kept this many seconds
+# for the requests arriving just after
+
+CLICKS_INFO_SINGLE_FLIGHT_RETAIN = 1.0
+
+# Directory of the lock files which also let the worker processes of a machine execute a result once, None for within a process only
+# (needs a CLICKS_INFO_CACHE shared by the workers, such as django.core.cache.backends.filebased.FileBasedCache)
+
+CLICKS_INFO_SINGLE_FLIGHT_LOCKS = os.environ.get('CLICKS_INFO_SINGLE_FLIGHT_LOCKS')
+
+# Largest limit or top a request can ask for, larger pages are rejected with 400
+
+CLICKS_INFO_MAX_LIMIT = 100000
+
+# Number of compiled api flag strings kept, so repeated URLs skip parsing and validation
+
+CLICKS_INFO_PLAN_CACHE_SIZE = 1024
+
+# Most queries accepted by one request to the batch endpoint
+
+CLICKS_INFO_BATCH_LIMIT = 100
+
+# Threads running requests under asgi (see handler/asgi.py), requests beyond this wait in a queue without holding a database connection
+
+CLICKS_INFO_ASGI_THREADS = int(os.environ.get('CLICKS_INFO_ASGI_THREADS', 8))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
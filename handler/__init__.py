@@ -1 +1,2 @@
-# not empty
\ No newline at end of file
+# not empty
+default_app_config = 'handler.apps.HandlerConfig'
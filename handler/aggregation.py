@@ -0,0 +1,171 @@
+from django.db.models import Sum, Count, Avg, Min, Max, F, Case, When, Value, FloatField, BigIntegerField
+from django.db.models.functions import Cast
+
+from .models import ClicksInfo
+from .query import RulesQuery
+from .pagination import keyset_predicate
+
+
+class AggregateQuery(RulesQuery):
+    '''
+    compiles a validated rules dictionary with an agg rule into a single GROUP BY query
+
+    every group returns one row, holding the group columns and the requested aggregates, e.g.
+
+    group=channel,country&agg=sum:impressions,sum:clicks,count
+
+    returns rows of channel, country, sum_impressions, sum_clicks and count
+
+    the requested derived metrics are calculated per group from the group totals, e.g. cpi as sum(spend) / sum(installs)
+
+    date_from, date_to and include_only filter the rows before they are grouped, the same way they do without agg
+    sorted orders the groups, and can be a group column, an aggregated column (ordered by its first aggregate) or a derived metric
+    sorting by any other column orders the groups by the group columns instead
+    the group columns always finish the order, which makes it total for limit and cursor
+    '''
+
+    aggregate_functions = {
+                           'sum': Sum,
+                           'count': Count,
+                           'avg': Avg,
+                           'min': Min,
+                           'max': Max,
+                           }
+
+    # columns which can be summed or averaged
+    summable_columns = ['impressions', 'clicks', 'installs', 'spend', 'revenue']
+
+    def aggregate_name(self, function, column):
+        # count without a column is simply called count, everything else is function_column
+        if column is None:
+            return function
+        return '{}_{}'.format(function, column)
+
+    def aggregates(self):
+        # dict of output name -> aggregate expression, in the order they were requested
+        aggregates = {}
+        for function, column in self.rules['agg']:
+            if column is None:
+                expression = Count('id')
+            else:
+                expression = self.aggregate_functions[function](column)
+            aggregates[self.aggregate_name(function, column)] = expression
+
+        return aggregates
+
+    def metric_columns(self):
+        # the requested derived metrics, in model order
+        return [c for c in self.derived_columns if c in self.rules['columns']]
+
+    def group_metric_expression(self, metric):
+        # e.g. cpi = sum(spend) / sum(installs), over the total_* annotations, with a 0 denominator counted as 1 to avoid division by zero
+        numerator, denominator = ClicksInfo.derived_metrics[metric]
+        return Cast(F('total_' + numerator), FloatField()) / Case(
+                                                                  When(**{'total_' + denominator: 0, 'then': Value(1)}),
+                                                                  default=F('total_' + denominator),
+                                                                  output_field=FloatField(),
+                                                                  )
+
+    def token_columns(self):
+        # tokens filter the rows before grouping, so they are not compared with the per row derived metrics
+        return [c for c in self.rules['columns'] if c not in self.derived_columns]
+
+    def order_column(self):
+        # the output column the groups are ordered by, or None if the sorted column is not part of the output
+        sort_column = self.rules['sorted'][0]
+
+        if sort_column in self.rules['group']:
+            return sort_column
+
+        if sort_column in self.metric_columns():
+            return 'group_' + sort_column
+
+        for function, column in self.rules['agg']:
+            if column == sort_column:
+                return self.aggregate_name(function, column)
+
+        return None
+
+    def output_columns(self):
+        # the columns of the returned rows, in order
+        return list(self.rules['group']) + list(self.aggregates()) + self.metric_columns()
+
+    def order_fields(self):
+        # list of (field, descending) pairs the groups are ordered by, ending with the group columns so the order is total
+        order_fields = []
+
+        order_column = self.order_column()
+        if order_column is not None:
+            order_fields.append((order_column, self.rules['sorted'][1] == 'descending'))
+
+        for c in self.rules['group']:
+            if c != order_column:
+                order_fields.append((c, False))
+
+        return order_fields
+
+    def groups_by_first_row(self):
+        # every group is a single row, ordered by sorted
+        return False
+
+    def order_field(self, name):
+        # the field of an order field's values, the groups of sums and counts can be larger than a single row's columns
+        for function, column in self.rules['agg']:
+            if self.aggregate_name(function, column) != name:
+                continue
+            if function == 'count':
+                return BigIntegerField()
+            if function == 'avg':
+                return FloatField()
+            field = ClicksInfo._meta.get_field(column)
+            if function == 'sum' and field.get_internal_type() == 'IntegerField':
+                return BigIntegerField()
+            return field
+
+        if name.startswith('group_'):
+            # a derived metric
+            return FloatField()
+        return ClicksInfo._meta.get_field(name)
+
+    def queryset(self):
+        rules = self.rules
+
+        queryset = self.filtered_queryset()
+
+        aggregates = self.aggregates()
+        output_columns = list(rules['group']) + list(aggregates)
+
+        if len(rules['group']) > 0:
+            queryset = queryset.values(*rules['group']).annotate(**aggregates)
+        else:
+            # without group columns the whole date range is a single group
+            queryset = queryset.annotate(single_group=Value(1, output_field=FloatField())).values('single_group').annotate(**aggregates)
+
+        metrics = self.metric_columns()
+        if len(metrics) > 0:
+            totals = []
+            for metric in metrics:
+                for c in ClicksInfo.derived_metrics[metric]:
+                    if c not in totals:
+                        totals.append(c)
+            queryset = queryset.annotate(**{'total_' + c: Sum(c) for c in totals})
+
+            # the model already has fields called cpi, roas and ctr, so the annotations are renamed when the rows are formatted
+            queryset = queryset.annotate(**{'group_' + metric: self.group_metric_expression(metric) for metric in metrics})
+            output_columns += ['group_' + metric for metric in metrics]
+
+        order_fields = self.order_fields()
+        queryset = queryset.order_by(*[('-' if descending else '') + field for field, descending in order_fields])
+
+        # limit and cursor, a cursor on an aggregate becomes a HAVING predicate
+        if rules['cursor'] is not None:
+            queryset = queryset.filter(keyset_predicate(order_fields, rules['cursor']))
+
+        queryset = queryset.values(*output_columns)
+
+        if rules['limit'] is not None:
+            # one group more than the limit tells if there is a next page
+            queryset = queryset[:rules['limit'] + 1]
+
+        return queryset
+
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class HandlerConfig(AppConfig):
     name = 'handler'
+    
+    def ready(self):
+        # connect the receivers which keep the data version up to date, the one setting up new sqlite connections,
+        # and the one exporting the snapshot again after a data change
+        from . import signals
+        from . import database
+        from . import columnar
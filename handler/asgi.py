@@ -0,0 +1,335 @@
+import asyncio
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+
+'''
+asgi serving of the project's wsgi application
+
+django 2.2 has no async views, so the asgi application runs every request through the ordinary wsgi application,
+on a thread of a bounded pool, and keeps the event loop free for accepting and answering connections:
+
+1. the request body is read on the loop, and the request is queued on the pool (at most CLICKS_INFO_ASGI_THREADS run at once,
+   the rest wait in the queue without holding a thread or a database connection)
+2. a thread runs the whole request, view, database reads, rule execution and rendering, and hands the response chunks to the loop,
+   so streamed formats (ndjson and csv) are sent while they are produced, and a slow client pauses the thread instead of
+   buffering the whole export
+3. if the client disconnects, a queued request never runs, and a running one is stopped: its sqlite query is interrupted,
+   and no more chunks are produced
+
+identical GET requests of the clicks_info endpoints arriving while one of them is running share its execution
+(see coalescing_key), unless they carry a cookie or an authorization, every one of them gets the same response, and the execution is only cancelled once all of them disconnected
+
+a request stays on one thread from start to finish, since django's database connections belong to the thread that opened them
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    '''
+    one execution of the wsgi application, whose response can be awaited by any number of requests
+
+    the thread pushes the status, headers and body chunks, the requests read them on the loop
+    a flight which is not shared lets its thread run at most max_pending chunks ahead of the client
+    '''
+
+    max_pending = 8
+
+    def __init__(self, loop, shared):
+        self.loop = loop
+        self.shared = shared
+
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.finished = False
+
+        # set on the loop every time something was pushed, and replaced by a new event
+        self.changed = asyncio.Event()
+
+        self.requests = 0
+        self.cancelled = threading.Event()
+        self.space = None if shared else threading.Semaphore(self.max_pending)
+
+        # the database connections of the thread running the flight, to interrupt them when it is cancelled
+        self.connections = []
+
+    # the loop side
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def join(self):
+        self.requests += 1
+
+    def leave(self):
+        # the last request leaving cancels the execution
+        self.requests -= 1
+        if self.requests == 0 and not self.finished:
+            self.cancel()
+
+    def cancel(self):
+        self.cancelled.set()
+        for connection in self.connections:
+            # sqlite3 connections can be interrupted from any thread, the running query raises OperationalError
+            if connection.vendor == 'sqlite' and connection.connection is not None:
+                connection.connection.interrupt()
+        if self.space is not None:
+            # wake the thread if it waits for the client
+            self.space.release()
+
+    def sent(self, position):
+        # a request of a flight which is not shared sent chunk position, the thread may produce another one
+        if self.space is not None:
+            self.chunks[position] = None
+            self.space.release()
+
+    # the thread side
+
+    def push(self, function, *args):
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def start_response(self, status, headers):
+        self.push(self.set_start, status, headers)
+
+    def set_start(self, status, headers):
+        self.status = status
+        self.headers = headers
+        self.notify()
+
+    def write(self, chunk):
+        # returns False if the flight was cancelled while waiting for the client
+        if self.space is not None:
+            self.space.acquire()
+        if self.cancelled.is_set():
+            return False
+        self.push(self.append, chunk)
+        return True
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.notify()
+
+    def finish(self):
+        self.push(self.set_finished)
+
+    def set_finished(self):
+        self.finished = True
+        self.notify()
+
+
+class ClicksInfoASGI:
+    '''
+    asgi application running a wsgi application on a bounded thread pool, see the notes above
+
+    run it with any asgi server, e.g. uvicorn api_endpoint.asgi:application
+    '''
+
+    # headers which can change the response of a GET request, requests only share an execution if these are equal too
+    coalesced_headers = [b'host', b'accept', b'if-none-match', b'if-modified-since']
+
+    # only requests of the clicks_info endpoints are shared
+    coalesced_path = '/clicks_info'
+
+    # headers of a user, requests carrying them are never shared
+    private_headers = [b'cookie', b'authorization']
+
+    def __init__(self, wsgi_application, threads=None):
+        self.wsgi_application = wsgi_application
+        if threads is None:
+            threads = getattr(settings, 'CLICKS_INFO_ASGI_THREADS', 8)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='clicks-info')
+
+        # coalescing key -> the running flight
+        self.flights = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Only http is served, not {}'.format(scope['type']))
+
+        body = await self.read_body(receive)
+        if body is None:
+            # the client disconnected before sending the whole request
+            return
+
+        environ = self.environ(scope, body)
+        loop = asyncio.get_running_loop()
+
+        key = self.coalescing_key(scope)
+        flight = self.flights.get(key) if key is not None else None
+        if flight is None:
+            flight = Flight(loop, shared=key is not None)
+            if key is not None:
+                self.flights[key] = flight
+            future = loop.run_in_executor(self.pool, self.run, environ, flight)
+            future.add_done_callback(lambda future: self.landed(key, flight))
+
+        await self.respond(flight, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    def coalescing_key(self, scope):
+        # requests with the same key get the same response, None for requests which are never shared
+        # (anything but GET, and streamed formats, which are sent while they are produced instead of kept for other requests)
+        # only the clicks_info rows are shared, and never the requests of a user (a session, a csrf token), whose responses are theirs
+        if scope['method'] != 'GET' or not scope['path'].startswith(self.coalesced_path):
+            return None
+
+        headers = dict(scope['headers'])
+        if any(name in headers for name in self.private_headers):
+            return None
+
+        # imported here, the views can only be imported once django is set up
+        from .views import ViewClicksInfo
+        flags = scope['path'].rsplit('/', 1)[-1].split('&')
+        if any('format=' + stream_format in flags for stream_format in ViewClicksInfo.stream_content_types):
+            return None
+
+        return (scope['path'], scope.get('query_string', b'')) + tuple(headers.get(name) for name in self.coalesced_headers)
+
+    def landed(self, key, flight):
+        # the flight finished, later requests start a new one
+        if key is not None and self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def environ(self, scope, body):
+        # the wsgi environ of an asgi http scope
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+
+        environ = {
+                   'REQUEST_METHOD': scope['method'],
+                   'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+                   'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+                   'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+                   'SERVER_NAME': server[0],
+                   'SERVER_PORT': str(server[1]),
+                   'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+                   'REMOTE_ADDR': client[0],
+                   'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': scope.get('scheme', 'http'),
+                   'wsgi.input': io.BytesIO(body),
+                   'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': True,
+                   'wsgi.run_once': False,
+                   }
+
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+                name = 'HTTP_' + name
+            if name in environ:
+                # repeated headers are joined, as a wsgi server would
+                value = environ[name] + ',' + value
+            environ[name] = value
+
+        return environ
+
+    def run(self, environ, flight):
+        # runs on a pool thread, the whole request from the view to the last chunk
+        if flight.cancelled.is_set():
+            # every request of the flight disconnected while it was queued
+            flight.finish()
+            return
+
+        flight.connections = connections.all()
+
+        try:
+            result = self.wsgi_application(environ, lambda status, headers, exc_info=None: flight.start_response(status, headers))
+            try:
+                for chunk in result:
+                    if len(chunk) > 0 and not flight.write(chunk):
+                        break
+            finally:
+                # closing the response sends request_finished, which closes this thread's old database connections
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            # django already turns exceptions of the view into 500 responses, this is an exception while streaming
+            # (or the interrupted query of a cancelled request, which is expected)
+            if not flight.cancelled.is_set():
+                logger.exception('Error while sending the response of %s', environ['PATH_INFO'])
+        finally:
+            flight.finish()
+
+    async def wait_for_disconnect(self, receive, flight, gone):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                gone.set()
+                flight.leave()
+                flight.notify()
+                return
+
+    async def respond(self, flight, receive, send):
+        # sends the response of the flight to one request, as it is produced
+        flight.join()
+        gone = asyncio.Event()
+        watcher = asyncio.ensure_future(self.wait_for_disconnect(receive, flight, gone))
+
+        try:
+            started = False
+            position = 0
+            while not gone.is_set():
+                changed = flight.changed
+
+                if not started and flight.status is not None:
+                    code = int(flight.status.split(' ', 1)[0])
+                    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in flight.headers]
+                    await send({'type': 'http.response.start', 'status': code, 'headers': headers})
+                    started = True
+
+                if started and position < len(flight.chunks):
+                    await send({'type': 'http.response.body', 'body': flight.chunks[position], 'more_body': True})
+                    flight.sent(position)
+                    position += 1
+                    continue
+
+                if flight.finished:
+                    if not started:
+                        # the execution failed before it could start a response
+                        await send({'type': 'http.response.start', 'status': 500, 'headers': [(b'content-type', b'text/plain')]})
+                        await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                    else:
+                        await send({'type': 'http.response.body', 'body': b''})
+                    return
+
+                await changed.wait()
+        except OSError:
+            # the client went away while its response was being sent
+            pass
+        finally:
+            if not gone.is_set():
+                watcher.cancel()
+                flight.leave()
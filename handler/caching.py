@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # file locks are only available on unix, elsewhere single flight only works within a process
+    fcntl = None
+
+from django.core.cache import caches
+from django.conf import settings
+
+
+def canonical_query(rules):
+    '''
+    a dict describing a validated rules dictionary, which is the same for every flag string producing the same rows
+    (limit and cursor, which only choose the page of those rows, are left out)
+
+    flag order and spelled out defaults already disappear in the validated rules
+    columns and include_only are sets (their order does not change the result), so they are sorted and deduplicated
+    group, sorted and agg keep their order, since it decides the order of the output
+    '''
+    return {
+                 'date_from': list(rules['date_from']),
+                 'date_to': list(rules['date_to']),
+                 'columns': sorted(set(rules['columns'])),
+                 'group': list(rules['group']),
+                 'sorted': list(rules['sorted']),
+                 'cpi': rules['cpi'],
+                 'include_only': sorted(set(rules['include_only'])),
+                 'agg': [list(item) for item in rules['agg']],
+                 }
+
+
+def canonical_rules(rules):
+    # json string of the canonical query, the page and the output format, the same for every flag string producing the same result
+    canonical = canonical_query(rules)
+    canonical['limit'] = rules['limit']
+    canonical['cursor'] = rules['cursor']
+    canonical['top'] = rules['top']
+    canonical['format'] = rules['format']
+    return json.dumps(canonical, sort_keys=True)
+
+
+def rules_digest(key, version):
+    # hash of the canonical rules (as returned by canonical_rules) and the data version, identifying one exact result
+    text = '{}:{}'.format(version, key)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    '''
+    caches executed results in the django cache selected by the CLICKS_INFO_CACHE setting
+
+    entries are keyed by the canonical rules and the data version, so a data change makes every older entry unreachable,
+    and the cache backend's own eviction (LRU and TIMEOUT for the default local memory cache) removes them
+
+    results of more than CLICKS_INFO_CACHE_MAX_ROWS rows are not cached: the backend only counts entries, so a few large
+    results (e.g. the whole table in a few sort orders) would otherwise keep several copies of the data in every process
+    '''
+
+    key_prefix = 'clicks_info'
+
+    def __init__(self, plan, version):
+        # plan is a QueryPlan, whose key is already the canonical rules
+        self.digest = rules_digest(plan.key, version)
+        self.cache = caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')]
+
+    def key(self):
+        return '{}:{}'.format(self.key_prefix, self.digest)
+
+    def etag(self, representation=None):
+        # the same result rendered in another format (see handler/renderers.py) is another representation, with its own etag
+        if representation is None:
+            return '"{}"'.format(self.digest)
+        return '"{}-{}"'.format(self.digest, representation)
+
+    def get(self):
+        return self.cache.get(self.key())
+
+    def set(self, result):
+        # result is the (rows, next values) pair of an execution
+        max_rows = getattr(settings, 'CLICKS_INFO_CACHE_MAX_ROWS', 1000)
+        if max_rows is not None and len(result[0]) > max_rows:
+            return
+        self.cache.set(self.key(), result)
+
+
+class Flight:
+    # one execution of a result, which the requests arriving while it runs (or shortly after) wait for
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+        self.expires = None
+
+
+class SingleFlight:
+    '''
+    executes a result once for all the requests which need it at the same time
+
+    during a refresh of a dashboard, dozens of identical requests arrive within milliseconds, all missing the result cache,
+    so without this every one of them would execute the same query
+    requests are keyed by their ResultCache key (the canonical rules and the data version), the first request executes
+    and stores the result, the ones arriving while it runs wait for it and share it, and the result is kept for
+    CLICKS_INFO_SINGLE_FLIGHT_RETAIN seconds for the requests arriving just after (even when the result cache is disabled)
+
+    across the worker processes of a machine, the executions of a key are also serialized with a lock file in
+    CLICKS_INFO_SINGLE_FLIGHT_LOCKS, and a worker which waited for the lock reads the result another worker just stored,
+    which needs a result cache shared by the workers (such as the file based cache, or memcached)
+
+    if the execution fails (for instance because its client disconnected and the query was interrupted),
+    the waiting requests don't inherit the error, one of them executes again
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def retain(self):
+        return getattr(settings, 'CLICKS_INFO_SINGLE_FLIGHT_RETAIN', 1.0)
+
+    def run(self, result_cache, function):
+        # the result of function for result_cache's key, stored in result_cache
+        key = result_cache.key()
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.forget(now)
+
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = Flight()
+                    self.flights[key] = flight
+
+            if leader:
+                return self.execute(key, flight, result_cache, function)
+
+            flight.done.wait()
+            if not flight.failed:
+                return flight.result
+
+    def clear(self):
+        # drops every finished flight, so the next request of any key executes again (used by the benchmark between runs)
+        with self.lock:
+            finished = [key for key, flight in self.flights.items() if flight.done.is_set()]
+            for key in finished:
+                del self.flights[key]
+
+    def forget(self, now):
+        # drops the finished flights which are no longer retained, called with the lock held
+        expired = [key for key, flight in self.flights.items() if flight.expires is not None and flight.expires <= now]
+        for key in expired:
+            del self.flights[key]
+
+    def execute(self, key, flight, result_cache, function):
+        try:
+            with self.worker_lock(result_cache.digest):
+                # another worker may have stored the result while this one waited for the lock
+                result = result_cache.get() if self.lock_directory() is not None else None
+                if result is None:
+                    result = function()
+                    result_cache.set(result)
+            flight.result = result
+            return result
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                if flight.failed or self.retain() <= 0:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+                else:
+                    flight.expires = time.monotonic() + self.retain()
+            flight.done.set()
+
+    def lock_directory(self):
+        if fcntl is None:
+            return None
+        return getattr(settings, 'CLICKS_INFO_SINGLE_FLIGHT_LOCKS', None)
+
+    def worker_lock(self, digest):
+        directory = self.lock_directory()
+        if directory is None:
+            return NoLock()
+        return FileLock(os.path.join(directory, digest + '.lock'))
+
+
+class NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FileLock:
+    '''
+    an exclusive lock on a lock file, shared by the processes of a machine
+
+    the holder deletes the file when it is done, so lock files don't pile up, and a process which was waiting on the
+    deleted file opens the new one instead (the inode it locked must still be the one at the path)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            lock_file = open(self.path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(self.path))
+            except FileNotFoundError:
+                current = False
+            if current:
+                self.lock_file = lock_file
+                return self
+            lock_file.close()
+
+    def __exit__(self, *exc_info):
+        try:
+            os.unlink(self.path)
+        finally:
+            # closing the file releases the lock
+            self.lock_file.close()
+        return False
+
+
+# the single flight of the process, shared by every request thread
+single_flight = SingleFlight()
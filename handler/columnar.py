@@ -0,0 +1,451 @@
+import threading
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed for the numpy engine
+    np = None
+
+from .models import ClicksInfo
+from .query import RulesQuery
+from .signals import data_version, data_changed
+from .partitions import catalog, next_month
+from .inverted_index import InvertedIndex
+from .database import read_alias
+from .snapshot import read_snapshot, write_snapshot, has_snapshot
+
+
+class ColumnarPartition:
+    '''
+    the rows of one month (a ClicksInfoPartition) loaded from the database, in id order
+
+    partitions outlive the tables built from them, a table reload only loads the months whose catalog version changed
+    categorical and text columns are kept as strings, since the codes are only assigned once the partitions are put together
+    '''
+
+    categorical_columns = ['channel', 'country', 'os']
+    int_columns = ['impressions', 'clicks', 'installs']
+    # money and the stored derived metrics
+    float_columns = ['spend', 'revenue', 'cpi', 'roas', 'ctr']
+    # the text of the money, which is what the api returns
+    text_columns = list(ClicksInfo.text_columns.values())
+
+    # rows fetched from the database at a time while loading
+    chunk_size = 20000
+
+    def __init__(self, month, version):
+        self.month = month
+        self.version = version
+
+        names = ['id', 'date'] + self.categorical_columns + self.int_columns + self.float_columns + self.text_columns
+        values = {name: [] for name in names}
+
+        rows = ClicksInfo.objects.filter(date__gte=month, date__lt=next_month(month)).order_by('id').values_list(*names)
+        for row in rows.iterator(chunk_size=self.chunk_size):
+            for name, value in zip(names, row):
+                values[name].append(value)
+
+        self.columns = {}
+        self.columns['id'] = np.array(values['id'], dtype=np.int64)
+        self.columns['date'] = np.array(values['date'], dtype='datetime64[D]')
+        for c in self.categorical_columns + self.text_columns:
+            self.columns[c] = np.array(values[c], dtype=str)
+        for c in self.int_columns:
+            self.columns[c] = np.array(values[c], dtype=np.int64)
+        for c in self.float_columns:
+            self.columns[c] = np.array([float(v) for v in values[c]], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+
+class ColumnarTable:
+    '''
+    the whole ClicksInfo table held in memory as one numpy array per column, made of its monthly partitions in month order,
+    and in id order within every partition
+
+    date -> datetime64[D]
+    impressions, clicks, installs -> int64
+    spend, revenue, cpi, roas, ctr -> float64
+    channel, country, os -> int32 codes into a sorted dictionary of the column's distinct values,
+    so comparing or sorting the codes compares or sorts the strings
+    spend_text, revenue_text -> int32 codes the same way, money is sorted by its value but returned and compared as its text
+
+    the rows of a partition are contiguous, so the rows of a date range are found inside the partitions it overlaps only
+    (see partition_range), and the position of a row says nothing about its id, so every order ends with an explicit id tiebreaker
+    '''
+
+    categorical_columns = ColumnarPartition.categorical_columns
+    int_columns = ColumnarPartition.int_columns
+    float_columns = ColumnarPartition.float_columns
+    text_columns = ColumnarPartition.text_columns
+
+    def __init__(self, version, partitions):
+        self.version = version
+        self.partitions = partitions
+
+        # the first day of every partition's month and of the month after it, and where every partition starts and ends
+        self.months = np.array([p.month for p in partitions], dtype='datetime64[D]')
+        self.month_ends = np.array([next_month(p.month) for p in partitions], dtype='datetime64[D]')
+        self.offsets = np.cumsum([0] + [len(p) for p in partitions])
+
+        self.ids = self.concatenate('id', np.int64)
+
+        self.columns = {}
+        self.dictionaries = {}
+
+        self.columns['date'] = self.concatenate('date', 'datetime64[D]')
+        for c in self.categorical_columns + self.text_columns:
+            self.dictionaries[c], codes = np.unique(self.concatenate(c, str), return_inverse=True)
+            self.columns[c] = codes.astype(np.int32)
+        for c in self.int_columns:
+            self.columns[c] = self.concatenate(c, np.int64)
+        for c in self.float_columns:
+            self.columns[c] = self.concatenate(c, np.float64)
+
+        # built the first time an include_only request needs it, and dropped together with the table when the data changes
+        self._inverted_index = None
+
+    @classmethod
+    def from_snapshot(cls, version, arrays):
+        # a table over the memory mapped arrays of a snapshot (see handler/snapshot.py), nothing is copied or loaded
+        table = cls.__new__(cls)
+        table.version = version
+        table.partitions = []
+
+        table.months = arrays['months']
+        table.month_ends = arrays['month_ends']
+        table.offsets = arrays['offsets']
+
+        table.ids = arrays['id']
+        table.columns = arrays['columns']
+        table.dictionaries = arrays['dictionaries']
+
+        table._inverted_index = InvertedIndex.from_arrays(table, arrays['index_keys'], arrays['index_positions'])
+        return table
+
+    def concatenate(self, column, dtype):
+        if len(self.partitions) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.concatenate([p.columns[column] for p in self.partitions])
+
+    def partition_range(self, date_from, date_to):
+        # (start, end) positions of the partitions overlapping date_from to date_to, the only rows that can be in the range
+        first = np.searchsorted(self.month_ends, date_from, side='right')
+        last = np.searchsorted(self.months, date_to, side='right')
+        if last <= first:
+            return 0, 0
+        return self.offsets[first], self.offsets[last]
+
+    def inverted_index(self):
+        if self._inverted_index is None:
+            self._inverted_index = InvertedIndex(self)
+        return self._inverted_index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def equals(self, column, value):
+        # boolean mask of the rows where column equals value (a value as returned by RulesQuery.token_value)
+        # money values are its text
+        column = ClicksInfo.api_field(column)
+        if column in self.dictionaries:
+            dictionary = self.dictionaries[column]
+            code = np.searchsorted(dictionary, value)
+            if code == len(dictionary) or dictionary[code] != value:
+                return np.zeros(len(self), dtype=bool)
+            return self.columns[column] == code
+        if column == 'date':
+            return self.columns[column] == np.datetime64(value, 'D')
+        if column in self.float_columns:
+            return self.columns[column] == float(value)
+        return self.columns[column] == value
+
+    def sort_key(self, column, selection):
+        # an array which sorts like the column does
+        if column == 'date':
+            return self.columns[column][selection].view(np.int64)
+        return self.columns[column][selection]
+
+    def group_key(self, column, selection):
+        # an array which is equal where the returned values of the column are equal, money is grouped by its text
+        if column in ClicksInfo.text_columns:
+            return self.columns[ClicksInfo.api_field(column)][selection]
+        return self.sort_key(column, selection)
+
+    def compare(self, column, selection, value):
+        # (greater, equal) masks of the selected rows compared with a cursor value of the column
+        if column in self.categorical_columns:
+            dictionary = self.dictionaries[column]
+            codes = self.columns[column][selection]
+            return (dictionary > value)[codes], (dictionary == value)[codes]
+
+        if column == 'id':
+            keys, value = self.ids[selection], int(value)
+        elif column == 'date':
+            keys, value = self.columns[column][selection], np.datetime64(value, 'D')
+        elif column in self.float_columns:
+            keys, value = self.columns[column][selection], float(value)
+        else:
+            keys, value = self.columns[column][selection], int(value)
+
+        return keys > value, keys == value
+
+    def cursor_value(self, column, position):
+        # the value of the column in the row at position, as it is stored in a cursor
+        if column == 'id':
+            return int(self.ids[position])
+        if column == 'date':
+            return str(self.columns[column][position])
+        if column in self.categorical_columns:
+            return str(self.dictionaries[column][self.columns[column][position]])
+        return self.columns[column][position].item()
+
+    def formatted(self, column, selection):
+        # the column values of the selected rows as the api returns them, formatted the same way as ClicksInfo.api_format
+        if column == 'id':
+            return self.ids[selection]
+        column = ClicksInfo.api_field(column)
+        if column == 'date':
+            return np.datetime_as_string(self.columns[column][selection], unit='D')
+        if column in self.dictionaries:
+            return self.dictionaries[column][self.columns[column][selection]]
+        return self.columns[column][selection].astype(str)
+
+
+class ColumnarEngine:
+    '''
+    executes a validated rules dictionary against a ColumnarTable, returning the same rows as the sql engine
+
+    every rule is executed with whole array operations (boolean masks, a stable argsort, np.unique for grouping),
+    the only python loop per row is building the output dicts of the rows which are returned
+
+    include_only runs first, through the table's InvertedIndex, so the other rules only see the matching rows
+
+    an engine can execute many requests (see the batch endpoint), the filtered rows are kept per filter,
+    so requests with the same date range and include_only filter the table only once
+    the kept arrays are shared between requests, so nothing may modify them in place
+    '''
+
+    def __init__(self, table):
+        self.table = table
+        self.filtered_rows = {}
+
+    def include_only_positions(self, rules, model_columns):
+        # sorted positions of the rows matching every include_only token
+        table = self.table
+        index = table.inverted_index()
+        query = RulesQuery(rules, model_columns)
+
+        token_positions = []
+        for token in rules['include_only']:
+            # a row matches a token if any of its requested columns is equal to the token
+            parts = []
+            for c in query.token_columns():
+                value = query.token_value(token, c)
+                if value is None:
+                    continue
+                if c in index.indexed_columns:
+                    parts.append(index.posting(c, value))
+                else:
+                    # the numerical columns are not indexed, so they are scanned
+                    parts.append(np.flatnonzero(table.equals(c, value)))
+
+            if len(parts) == 0:
+                return np.empty(0, dtype=np.int64)
+            token_positions.append(np.unique(np.concatenate(parts)))
+
+        return index.intersect(token_positions)
+
+    def group_order(self, rules, selection):
+        # order which keeps the sorted order inside every group, and orders the groups by where they first appear
+        table = self.table
+
+        codes = []
+        for c in rules['group']:
+            values = table.group_key(c, selection)
+            codes.append(np.unique(values, return_inverse=True)[1])
+
+        _, first_index, inverse = np.unique(np.stack(codes, axis=1), axis=0, return_index=True, return_inverse=True)
+        return np.argsort(first_index[inverse.reshape(-1)], kind='stable')
+
+    def order_fields(self, rules):
+        # list of (column, descending) pairs of a paged request without group, the same order RulesQuery uses
+        sort_column, direction = rules['sorted']
+        return [(sort_column, direction == 'descending'), ('id', False)]
+
+    def page(self, rules, selection):
+        # orders the selected rows by the order fields, and keeps the rows of the requested page (plus one, to tell if there is a next)
+        table = self.table
+        order_fields = self.order_fields(rules)
+
+        if rules['cursor'] is not None:
+            # the rows after the cursor, (a, b) > (x, y) is a > x or (a = x and b > y)
+            after = np.zeros(len(selection), dtype=bool)
+            for (column, descending), value in reversed(list(zip(order_fields, rules['cursor']))):
+                greater, equal = table.compare(column, selection, value)
+                if descending:
+                    greater = ~greater & ~equal
+                after = greater | (equal & after)
+            selection = selection[after]
+
+        # the sort keys, all ascending, calculated once for every row
+        keys = []
+        for column, descending in order_fields:
+            key = table.ids[selection] if column == 'id' else table.sort_key(column, selection)
+            keys.append(-key if descending else key)
+
+        size = rules['limit'] + 1
+        if len(selection) > size:
+            # top k: only rows whose first key is among the size smallest can be on the page
+            # np.partition finds that bound in linear time, so only those rows (and their ties) are fully sorted
+            bound = np.partition(keys[0], size - 1)[size - 1]
+            candidates = np.flatnonzero(keys[0] <= bound)
+            selection = selection[candidates]
+            keys = [key[candidates] for key in keys]
+
+        # np.lexsort sorts by the last key first
+        order = np.lexsort(keys[::-1])[:size]
+        return selection[order]
+
+    def filter_key(self, rules):
+        # everything the filtered rows depend on, include_only tokens are matched against the requested columns
+        if len(rules['include_only']) == 0:
+            return rules['date_from'], rules['date_to']
+        return rules['date_from'], rules['date_to'], tuple(rules['include_only']), frozenset(rules['columns'])
+
+    def filter(self, rules, model_columns):
+        # the positions of the rows matching date_from, date_to and include_only
+        key = self.filter_key(rules)
+        if key in self.filtered_rows:
+            return self.filtered_rows[key]
+
+        table = self.table
+
+        date_from = np.datetime64(date(*rules['date_from']), 'D')
+        date_to = np.datetime64(date(*rules['date_to']), 'D')
+
+        if len(rules['include_only']) > 0:
+            # include_only first, through the inverted index, then date_from and date_to on the matching rows only
+            selection = self.include_only_positions(rules, model_columns)
+            dates = table.columns['date'][selection]
+            selection = selection[(dates >= date_from) & (dates <= date_to)]
+        else:
+            # date_from and date_to, only within the partitions of the date range
+            start, end = table.partition_range(date_from, date_to)
+            dates = table.columns['date'][start:end]
+            selection = np.flatnonzero((dates >= date_from) & (dates <= date_to)) + start
+
+        self.filtered_rows[key] = selection
+        return selection
+
+    def execute(self, rules, model_columns):
+        # returns the rows, and the order values of the last row if there is a next page (None otherwise)
+        table = self.table
+
+        selection = self.filter(rules, model_columns)
+
+        next_values = None
+        if rules['limit'] is not None and len(rules['group']) == 0:
+            # sorted, limit (or top) and cursor
+            selection = self.page(rules, selection)
+            if len(selection) > rules['limit']:
+                selection = selection[:rules['limit']]
+                next_values = [table.cursor_value(column, selection[-1]) for column, descending in self.order_fields(rules)]
+        else:
+            # sorted, with id as the tiebreaker (the same tiebreaker the sql engine uses)
+            sort_column, direction = rules['sorted']
+            key = table.sort_key(sort_column, selection)
+            if direction == 'descending':
+                key = -key
+            order = np.lexsort((table.ids[selection], key))
+            selection = selection[order]
+
+            # group
+            if len(rules['group']) > 0 and len(selection) > 0:
+                selection = selection[self.group_order(rules, selection)]
+
+            if rules['limit'] is not None:
+                # top with group, the first rows once every group is together
+                selection = selection[:rules['limit']]
+
+        # columns
+        columns = RulesQuery(rules, model_columns).output_columns()
+        values = [table.formatted(c, selection).tolist() for c in columns]
+
+        return [dict(zip(columns, row)) for row in zip(*values)], next_values
+
+
+# the table is loaded once per process, and reloaded when the data version changes
+_table = None
+_table_lock = threading.Lock()
+
+
+def load_table(version, previous):
+    # maps the snapshot of the current data version if there is one, otherwise builds the table of the current catalog,
+    # reusing the partitions of the previous table whose version did not change
+    path = getattr(settings, 'CLICKS_INFO_SNAPSHOT', None)
+    if path:
+        arrays = read_snapshot(path, version)
+        if arrays is not None:
+            return ColumnarTable.from_snapshot(version, arrays)
+
+    reusable = {}
+    if previous is not None:
+        reusable = {(p.month, p.version): p for p in previous.partitions}
+
+    # one read transaction, so the catalog and the partitions are read from the same committed data
+    with transaction.atomic(using=read_alias()):
+        partitions = []
+        for month, partition_version in catalog():
+            partition = reusable.get((month, partition_version))
+            if partition is None:
+                partition = ColumnarPartition(month, partition_version)
+            partitions.append(partition)
+
+    return ColumnarTable(version, partitions)
+
+
+def export_snapshot(path):
+    # writes a snapshot of the current data under path (see handler/snapshot.py), returns its directory and its table
+    # the rows and their version are read together, so the snapshot is exactly the data of its version
+    with transaction.atomic(using=read_alias()):
+        version = data_version()[0]
+        table = load_table(version, None)
+
+    return write_snapshot(table, path), table
+
+
+@receiver(data_changed)
+def refresh_snapshot(sender, **kwargs):
+    '''
+    exports the snapshot again once a data change is committed, if one was exported before
+
+    without this a snapshot is only used until the first load after its export, the new snapshot is written by the process
+    which changed the data (e.g. load_clicks), and the other workers map it on their next request
+    CLICKS_INFO_SNAPSHOT_REFRESH = False leaves it to the export_snapshot command
+    '''
+    path = getattr(settings, 'CLICKS_INFO_SNAPSHOT', None)
+    if np is None or not path or not getattr(settings, 'CLICKS_INFO_SNAPSHOT_REFRESH', True) or not has_snapshot(path):
+        return
+    export_snapshot(path)
+
+
+def columnar_table():
+    global _table
+
+    if np is None:
+        raise ImportError('The numpy engine requires numpy, install it or set CLICKS_INFO_ENGINE to sql')
+
+    version = data_version()[0]
+    if _table is None or _table.version != version:
+        with _table_lock:
+            if _table is None or _table.version != version:
+                _table = load_table(version, _table)
+
+    return _table
@@ -0,0 +1,84 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+'''
+the sqlite connection layer
+
+every new sqlite connection is set up with the CLICKS_INFO_SQLITE_PRAGMAS (see settings.py), most importantly
+journal_mode = WAL, in which readers never wait for a writer: LoadDB writes while the api keeps reading the last committed rows
+connections are kept open by every worker thread for CONN_MAX_AGE seconds, so the pragmas run once per thread, not once per request
+
+with CLICKS_INFO_READ_REPLICA set, the api reads through a second, read only connection (the 'replica' database):
+the same database file opened with mode=ro, or a copy of it (such as a backup taken after every load)
+only the reads made inside replica_reads() go there, which the clicks info views wrap their requests in,
+everything else (LoadDB, the signals, the management commands) keeps reading and writing the default database
+'''
+
+REPLICA = 'replica'
+
+# the pragmas which only a writable connection can set
+writer_pragmas = ['journal_mode']
+
+_state = threading.local()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'CLICKS_INFO_SQLITE_PRAGMAS', {}).items():
+            if connection.alias == REPLICA and name in writer_pragmas:
+                continue
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+@contextmanager
+def replica_reads():
+    # the reads of this thread inside the block go to the replica, if there is one
+    depth = getattr(_state, 'depth', 0)
+    _state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _state.depth = depth
+
+
+def read_alias():
+    # the database the reads of this thread go to
+    if has_replica() and getattr(_state, 'depth', 0) > 0:
+        return REPLICA
+    return DEFAULT_DB_ALIAS
+
+
+class ReadReplicaRouter:
+    '''
+    sends the reads made inside replica_reads() to the replica, and never migrates it (it is read only)
+    '''
+
+    def db_for_read(self, model, **hints):
+        if read_alias() == REPLICA:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPLICA:
+            return False
+        return None
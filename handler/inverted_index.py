@@ -0,0 +1,78 @@
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed for the numpy engine
+    np = None
+
+
+class InvertedIndex:
+    '''
+    value -> row positions index over the categorical and date columns of a ColumnarTable
+
+    for every indexed column the row positions are kept sorted by value (and by position within a value),
+    so the posting list of a value is a single slice found with two binary searches
+
+    include_only tokens are answered by taking the union of a token's posting lists over the requested columns,
+    and intersecting the results of all tokens, so the cost follows the number of matching rows rather than the table size
+    '''
+
+    indexed_columns = ['date', 'channel', 'country', 'os']
+
+    def __init__(self, table):
+        self.table = table
+
+        self.sorted_keys = {}
+        self.positions = {}
+        for c in self.indexed_columns:
+            keys = self.column_keys(c)
+            order = np.argsort(keys, kind='stable')
+            self.sorted_keys[c] = keys[order]
+            self.positions[c] = order
+
+    @classmethod
+    def from_arrays(cls, table, sorted_keys, positions):
+        # an index which was already built, such as the one stored in a snapshot
+        index = cls.__new__(cls)
+        index.table = table
+        index.sorted_keys = sorted_keys
+        index.positions = positions
+        return index
+
+    def column_keys(self, column):
+        # the integer keys the column is indexed by, codes for the categorical columns and days for dates
+        if column == 'date':
+            return self.table.columns[column].view(np.int64)
+        return self.table.columns[column]
+
+    def value_key(self, column, value):
+        # the integer key of a value (as returned by RulesQuery.token_value), or None if the column never holds it
+        if column == 'date':
+            return np.datetime64(value, 'D').astype(np.int64)
+
+        dictionary = self.table.dictionaries[column]
+        code = np.searchsorted(dictionary, value)
+        if code == len(dictionary) or dictionary[code] != value:
+            return None
+        return code
+
+    def posting(self, column, value):
+        # sorted row positions where column equals value
+        # (the positions of equal keys are already in order, since the index was built with a stable sort)
+        key = self.value_key(column, value)
+        if key is None:
+            return np.empty(0, dtype=np.int64)
+
+        sorted_keys = self.sorted_keys[column]
+        low = np.searchsorted(sorted_keys, key, side='left')
+        high = np.searchsorted(sorted_keys, key, side='right')
+        return self.positions[column][low:high]
+
+    def intersect(self, postings):
+        # intersect sorted posting lists, smallest first so every step is as cheap as possible
+        postings = sorted(postings, key=len)
+        result = postings[0]
+        for posting in postings[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, posting, assume_unique=True)
+        return result
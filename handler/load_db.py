@@ -1,69 +1,268 @@
+import csv
+import os
 import sqlite3
+import time
 from sqlite3 import Error
-from .models import ClicksInfo
+from datetime import date
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ClicksInfo, LoadWatermark
+from .signals import bump_data_version
+from .rollups import add_to_rollups
+from .partitions import month_start, add_to_partitions, read_only_months
 
 class LoadDB:
-    def __init__(self, db_path):
+    '''
+    loads the clicks info rows from a source database into the ClicksInfo table
+
+    the source is either an sqlite3 file with a clicksinfo table, or a csv file with the same columns and no header
+    (such as database/db.csv):
+
+    date, channel, country, os, impressions, clicks, installs, spend, revenue
+
+    source rows are read chunk_size rows at a time, and every chunk is upserted inside its own transaction,
+    so memory use does not grow with the size of the source:
+    new rows are inserted with a single bulk insert, rows which are already in the table (same date, channel, country and os)
+    are updated if their values changed and skipped otherwise
+
+    the rollup tables (see handler/rollups.py) are kept up to date one chunk at a time, by adding the chunk's inserted rows and
+    the changes of its updated rows to the rollup rows they fall in, without recomputing whole periods
+    and so is the partition catalog (see handler/partitions.py), rows for months which were made read only are rejected
+
+    with incremental=True only the rows added to the source since its last load are read, using the source's high-water mark
+    (LoadWatermark): the largest rowid loaded for sqlite sources, and the latest date loaded for csv sources
+    (the rows of that date are read again, as the day may have been exported before it was complete)
+    with atomic=True the whole load is one transaction, so the api sees either none or all of its rows
+    '''
+
+    # the source columns a loaded row is updated with when they change, the rest identify the row
+    # (a reload also brings back the text of money which was only written another way, such as 43612 loaded as 43612.0)
+    value_columns = ['impressions', 'clicks', 'installs', 'spend', 'revenue', 'spend_text', 'revenue_text']
+
+    def __init__(self, db_path, chunk_size=5000, incremental=False, atomic=False):
         self.db_path = db_path
-    
+        self.chunk_size = chunk_size
+        self.incremental = incremental
+        self.atomic = atomic
+
+        # the high-water mark of the rows read so far, saved once the load is done
+        self.last_rowid = None
+        self.last_date = None
+
     def create_connection(self):
         """ create a database connection to the SQLite database
             specified by the self.db_path path
         :return: Connection object or None
         """
-        
+
         conn = None
         try:
             conn = sqlite3.connect(self.db_path)
         except Error as e:
             print(e)
-     
+
         return conn
- 
 
-    def get_all_rows(self, conn):
-        # creation status success log
-        stat_log = {}
-        
+    def is_csv(self):
+        return self.db_path.lower().endswith('.csv')
+
+    def source(self):
+        # the name the source's high-water mark is stored under
+        return os.path.abspath(self.db_path)
+
+    def watermark(self):
+        # the source's high-water mark, None for a full load or a source which was never loaded
+        if not self.incremental:
+            return None
+        return LoadWatermark.objects.filter(source=self.source()).first()
+
+    def save_watermark(self, rows_read):
+        if self.last_rowid is None and self.last_date is None:
+            # nothing was read, the mark stays where it was
+            return
+
+        # incremental loads only read rows after the mark, so it only moves forward, a full load sets it to what it read
+        watermark = LoadWatermark.objects.filter(source=self.source()).first()
+        if watermark is None:
+            watermark = LoadWatermark(source=self.source())
+        watermark.last_rowid = self.last_rowid
+        watermark.last_date = self.last_date
+        watermark.rows += rows_read
+        watermark.loaded = timezone.now()
+        watermark.save()
+
+    def sqlite_chunks(self, conn):
+        # stream the source table, chunk_size rows at a time, in rowid order and after the high-water mark
+        watermark = self.watermark()
+        last_rowid = watermark.last_rowid if watermark is not None and watermark.last_rowid is not None else 0
+
         cur = conn.cursor()
-        cur.execute("SELECT * FROM clicksinfo")
-        
-        rows = cur.fetchall()
-        
-        row_counter = 0
-        for row in rows:
-            
-            object, created = ClicksInfo.objects.get_or_create(
-                                                          date=row[0],
-                                                          channel=row[1],
-                                                          country=row[2],
-                                                          os=row[3],
-                                                          impressions=row[4],
-                                                          clicks=row[5],
-                                                          installs=row[6],
-                                                          spend=row[7],
-                                                          revenue=row[8],
-                                                          )
-            
-            print('Row {} Status {}'.format(row_counter, created))
-            stat_log[row_counter] = created
-            
-            row_counter += 1
-        
+        cur.execute("SELECT date, channel, country, os, impressions, clicks, installs, spend, revenue, rowid FROM clicksinfo WHERE rowid > ? ORDER BY rowid", (last_rowid,))
+
+        while True:
+            rows = cur.fetchmany(self.chunk_size)
+            if len(rows) == 0:
+                return
+            self.last_rowid = rows[-1][9]
+            yield rows
+
+    def csv_chunks(self, csv_file):
+        # stream the csv file, chunk_size rows at a time, skipping the rows before the high-water mark
+        watermark = self.watermark()
+        since = watermark.last_date if watermark is not None else None
+
+        rows = []
+        for row in csv.reader(csv_file):
+            if len(row) == 0:
+                continue
+            if since is not None and self.parse_date(row[0]) < since:
+                continue
+            rows.append(row)
+            if len(rows) == self.chunk_size:
+                yield rows
+                rows = []
+
+        if len(rows) > 0:
+            yield rows
+
+    def parse_date(self, value):
+        year, month, day = value.split('-')
+        return date(int(year), int(month), int(day))
+
+    def row_to_model(self, row):
+        model_obj = ClicksInfo(
+                          date=self.parse_date(row[0]),
+                          channel=row[1],
+                          country=row[2],
+                          os=row[3],
+                          impressions=int(row[4]),
+                          clicks=int(row[5]),
+                          installs=int(row[6]),
+                          spend=Decimal(str(row[7])),
+                          revenue=Decimal(str(row[8])),
+                          # the money as the source wrote it, which is what the api returns
+                          spend_text=str(row[7]),
+                          revenue_text=str(row[8]),
+                          )
+
+        # bulk_create does not send pre_save, so the derived metrics are calculated here
+        model_obj.calculate_metrics()
+        return model_obj
+
+    def upsert(self, objects):
+        # inserts the new rows and updates the loaded rows whose values changed
+        # returns the inserted rows, the updated rows, and the updated rows as they were before
+        # a row appearing twice in the chunk is loaded with its last values
+        new = {(model_obj.date, model_obj.channel, model_obj.country, model_obj.os): model_obj for model_obj in objects}
+
+        # the loaded rows of the chunk's dates, source rows usually come in date order, so this is a narrow date range
+        existing = ClicksInfo.objects.filter(date__gte=min(key[0] for key in new), date__lte=max(key[0] for key in new))
+        changed = []
+        replaced = []
+        for row in existing.values('id', 'date', 'channel', 'country', 'os', *self.value_columns):
+            model_obj = new.pop((row['date'], row['channel'], row['country'], row['os']), None)
+            if model_obj is None:
+                continue
+            if any(getattr(model_obj, c) != row[c] for c in self.value_columns):
+                model_obj.pk = row['id']
+                changed.append(model_obj)
+                replaced.append(ClicksInfo(**row))
+
+        inserted = list(new.values())
+        ClicksInfo.objects.bulk_create(inserted, ignore_conflicts=True)
+        ClicksInfo.objects.bulk_update(changed, self.value_columns + list(ClicksInfo.derived_metrics), batch_size=500)
+        return inserted, changed, replaced
+
+    def insert_chunks(self, chunks):
+        # creation status summary
+        stat_log = {
+                    'rows_read': 0,
+                    'rows_inserted': 0,
+                    'rows_updated': 0,
+                    'rows_skipped': 0,
+                    'rows_rejected': 0,
+                    'seconds': 0.0,
+                    'rows_per_second': 0.0,
+                    }
+
+        start = time.monotonic()
+        changed_dates = set()
+
+        for rows in chunks:
+            objects = [self.row_to_model(row) for row in rows]
+            stat_log['rows_read'] += len(rows)
+
+            chunk_last_date = max(model_obj.date for model_obj in objects)
+            if self.last_date is None or chunk_last_date > self.last_date:
+                self.last_date = chunk_last_date
+
+            # one transaction per chunk (a savepoint of the load's transaction when it is atomic)
+            # the rollups and partitions are brought up to date with the changed rows in the same transaction, so they always agree with the rows
+            with transaction.atomic():
+                read_only = read_only_months({model_obj.date for model_obj in objects})
+                if len(read_only) > 0:
+                    kept = [model_obj for model_obj in objects if month_start(model_obj.date) not in read_only]
+                    stat_log['rows_rejected'] += len(objects) - len(kept)
+                    objects = kept
+
+                if len(objects) > 0:
+                    inserted, updated, replaced = self.upsert(objects)
+                    stat_log['rows_inserted'] += len(inserted)
+                    stat_log['rows_updated'] += len(updated)
+
+                    dates = {model_obj.date for model_obj in inserted + updated}
+                    if len(dates) > 0:
+                        add_to_rollups(inserted + updated, replaced)
+                        add_to_partitions(inserted, dates)
+                        changed_dates |= dates
+
+            elapsed = time.monotonic() - start
+            print('Read {} rows ({:.0f} rows/s)'.format(stat_log['rows_read'], stat_log['rows_read'] / max(elapsed, 1e-9)))
+
+        stat_log['seconds'] = time.monotonic() - start
+        stat_log['rows_skipped'] = stat_log['rows_read'] - stat_log['rows_inserted'] - stat_log['rows_updated'] - stat_log['rows_rejected']
+        stat_log['rows_per_second'] = stat_log['rows_read'] / max(stat_log['seconds'], 1e-9)
+
+        self.save_watermark(stat_log['rows_read'])
+
+        # bulk inserts and updates do not send model signals, so tell the caches about the changed rows here
+        if len(changed_dates) > 0:
+            bump_data_version(changed_dates)
+
         return stat_log
-        
-    def load_db(self):
+
+    def get_all_rows(self, conn):
+        return self.insert_chunks(self.sqlite_chunks(conn))
+
+    def load(self):
+        if self.is_csv():
+            print("Get {} rows from CSV".format('new' if self.incremental else 'all'))
+            with open(self.db_path, newline='') as csv_file:
+                return self.insert_chunks(self.csv_chunks(csv_file))
+
         # create a database connection
         conn = self.create_connection()
         with conn:
-            print("Get all rows from DB")
+            print("Get {} rows from DB".format('new' if self.incremental else 'all'))
             status = self.get_all_rows(conn)
-            
-        # print success status log for each of all the tables in the db
-        print(status)
-        # print final success status of ALL tables (single True or False)
-        print('Final Status {}'.format(all(value == True for value in status.values())))
-
-'''            
-dbloader = DBLoader('sample_db.sqlite3')
-dbloader.load_db()'''
\ No newline at end of file
+        conn.close()
+        return status
+
+    def load_db(self):
+        if self.atomic:
+            with transaction.atomic():
+                status = self.load()
+        else:
+            status = self.load()
+
+        # print summary of the load
+        print('Read {rows_read} rows, inserted {rows_inserted}, updated {rows_updated}, skipped {rows_skipped} already loaded rows, rejected {rows_rejected} rows of read only months, in {seconds:.2f}s ({rows_per_second:.0f} rows/s)'.format(**status))
+
+        return status
+
+'''
+dbloader = LoadDB('database/clicksinfo_db.sqlite3')
+dbloader.load_db()'''
@@ -0,0 +1 @@
+# not empty
\ No newline at end of file
@@ -0,0 +1,215 @@
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import setup_databases, teardown_databases
+from rest_framework.renderers import JSONRenderer
+
+from handler.load_db import LoadDB
+from handler.views import ViewClicksInfo
+from handler.caching import single_flight
+
+
+# the README example queries, plus the worst cases of the pipeline
+QUERIES = {
+           'default': '',
+           'readme_1_clicks_by_channel_country': 'date_to=2017-05-31&group=channel,country&sorted=clicks,descending&columns=impressions',
+           'readme_2_ios_installs_in_may': 'date_from=2017-05-01&date_to=2017-05-31&group=date,os&sorted=date,ascending&columns=os,installs,date&include_only=ios',
+           'readme_3_us_revenue_on_june_1': 'include_only=2017-06-01,US&group=os&sorted=revenue,descending&columns=revenue,date,os,country',
+           'readme_4_ca_cpi_by_channel': 'include_only=CA&group=channel&cpi=true&sorted=cpi,descending&columns=country',
+           'full_table_include_only': 'include_only=ios',
+           'full_table_cpi_sort': 'cpi=true&sorted=cpi,descending',
+           'top_20_rows_by_revenue': 'sorted=revenue,descending&top=20',
+           'aggregate_by_channel_country': 'group=channel,country&agg=sum:impressions,sum:clicks,count&cpi=true&sorted=clicks,descending',
+           }
+
+# the channels, countries and os of database/db.csv, extended with made up values up to the requested cardinalities
+CHANNELS = ['chartboost', 'facebook', 'google', 'unityads', 'vungle', 'apple_search_ads', 'adcolony']
+COUNTRIES = ['US', 'GB', 'DE', 'CA', 'FR', 'JP', 'KR', 'CN', 'BR', 'MX', 'IN', 'RU', 'IT', 'ES', 'NL', 'SE', 'NO', 'DK', 'FI', 'PL',
+             'TR', 'AU', 'NZ', 'AR', 'CL', 'CO', 'ZA', 'EG', 'SA', 'AE', 'IL', 'TH', 'VN', 'ID', 'MY', 'SG', 'PH', 'TW', 'HK', 'IE']
+OS = ['ios', 'android']
+
+
+class SyntheticClicks:
+    '''
+    generates rows shaped like database/db.csv
+
+    every day holds one row per channel, country and os combination (which keeps the rows unique, as the table requires),
+    starting on 2017-05-17 like the sample, for as many days as the requested number of rows needs
+    numbers follow the sample: a few thousand to a few tens of thousands of impressions, 1-5% of them clicked,
+    5-30% of the clicks installing, 1-3 per install spent, and 0-2 times the spend earned
+    '''
+
+    start_date = date(2017, 5, 17)
+
+    def __init__(self, rows, channels=25, countries=40, seed=0):
+        self.rows = rows
+        self.channels = CHANNELS + ['channel_{}'.format(i) for i in range(len(CHANNELS), channels)]
+        self.channels = self.channels[:channels]
+        self.countries = COUNTRIES[:countries]
+        self.random = random.Random(seed)
+
+    def generate(self):
+        generated = 0
+        day = self.start_date
+        while True:
+            for channel in self.channels:
+                for country in self.countries:
+                    for os_name in OS:
+                        if generated == self.rows:
+                            return
+                        yield self.row(day, channel, country, os_name)
+                        generated += 1
+            day += timedelta(days=1)
+
+    def row(self, day, channel, country, os_name):
+        rand = self.random
+        impressions = rand.randint(1000, 30000)
+        clicks = int(impressions * rand.uniform(0.01, 0.05))
+        installs = int(clicks * rand.uniform(0.05, 0.3))
+        spend = round(installs * rand.choice([1.0, 1.5, 2.0, 2.5, 3.0]), 2)
+        revenue = round(spend * rand.uniform(0, 2), 2)
+        return [day.isoformat(), channel, country, os_name, impressions, clicks, installs, spend, revenue]
+
+
+class Timer:
+    # collects the duration of every run of every stage, in seconds
+    def __init__(self):
+        self.durations = {}
+
+    def time(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, durations in self.durations.items():
+            summary[stage] = {
+                              'runs': len(durations),
+                              'median': statistics.median(durations),
+                              'min': min(durations),
+                              'max': max(durations),
+                              }
+        return summary
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the api_parser -> rules_validator -> execute_rules pipeline on synthetic data, and prints the timings as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='table sizes to benchmark, e.g. --rows 10000 1000000 10000000')
+        parser.add_argument('--repeat', type=int, default=5, help='runs of every query')
+        parser.add_argument('--channels', type=int, default=25)
+        parser.add_argument('--countries', type=int, default=40)
+        parser.add_argument('--engine', choices=['sql', 'numpy'], default=getattr(settings, 'CLICKS_INFO_ENGINE', 'sql'))
+        parser.add_argument('--query', nargs='+', choices=list(QUERIES), default=list(QUERIES), help='queries to run')
+        parser.add_argument('--output', help='file to write the json results to, instead of stdout')
+
+    def handle(self, *args, **options):
+        settings.CLICKS_INFO_ENGINE = options['engine']
+        settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+
+        report = {
+                  'meta': {
+                           'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           'engine': options['engine'],
+                           'repeat': options['repeat'],
+                           'python': platform.python_version(),
+                           'django': django.get_version(),
+                           'machine': platform.machine(),
+                           },
+                  'runs': [],
+                  }
+
+        # the benchmark runs on a throwaway test database, never on the real one
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            loaded = 0
+            for rows in sorted(options['rows']):
+                # the table only grows, so every size only loads the rows it adds
+                self.stderr.write('Loading {} rows'.format(rows))
+                load_log = self.load(loaded, rows, options)
+                loaded = rows
+
+                report['runs'].append({
+                                       'rows': rows,
+                                       'load': load_log,
+                                       'queries': {name: self.benchmark(QUERIES[name], options['repeat']) for name in options['query']},
+                                       })
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def load(self, loaded, rows, options):
+        # generates the rows past the ones already loaded, and loads them with LoadDB
+        generator = SyntheticClicks(rows, channels=options['channels'], countries=options['countries'])
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            with open(path, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                for index, row in enumerate(generator.generate()):
+                    if index >= loaded:
+                        writer.writerow(row)
+            # the loader's progress goes to stderr, so stdout only holds the json results
+            with contextlib.redirect_stdout(self.stderr):
+                return LoadDB(path).load_db()
+        finally:
+            os.remove(path)
+
+    def benchmark(self, api_flags, repeat):
+        # times every stage of the pipeline separately, then the whole request through the test client
+        timer = Timer()
+        view = ViewClicksInfo()
+        client = Client()
+
+        for run in range(repeat):
+            rules, parsing_status = timer.time('api_parser', view.api_parser, api_flags)
+            rules, validation_status = timer.time('rules_validator', view.rules_validator, rules)
+
+            if getattr(settings, 'CLICKS_INFO_ENGINE', 'sql') == 'sql' or len(rules['agg']) > 0:
+                query = view.compile_query(rules)
+                models = timer.time('query', lambda: list(query.queryset()))
+                rows_returned = len(models)
+
+                models = timer.time('execute_rules', view.execute_rules, rules, models)
+            else:
+                models, next_values = timer.time('run_rules', view.run_rules, rules)
+                rows_returned = len(models)
+
+            timer.time('serialization', JSONRenderer().render, models)
+
+            # the result cache and the results single flight keeps for a moment are emptied first,
+            # so every run executes the query instead of reading the previous run's result
+            caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+            single_flight.clear()
+            url = '/clicks_info/' + api_flags if api_flags else '/clicks_info'
+            response = timer.time('end_to_end', client.get, url)
+            assert response.status_code == 200, response.content
+
+        return {
+                'api_flags': api_flags,
+                'rows_returned': rows_returned,
+                'stages': timer.summary(),
+                }
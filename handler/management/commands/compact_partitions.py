@@ -0,0 +1,47 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from handler.models import ClicksInfoPartition
+from handler.partitions import freeze_partitions, thaw_partitions
+
+
+class Command(BaseCommand):
+    help = 'Makes the old monthly partitions of the clicks info rows read only, and compacts the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=3, help='number of latest months which stay writable')
+        parser.add_argument('--before', help='freeze every month before this date (yyyy-mm-dd) instead')
+        parser.add_argument('--thaw', action='store_true', help='make every frozen month writable again, e.g. to flush the database')
+
+    def handle(self, *args, **options):
+        if options['thaw']:
+            thawed = thaw_partitions()
+            self.stdout.write('Thawed {} months: {}'.format(len(thawed), ', '.join(m.strftime('%Y-%m') for m in thawed)))
+            return
+
+        if options['before'] is not None:
+            try:
+                year, month, day = options['before'].split('-')
+                before = date(int(year), int(month), int(day))
+            except ValueError:
+                raise CommandError('--before is in wrong format. Format expected is yyyy-mm-dd')
+        else:
+            # the latest months of the data, not of the calendar, stay writable
+            months = list(ClicksInfoPartition.objects.order_by('-month').values_list('month', flat=True)[:options['keep_months']])
+            if len(months) < options['keep_months'] or len(months) == 0:
+                self.stdout.write('Nothing to freeze')
+                return
+            before = months[-1]
+
+        frozen = freeze_partitions(before)
+        self.stdout.write('Froze {} months: {}'.format(len(frozen), ', '.join(m.strftime('%Y-%m') for m in frozen)))
+
+        # frozen months never change again, so this is when the space of their deleted and updated rows is reclaimed,
+        # and the query planner statistics are refreshed
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+                cursor.execute('ANALYZE')
+            self.stdout.write('Compacted the database')
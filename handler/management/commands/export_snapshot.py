@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from handler.columnar import export_snapshot
+from handler.snapshot import np
+
+
+class Command(BaseCommand):
+    help = 'Writes a memory mapped columnar snapshot of the clicks info rows, for the numpy engine to start from'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=getattr(settings, 'CLICKS_INFO_SNAPSHOT', None), help='snapshot directory')
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError('Snapshots require numpy')
+        if not options['path']:
+            raise CommandError('No snapshot directory, set CLICKS_INFO_SNAPSHOT or use --path')
+
+        directory, table = export_snapshot(options['path'])
+        self.stdout.write('Wrote {} rows of data version {} to {}'.format(len(table), table.version, directory))
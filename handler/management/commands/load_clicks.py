@@ -0,0 +1,29 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from handler.load_db import LoadDB
+from handler.models import LoadWatermark
+
+
+class Command(BaseCommand):
+    help = 'Loads the clicks info rows added to a source (sqlite3 or csv) since its last load, in one transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', nargs='?', default='database/clicksinfo_db.sqlite3', help='sqlite3 or csv file to load from')
+        parser.add_argument('--full', action='store_true', help='read every row of the source, not only the ones after its high-water mark')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='rows read and upserted at a time')
+        parser.add_argument('--no-atomic', action='store_true', help='commit every chunk on its own instead of the whole load at once')
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options['source']):
+            raise CommandError('No such source file: {}'.format(options['source']))
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        loader = LoadDB(options['source'], chunk_size=options['chunk_size'], incremental=not options['full'], atomic=not options['no_atomic'])
+        loader.load_db()
+
+        watermark = LoadWatermark.objects.filter(source=loader.source()).first()
+        if watermark is not None:
+            self.stdout.write('High-water mark of {}: rowid {}, date {}'.format(watermark.source, watermark.last_rowid, watermark.last_date))
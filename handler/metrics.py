@@ -0,0 +1,227 @@
+import threading
+import time
+
+
+'''
+per stage timing of clicks info requests
+
+every request times its stages with a StageTimer (time.perf_counter, a monotonic clock), counting the rows going into
+and out of each stage, and sends them back in a Server-Timing header
+the timings of every request are also added to the process wide StageMetrics histograms, per stage and per query shape,
+which the metrics endpoint returns in the prometheus text format
+
+recording a stage is two clock reads and a list append, and recording a request is one dict update per stage under a lock,
+so it is cheap enough to always be on
+'''
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+def metrics_shape(rules):
+    '''
+    low cardinality description of a validated rules dictionary, which flags are used but not their values
+
+    e.g. group:channel+country,sorted:clicks,cpi,include_only
+    two requests with the same shape run the same kind of query, only on different dates or include_only values
+    '''
+    parts = []
+    if len(rules['agg']) > 0:
+        parts.append('agg')
+    if len(rules['group']) > 0:
+        parts.append('group:' + '+'.join(rules['group']))
+    parts.append('sorted:' + rules['sorted'][0])
+    for metric in rules['metrics']:
+        parts.append(metric)
+    if len(rules['include_only']) > 0:
+        parts.append('include_only')
+    if rules['date_from'] != (1000, 1, 1) or rules['date_to'] != (3000, 12, 30):
+        parts.append('dates')
+    if rules['top'] == True:
+        parts.append('top')
+    elif rules['limit'] is not None:
+        parts.append('page')
+    if rules['format'] != 'json':
+        parts.append(rules['format'])
+    return ','.join(parts)
+
+
+def row_count(rows):
+    # number of rows of a stage's input or output, None if it is not a list of rows
+    return len(rows) if isinstance(rows, list) else None
+
+
+class StageTimer:
+    # times the stages of one request, in the order they ran
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def run(self, stage, function, *args):
+        # calls function(*args) as the named stage, and returns its result
+        # rows in is the length of the first argument and rows out the length of the result, when they are lists of rows
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+
+        rows_in = row_count(args[0]) if len(args) > 0 else None
+        self.stages.append((stage, seconds, rows_in, row_count(result)))
+        return result
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def merged_stages(self):
+        # the stages with the runs of a stage which ran more than once (such as the queries of a batch) added together
+        merged = {}
+        for stage, seconds, rows_in, rows_out in self.stages:
+            if stage not in merged:
+                merged[stage] = [stage, 0.0, None, None]
+            merged[stage][1] += seconds
+            if rows_in is not None:
+                merged[stage][2] = (merged[stage][2] or 0) + rows_in
+            if rows_out is not None:
+                merged[stage][3] = (merged[stage][3] or 0) + rows_out
+        return list(merged.values())
+
+    def server_timing(self):
+        # Server-Timing header value, durations in milliseconds, e.g. query;dur=12.3;desc="rows_out=200"
+        entries = []
+        for stage, seconds, rows_in, rows_out in self.merged_stages():
+            entry = '{};dur={:.3f}'.format(stage, seconds * 1000)
+
+            counts = []
+            if rows_in is not None:
+                counts.append('rows_in={}'.format(rows_in))
+            if rows_out is not None:
+                counts.append('rows_out={}'.format(rows_out))
+            if len(counts) > 0:
+                entry += ';desc="{}"'.format(' '.join(counts))
+
+            entries.append(entry)
+
+        entries.append('total;dur={:.3f}'.format(self.total() * 1000))
+        return ', '.join(entries)
+
+
+class Histogram:
+    # cumulative prometheus histogram of seconds, with the rows in and out of the stage counted alongside
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def observe(self, seconds, rows_in, rows_out):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.rows_in += rows_in or 0
+        self.rows_out += rows_out or 0
+
+    def cumulative(self):
+        counts = []
+        total = 0
+        for count in self.buckets:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q):
+        # estimates a quantile from the buckets, interpolating inside the bucket it falls in (as prometheus' histogram_quantile does)
+        if self.count == 0:
+            return float('nan')
+
+        rank = q * self.count
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in zip(BUCKETS, self.cumulative()):
+            if count >= rank:
+                if bound == float('inf'):
+                    # past the last finite bucket, the best estimate is its bound
+                    return lower_bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1)
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+
+class StageMetrics:
+    '''
+    process wide histograms of the stage timings, keyed by (stage, query shape)
+
+    at most max_shapes query shapes get their own histograms, the requests of any shape after them are counted under 'other',
+    so unusual flag combinations can't grow the metrics without bound
+    '''
+
+    max_shapes = 200
+
+    def __init__(self):
+        self.histograms = {}
+        self.shapes = set()
+        self.lock = threading.Lock()
+
+    def record(self, shape, timer):
+        with self.lock:
+            if shape not in self.shapes:
+                if len(self.shapes) < self.max_shapes:
+                    self.shapes.add(shape)
+                else:
+                    shape = 'other'
+
+            stages = timer.stages + [('total', timer.total(), None, None)]
+            for stage, seconds, rows_in, rows_out in stages:
+                key = (stage, shape)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].observe(seconds, rows_in, rows_out)
+
+    def prometheus(self):
+        # the histograms in the prometheus text exposition format
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+
+        lines = [
+                 '# HELP clicks_info_stage_seconds Time spent in each stage of a clicks info request.',
+                 '# TYPE clicks_info_stage_seconds histogram',
+                 ]
+        for (stage, shape), histogram in histograms:
+            labels = 'stage="{}",shape="{}"'.format(label_value(stage), label_value(shape))
+            for bound, count in zip(BUCKETS, histogram.cumulative()):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('clicks_info_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, count))
+            lines.append('clicks_info_stage_seconds_sum{{{}}} {!r}'.format(labels, histogram.sum))
+            lines.append('clicks_info_stage_seconds_count{{{}}} {}'.format(labels, histogram.count))
+
+        lines.append('# HELP clicks_info_stage_seconds_quantile p50, p95 and p99 of each stage, estimated from the histogram buckets.')
+        lines.append('# TYPE clicks_info_stage_seconds_quantile gauge')
+        for (stage, shape), histogram in histograms:
+            for q in QUANTILES:
+                labels = 'stage="{}",shape="{}",quantile="{}"'.format(label_value(stage), label_value(shape), q)
+                lines.append('clicks_info_stage_seconds_quantile{{{}}} {!r}'.format(labels, histogram.quantile(q)))
+
+        for direction in ['in', 'out']:
+            name = 'clicks_info_stage_rows_{}_total'.format(direction)
+            lines.append('# HELP {} Rows going {} of each stage of a clicks info request.'.format(name, 'into' if direction == 'in' else 'out'))
+            lines.append('# TYPE {} counter'.format(name))
+            for (stage, shape), histogram in histograms:
+                labels = 'stage="{}",shape="{}"'.format(label_value(stage), label_value(shape))
+                lines.append('{}{{{}}} {}'.format(name, labels, getattr(histogram, 'rows_' + direction)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def label_value(value):
+    # escapes a prometheus label value
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the histograms of this process
+stage_metrics = StageMetrics()
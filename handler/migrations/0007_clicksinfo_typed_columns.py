@@ -0,0 +1,93 @@
+# Generated by Django 2.2.4 on 2020-03-02 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0006_clicksinfo_cpi'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='date',
+            field=models.CharField(max_length=15, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='impressions',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='clicks',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='installs',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='spend',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='revenue',
+            field=models.CharField(max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='cpi',
+            field=models.CharField(default='0', max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='date_typed',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='impressions_typed',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='clicks_typed',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='installs_typed',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='spend_typed',
+            field=models.DecimalField(decimal_places=4, max_digits=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='revenue_typed',
+            field=models.DecimalField(decimal_places=4, max_digits=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='cpi_typed',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='spend_text',
+            field=models.CharField(default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='revenue_text',
+            field=models.CharField(default='', max_length=50),
+        ),
+    ]
@@ -0,0 +1,78 @@
+from datetime import date
+from decimal import Decimal
+
+from django.db import migrations
+
+# rows are converted in batches, so converting a large table does not load it all into memory at once
+BATCH_SIZE = 2000
+
+int_columns = ['impressions', 'clicks', 'installs']
+decimal_columns = ['spend', 'revenue']
+
+# the money strings are kept as their text, which the api returns (43612 and 43612.0 are the same decimal, not the same text)
+text_columns = {
+                'spend': 'spend_text',
+                'revenue': 'revenue_text',
+                }
+
+
+def batches(ClicksInfo):
+    # walk the table in id order, one batch at a time
+    last_id = 0
+    while True:
+        batch = list(ClicksInfo.objects.filter(id__gt=last_id).order_by('id')[:BATCH_SIZE])
+        if len(batch) == 0:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+def to_typed(apps, schema_editor):
+    ClicksInfo = apps.get_model('handler', 'ClicksInfo')
+    
+    typed_fields = ['date_typed', 'cpi_typed'] + [c + '_typed' for c in int_columns + decimal_columns] + list(text_columns.values())
+    
+    for batch in batches(ClicksInfo):
+        for row in batch:
+            year, month, day = row.date.split('-')
+            row.date_typed = date(int(year), int(month), int(day))
+            
+            for c in int_columns:
+                setattr(row, c + '_typed', int(getattr(row, c)))
+            for c in decimal_columns:
+                setattr(row, c + '_typed', Decimal(getattr(row, c)))
+                setattr(row, text_columns[c], getattr(row, c))
+            
+            row.cpi_typed = float(row.cpi)
+        
+        ClicksInfo.objects.bulk_update(batch, typed_fields)
+
+
+def to_strings(apps, schema_editor):
+    ClicksInfo = apps.get_model('handler', 'ClicksInfo')
+    
+    string_fields = ['date', 'cpi'] + int_columns + decimal_columns
+    
+    for batch in batches(ClicksInfo):
+        for row in batch:
+            row.date = row.date_typed.isoformat()
+            
+            for c in int_columns:
+                setattr(row, c, str(getattr(row, c + '_typed')))
+            for c in decimal_columns:
+                setattr(row, c, getattr(row, text_columns[c]) or str(float(getattr(row, c + '_typed'))))
+            
+            row.cpi = str(row.cpi_typed)
+        
+        ClicksInfo.objects.bulk_update(batch, string_fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0007_clicksinfo_typed_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_typed, to_strings),
+    ]
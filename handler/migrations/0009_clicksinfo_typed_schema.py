@@ -0,0 +1,122 @@
+# Generated by Django 2.2.4 on 2020-03-02 10:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0008_convert_typed_columns'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='date',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='impressions',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='clicks',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='installs',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='spend',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='revenue',
+        ),
+        migrations.RemoveField(
+            model_name='clicksinfo',
+            name='cpi',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='date_typed',
+            new_name='date',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='impressions_typed',
+            new_name='impressions',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='clicks_typed',
+            new_name='clicks',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='installs_typed',
+            new_name='installs',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='spend_typed',
+            new_name='spend',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='revenue_typed',
+            new_name='revenue',
+        ),
+        migrations.RenameField(
+            model_name='clicksinfo',
+            old_name='cpi_typed',
+            new_name='cpi',
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='impressions',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='clicks',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='installs',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='spend',
+            field=models.DecimalField(decimal_places=4, max_digits=15),
+        ),
+        migrations.AlterField(
+            model_name='clicksinfo',
+            name='revenue',
+            field=models.DecimalField(decimal_places=4, max_digits=15),
+        ),
+        migrations.AddIndex(
+            model_name='clicksinfo',
+            index=models.Index(fields=['date'], name='clicksinfo_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clicksinfo',
+            index=models.Index(fields=['country', 'date'], name='clicksinfo_country_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clicksinfo',
+            index=models.Index(fields=['channel', 'date'], name='clicksinfo_channel_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clicksinfo',
+            index=models.Index(fields=['os', 'date'], name='clicksinfo_os_date_idx'),
+        ),
+    ]
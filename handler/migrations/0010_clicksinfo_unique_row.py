@@ -0,0 +1,17 @@
+# Generated by Django 2.2.4 on 2026-10-18 09:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0009_clicksinfo_typed_schema'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='clicksinfo',
+            constraint=models.UniqueConstraint(fields=('date', 'channel', 'country', 'os'), name='clicksinfo_unique_row'),
+        ),
+    ]
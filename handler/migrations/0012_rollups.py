@@ -0,0 +1,105 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:08
+
+from django.db import migrations, models
+from django.db.models import F, Sum, Count
+from django.db.models.functions import TruncMonth
+
+# (model, period field, dimension columns) of every rollup
+rollups = [
+           ('DailyChannelRollup', 'date', ['channel']),
+           ('DailyCountryRollup', 'date', ['country']),
+           ('MonthlyChannelRollup', 'month', ['channel']),
+           ]
+
+measures = ['impressions', 'clicks', 'installs', 'spend', 'revenue']
+
+
+def fill_rollups(apps, schema_editor):
+    # builds the rollups of the rows which are already loaded, LoadDB keeps them up to date from here on
+    ClicksInfo = apps.get_model('handler', 'ClicksInfo')
+    
+    for name, period_field, dimensions in rollups:
+        Rollup = apps.get_model('handler', name)
+        
+        if period_field == 'month':
+            queryset = ClicksInfo.objects.annotate(period=TruncMonth('date'))
+        else:
+            queryset = ClicksInfo.objects.annotate(period=F('date'))
+        
+        totals = queryset.values('period', *dimensions).annotate(total_rows=Count('id'), **{'total_' + c: Sum(c) for c in measures})
+        
+        rows = []
+        for total in totals:
+            values = {period_field: total['period'], 'rows': total['total_rows']}
+            for c in dimensions:
+                values[c] = total[c]
+            for c in measures:
+                values[c] = total['total_' + c]
+            rows.append(Rollup(**values))
+        
+        Rollup.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0011_dataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyChannelRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.IntegerField()),
+                ('impressions', models.BigIntegerField()),
+                ('clicks', models.BigIntegerField()),
+                ('installs', models.BigIntegerField()),
+                ('spend', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('revenue', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('date', models.DateField()),
+                ('channel', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyCountryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.IntegerField()),
+                ('impressions', models.BigIntegerField()),
+                ('clicks', models.BigIntegerField()),
+                ('installs', models.BigIntegerField()),
+                ('spend', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('revenue', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('date', models.DateField()),
+                ('country', models.CharField(max_length=2)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MonthlyChannelRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.IntegerField()),
+                ('impressions', models.BigIntegerField()),
+                ('clicks', models.BigIntegerField()),
+                ('installs', models.BigIntegerField()),
+                ('spend', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('revenue', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('month', models.DateField()),
+                ('channel', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlychannelrollup',
+            constraint=models.UniqueConstraint(fields=('month', 'channel'), name='monthlychannelrollup_unique_row'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailycountryrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'country'), name='dailycountryrollup_unique_row'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailychannelrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'channel'), name='dailychannelrollup_unique_row'),
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
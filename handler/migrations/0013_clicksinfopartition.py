@@ -0,0 +1,50 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:17
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Max
+from django.db.models.functions import TruncMonth
+
+
+def fill_catalog(apps, schema_editor):
+    # one catalog entry for every month of the rows which are already loaded
+    ClicksInfo = apps.get_model('handler', 'ClicksInfo')
+    ClicksInfoPartition = apps.get_model('handler', 'ClicksInfoPartition')
+    
+    months = ClicksInfo.objects.annotate(month=TruncMonth('date')).values('month').annotate(
+                                                                                         rows=Count('id'),
+                                                                                         first_date=Min('date'),
+                                                                                         last_date=Max('date'),
+                                                                                         )
+    
+    ClicksInfoPartition.objects.bulk_create([ClicksInfoPartition(**month) for month in months])
+
+
+def drop_read_only_triggers(apps, schema_editor):
+    # the read only triggers (see handler/partitions.py) read the catalog, so they go before it does
+    if schema_editor.connection.vendor == 'sqlite':
+        for event in ['insert', 'update', 'delete']:
+            schema_editor.execute('DROP TRIGGER IF EXISTS handler_clicksinfo_read_only_' + event)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0012_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClicksInfoPartition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('rows', models.IntegerField()),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+                ('version', models.IntegerField(default=1)),
+                ('read_only', models.BooleanField(default=False)),
+                ('compacted', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_catalog, drop_read_only_triggers),
+    ]
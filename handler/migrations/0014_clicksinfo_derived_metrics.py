@@ -0,0 +1,75 @@
+# Generated by Django 2.2.4 on 2026-10-18 11:02
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+# rows are updated in batches, as in 0008, so filling a large table does not load it all into memory at once
+BATCH_SIZE = 2000
+
+# derived metric -> (numerator column, denominator column), as in ClicksInfo.derived_metrics
+derived_metrics = {
+                   'cpi': ('spend', 'installs'),
+                   'roas': ('revenue', 'spend'),
+                   'ctr': ('clicks', 'impressions'),
+                   }
+
+
+def ratio(numerator, denominator):
+    # a 0 denominator is counted as 1, as in ClicksInfo.ratio
+    if denominator == 0:
+        denominator = 1
+    return float(numerator) / float(denominator)
+
+
+def batches(ClicksInfo):
+    # walk the table in id order, one batch at a time, reading only the columns the metrics are calculated from
+    columns = sorted({c for pair in derived_metrics.values() for c in pair})
+    last_id = 0
+    while True:
+        batch = list(ClicksInfo.objects.filter(id__gt=last_id).order_by('id').only('id', *columns)[:BATCH_SIZE])
+        if len(batch) == 0:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+def fill_metrics(apps, schema_editor):
+    # calculates the derived metrics of the rows which are already loaded, saves and LoadDB keep them up to date from here on
+    ClicksInfo = apps.get_model('handler', 'ClicksInfo')
+    DataVersion = apps.get_model('handler', 'DataVersion')
+    
+    for batch in batches(ClicksInfo):
+        for row in batch:
+            for metric, (numerator, denominator) in derived_metrics.items():
+                setattr(row, metric, ratio(getattr(row, numerator), getattr(row, denominator)))
+        
+        ClicksInfo.objects.bulk_update(batch, list(derived_metrics), batch_size=500)
+    
+    # the rows changed, so every cached result and snapshot of them is stale
+    DataVersion.objects.update(version=F('version') + 1, updated=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0013_clicksinfopartition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='roas',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='clicksinfo',
+            name='ctr',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='clicksinfo',
+            index=models.Index(fields=['cpi'], name='clicksinfo_cpi_idx'),
+        ),
+        migrations.RunPython(fill_metrics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('handler', '0014_clicksinfo_derived_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True)),
+                ('last_rowid', models.BigIntegerField(blank=True, null=True)),
+                ('last_date', models.DateField(blank=True, null=True)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('loaded', models.DateTimeField()),
+            ],
+        ),
+    ]
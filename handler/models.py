@@ -1,11 +1,13 @@
+from datetime import date
+from decimal import Decimal
+
 from django.db import models
 
 # Create your models here.
 # model based on db structure provided in task
 
 class ClicksInfo(models.Model):
-    # format should not exceed yyyy-mm-dd format, but max_length has a few extra chars for leeway
-    date = models.CharField(max_length = 15)
+    date = models.DateField()
     
     # allowing 50 chars in case of long channel names
     channel = models.CharField(max_length = 50)
@@ -16,15 +18,225 @@ class ClicksInfo(models.Model):
     # 10 max chars in case of windows 10 (10 chars)
     os = models.CharField(max_length = 10)
     
-    # 50 chars max
-    impressions = models.CharField(max_length = 50)
-    clicks = models.CharField(max_length = 50)
-    installs = models.CharField(max_length = 50)
-    spend = models.CharField(max_length = 50)
-    revenue = models.CharField(max_length = 50)
+    impressions = models.IntegerField()
+    clicks = models.IntegerField()
+    installs = models.IntegerField()
+    
+    # money values have 2 decimal places, but decimal_places has a few extra places for leeway
+    spend = models.DecimalField(max_digits = 15, decimal_places = 4)
+    revenue = models.DecimalField(max_digits = 15, decimal_places = 4)
+    
+    # the money values as the source wrote them, which the api returns (e.g. 43612 and 43612.0 are the same decimal, but not the same text)
+    spend_text = models.CharField(max_length = 50, default = '')
+    revenue_text = models.CharField(max_length = 50, default = '')
+    
+    # derived metrics, calculated from the other columns whenever a row is saved or loaded (see calculate_metrics)
+    # cpi = spend / installs, roas = revenue / spend, ctr = clicks / impressions
+    cpi = models.FloatField(default = 0)
+    roas = models.FloatField(default = 0)
+    ctr = models.FloatField(default = 0)
+    
+    # derived metric -> (numerator column, denominator column)
+    derived_metrics = {
+                       'cpi': ('spend', 'installs'),
+                       'roas': ('revenue', 'spend'),
+                       'ctr': ('clicks', 'impressions'),
+                       }
+    
+    # money column -> the column holding its text
+    text_columns = {
+                    'spend': 'spend_text',
+                    'revenue': 'revenue_text',
+                    }
+    
+    # the columns the api had before the typed schema, a request for all of them also returns the row id, as it always did
+    # (the original view only removed id while removing a column which was not requested)
+    id_columns = ['date', 'channel', 'country', 'os', 'impressions', 'clicks', 'installs', 'spend', 'revenue', 'cpi']
+    
+    class Meta:
+        # indexes for the date range filter, and for the date range filter combined with the categorical columns
+        indexes = [
+                   models.Index(fields = ['date'], name = 'clicksinfo_date_idx'),
+                   models.Index(fields = ['country', 'date'], name = 'clicksinfo_country_date_idx'),
+                   models.Index(fields = ['channel', 'date'], name = 'clicksinfo_channel_date_idx'),
+                   models.Index(fields = ['os', 'date'], name = 'clicksinfo_os_date_idx'),
+                   models.Index(fields = ['cpi'], name = 'clicksinfo_cpi_idx'),
+                   ]
+        
+        # a row is identified by its date, channel, country and os, which lets LoadDB skip rows that are already loaded
+        constraints = [
+                       models.UniqueConstraint(fields = ['date', 'channel', 'country', 'os'], name = 'clicksinfo_unique_row'),
+                       ]
+    
+    @staticmethod
+    def api_format(value):
+        # format a column value the way the api has always returned it, back when every column was stored as a string
+        # dates as yyyy-mm-dd, integers as is, and money and the derived metrics the way python prints a float
+        # aggregates of no rows (such as the sum of an empty date range) are None, which is returned as null
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, int):
+            return str(value)
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return str(float(value))
+    
+    @classmethod
+    def api_formatter(cls, column):
+        # the function formatting the values of a column the way api_format does, picked once per column instead of once per value
+        internal_type = cls._meta.get_field(column).get_internal_type()
+        if internal_type == 'DateField':
+            return date.isoformat
+        if internal_type == 'AutoField':
+            # the row id was always returned as a number
+            return int
+        if internal_type == 'IntegerField':
+            return str
+        if internal_type in ['DecimalField', 'FloatField']:
+            return lambda value: str(float(value))
+        return cls.api_format
+    
+    @classmethod
+    def api_field(cls, column):
+        # the field the api returns a column from, money comes from its text
+        return cls.text_columns.get(column, column)
+    
+    @staticmethod
+    def ratio(numerator, denominator):
+        # a derived metric, with a 0 denominator counted as 1 to avoid division by zero
+        if denominator == 0:
+            denominator = 1
+        return float(numerator) / float(denominator)
+    
+    def calculate_metrics(self):
+        # sets the derived metrics from the row's current values
+        # saves do this through the pre_save signal, and LoadDB before it bulk creates the rows it loads
+        for metric, (numerator, denominator) in self.derived_metrics.items():
+            setattr(self, metric, self.ratio(getattr(self, numerator), getattr(self, denominator)))
+    
+    def calculate_text(self):
+        # sets the text of the money values which have none, or whose text no longer holds their value (e.g. after a change in the admin)
+        # LoadDB sets the text the source wrote, anything else gets the value the way python prints a float
+        for column, text_column in self.text_columns.items():
+            value = getattr(self, column)
+            text = getattr(self, text_column)
+            if text == '' or Decimal(text) != Decimal(str(value)):
+                setattr(self, text_column, self.api_format(value))
+    
+    def __str__(self):
+        return str(self.date)
+
+
+class DataVersion(models.Model):
+    # a single row counter, bumped every time the clicks info rows change
+    # anything built from the rows (such as the columnar cache) compares versions to know when to rebuild
+    version = models.IntegerField(default = 0)
+    updated = models.DateTimeField()
+    
+    def __str__(self):
+        return str(self.version)
+
+
+class ClicksInfoPartition(models.Model):
+    # catalog entry of a month of clicks info rows, maintained by LoadDB (see handler/partitions.py)
+    
+    # the first day of the month
+    month = models.DateField(unique = True)
+    
+    rows = models.IntegerField()
+    first_date = models.DateField()
+    last_date = models.DateField()
+    
+    # bumped every time the rows of the month change, so the numpy engine only reloads the months that changed
+    version = models.IntegerField(default = 1)
+    
+    # read only months can't be loaded into, saved or deleted from
+    read_only = models.BooleanField(default = False)
+    compacted = models.DateTimeField(null = True, blank = True)
+    
+    def __str__(self):
+        return self.month.strftime('%Y-%m')
+
+
+class LoadWatermark(models.Model):
+    # how far LoadDB got in a source, so an incremental load only reads the rows added after it (see handler/load_db.py)
+    
+    # the source file, as given to LoadDB
+    source = models.CharField(max_length = 255, unique = True)
+    
+    # sqlite sources: the largest rowid loaded, csv sources: the latest date loaded
+    last_rowid = models.BigIntegerField(null = True, blank = True)
+    last_date = models.DateField(null = True, blank = True)
     
-    # cpi insert
-    cpi = models.CharField(max_length = 50, default='0')
+    # rows read from the source over every load
+    rows = models.BigIntegerField(default = 0)
+    loaded = models.DateTimeField()
     
     def __str__(self):
-        return self.date
\ No newline at end of file
+        return self.source
+
+
+class Rollup(models.Model):
+    # per period totals of the clicks info rows sharing the rollup's dimension columns, maintained by LoadDB (see handler/rollups.py)
+    
+    # the clicks info rows summed into this row
+    rows = models.IntegerField()
+    
+    impressions = models.BigIntegerField()
+    clicks = models.BigIntegerField()
+    installs = models.BigIntegerField()
+    
+    spend = models.DecimalField(max_digits = 20, decimal_places = 4)
+    revenue = models.DecimalField(max_digits = 20, decimal_places = 4)
+    
+    # the date field the rows are totalled by, date for daily rollups and month (the first day of the month) for monthly ones
+    period_field = 'date'
+    
+    # the clicks info columns a row is identified by, besides its period
+    dimensions = []
+    
+    # name of the rollup in the X-Clicks-Info-Source header
+    source = ''
+    
+    class Meta:
+        abstract = True
+
+
+class DailyChannelRollup(Rollup):
+    date = models.DateField()
+    channel = models.CharField(max_length = 50)
+    
+    dimensions = ['channel']
+    source = 'rollup_daily_channel'
+    
+    class Meta:
+        constraints = [
+                       models.UniqueConstraint(fields = ['date', 'channel'], name = 'dailychannelrollup_unique_row'),
+                       ]
+
+
+class DailyCountryRollup(Rollup):
+    date = models.DateField()
+    country = models.CharField(max_length = 2)
+    
+    dimensions = ['country']
+    source = 'rollup_daily_country'
+    
+    class Meta:
+        constraints = [
+                       models.UniqueConstraint(fields = ['date', 'country'], name = 'dailycountryrollup_unique_row'),
+                       ]
+
+
+class MonthlyChannelRollup(Rollup):
+    month = models.DateField()
+    channel = models.CharField(max_length = 50)
+    
+    period_field = 'month'
+    dimensions = ['channel']
+    source = 'rollup_monthly_channel'
+    
+    class Meta:
+        constraints = [
+                       models.UniqueConstraint(fields = ['month', 'channel'], name = 'monthlychannelrollup_unique_row'),
+                       ]
@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import json
+import math
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from .caching import canonical_query
+
+
+'''
+keyset (cursor) pagination
+
+a cursor holds the sort key values of the last row of a page, plus a short hash of the query it belongs to
+the next page is every row that comes after those values in the query's order, so each page costs a single
+index range scan of limit rows, no matter how deep into the results it is
+
+cursors are url safe base64 of json, without padding so they can be used as an api flag value
+'''
+
+
+def query_shape(rules):
+    # short hash of the canonical rules of a query (without limit and cursor), so a cursor can't be used on a different query
+    canonical = json.dumps(canonical_query(rules), sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:12]
+
+
+def encode_cursor(shape, values):
+    text = json.dumps({'q': shape, 'k': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # returns the (shape, values) pair of a cursor, or raises ValueError if it is not a cursor
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        return decoded['q'], decoded['k']
+    except (TypeError, KeyError, UnicodeError, ValueError) as e:
+        raise ValueError('cursor is not valid') from e
+
+
+def typed_cursor(query, values):
+    '''
+    the values of a decoded cursor, checked against the order fields of the query it is used on
+
+    a cursor is only checked by its shape hash, so its values can still be anything json holds: the query must have
+    an order (a query without order fields, e.g. an ungrouped agg, is a single page and has no cursor), there must be one
+    value per order field, each one turned into the field's type (e.g. a date must be yyyy-mm-dd), finite and within
+    the range sqlite compares, otherwise ValueError is raised
+    the values are returned the way cursor_value writes them, so the same page always has the same cursor
+    '''
+    order_fields = query.order_fields()
+    if len(order_fields) == 0:
+        raise ValueError('cursor can not be used on a query without order')
+    if not isinstance(values, list) or len(values) != len(order_fields):
+        raise ValueError('cursor does not have a value for every order field')
+
+    typed = []
+    for (field, descending), value in zip(order_fields, values):
+        if value is None or isinstance(value, (bool, list, dict)):
+            raise ValueError('cursor value of {} is not valid'.format(field))
+        try:
+            value = query.order_field(field).to_python(value)
+            if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+                raise ValueError('cursor value of {} is out of range'.format(field))
+            if not isinstance(value, (int, str)) and not hasattr(value, 'isoformat') and not math.isfinite(value):
+                raise ValueError('cursor value of {} is not finite'.format(field))
+        except ValidationError as e:
+            raise ValueError('cursor value of {} is not valid'.format(field)) from e
+        typed.append(cursor_value(value))
+
+    return typed
+
+
+def cursor_value(value):
+    # json friendly form of a sort key value, dates and decimals are kept as strings
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def keyset_predicate(order_fields, values):
+    '''
+    predicate for the rows after values in the order of order_fields, a list of (field, descending) pairs
+
+    (a, b, c) > (x, y, z) is a > x or (a = x and b > y) or (a = x and b = y and c > z), with > flipped to < for descending fields
+    without order fields there is no row after values, and the predicate matches nothing
+    '''
+    terms = []
+    equal = Q()
+    for (field, descending), value in zip(order_fields, values):
+        lookup = '{}__{}'.format(field, 'lt' if descending else 'gt')
+        terms.append(equal & Q(**{lookup: value}))
+        equal &= Q(**{field: value})
+
+    if len(terms) == 0:
+        # pk__in=[] is django's empty predicate, it is never sent to the database
+        return Q(pk__in=[])
+
+    predicate = terms[0]
+    for term in terms[1:]:
+        predicate |= term
+    return predicate
@@ -0,0 +1,308 @@
+import functools
+import heapq
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, timedelta
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import ClicksInfo, ClicksInfoPartition
+from .query import RulesQuery
+from .aggregation import AggregateQuery
+from .database import replica_reads, read_alias
+from .signals import data_version
+
+
+'''
+parallel scans of the sql engine
+
+a request which can't be answered from an index or a rollup, such as a wide include_only over years of rows, is a scan
+of every row in its date range, run by sqlite on one core
+when the partition catalog estimates more than CLICKS_INFO_PARALLEL_ROWS rows in the range, the range is split into
+CLICKS_INFO_PARALLEL_WORKERS date ranges of about the same number of rows, and every range is scanned by a worker process:
+
+rows <- every worker runs the request's query on its range, filtered, sorted and limited to limit + 1 rows,
+        and the sorted runs are merged on the order columns (a k-way merge), which gives the rows in the same order as one query
+agg <- every worker groups its range into partial aggregates which add up (sums, counts, minimums and maximums),
+       the partials of the same group are combined, and the averages and derived metrics are calculated from the totals,
+       then the groups are sorted and paged the same way the database would
+
+the workers are started once per process (spawned, not forked, since the web process runs threads) and keep their own
+database connections, opened from the DATABASES setting, they read inside a transaction each, and if a worker read another
+database than the request (e.g. the request runs on a test database) or the data version changed while the ranges were read,
+the request is scanned in its own thread instead, so the ranges always come from the request's data
+an in memory database, which other processes can't open, is always scanned in the request's thread
+
+off by default (CLICKS_INFO_PARALLEL_WORKERS = 1)
+
+sums and averages of the money columns combined from partials can differ in the last float digits from one query
+'''
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def workers():
+    return getattr(settings, 'CLICKS_INFO_PARALLEL_WORKERS', 1)
+
+
+def executor():
+    # the worker processes, started by the first parallel scan of the process
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers(), mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+        return _pool
+
+
+def reset_executor():
+    # a worker died, the next parallel scan starts new ones
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def split_dates(date_from, date_to, count):
+    # up to count contiguous date ranges covering date_from to date_to, of about the same number of rows, and the number of rows in all of them
+    # estimated from the partition catalog, with the rows of a month spread evenly over its days
+    days = []
+    partitions = ClicksInfoPartition.objects.filter(last_date__gte=date_from, first_date__lte=date_to).order_by('month')
+    for first_date, last_date, rows in partitions.values_list('first_date', 'last_date', 'rows'):
+        per_day = rows / ((last_date - first_date).days + 1)
+        day = max(first_date, date_from)
+        while day <= min(last_date, date_to):
+            days.append((day, per_day))
+            day += timedelta(days=1)
+
+    total = sum(rows for day, rows in days)
+
+    ranges = []
+    start = date_from
+    seen = 0
+    # the first range starts at date_from and the last one ends at date_to, so no row is left out if the catalog is behind
+    for day, rows in days[:-1]:
+        seen += rows
+        if len(ranges) < count - 1 and seen >= total * (len(ranges) + 1) / count:
+            ranges.append((start, day))
+            start = day + timedelta(days=1)
+    ranges.append((start, date_to))
+
+    return ranges, total
+
+
+def database_name():
+    # the name of the database the request reads from, None if the worker processes can't open it (an in memory database)
+    connection = connections[read_alias()]
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        return None
+    return connection.settings_dict['NAME']
+
+
+def parallel_ranges(query):
+    # the date ranges to scan the query in, None if it is scanned in the request's thread
+    if workers() < 2 or query.source != 'clicks_info' or database_name() is None:
+        return None
+
+    # the groups of top and streamed requests are ordered by window functions over the whole range
+    if query.groups_by_first_row():
+        return None
+
+    ranges, rows = split_dates(query.date_bound(query.rules['date_from']), query.date_bound(query.rules['date_to']), workers())
+    if rows < getattr(settings, 'CLICKS_INFO_PARALLEL_ROWS', 200000) or len(ranges) < 2:
+        return None
+    return ranges
+
+
+class RangeQuery(RulesQuery):
+    '''
+    the rows of one date range of a parallel scan
+
+    the order columns are always selected, since the runs are merged on them (execute_rules drops them again)
+    '''
+
+    def fetch_columns(self):
+        fetch = super().fetch_columns()
+        for field, descending in self.order_fields():
+            if field not in fetch:
+                fetch.append(field)
+        return fetch
+
+
+def partial_aggregates(rules):
+    # the aggregates every range computes, which add up to the requested aggregates and derived metrics
+    partial = []
+    for function, column in rules['agg']:
+        if function == 'avg':
+            items = [('sum', column), ('count', None)]
+        else:
+            items = [(function, column)]
+        for item in items:
+            if item not in partial:
+                partial.append(item)
+
+    for metric in ClicksInfo.derived_metrics:
+        if metric in rules['columns']:
+            for column in ClicksInfo.derived_metrics[metric]:
+                if ('sum', column) not in partial:
+                    partial.append(('sum', column))
+
+    return partial
+
+
+def worker_rules(query):
+    # the rules the workers run, the agg rules of a range are its partial aggregates, without the derived metrics, sorting and paging
+    rules = dict(query.rules)
+    if isinstance(query, AggregateQuery):
+        rules['agg'] = partial_aggregates(query.rules)
+        rules['columns'] = [c for c in query.rules['columns'] if c not in ClicksInfo.derived_metrics]
+        rules['limit'] = None
+        rules['cursor'] = None
+    return rules
+
+
+def scan_range(aggregate, rules, model_columns, date_from, date_to, replica):
+    # runs in a worker process, returns the name of the database it read, its data version and the rows (or partial aggregates) of the range
+    rules = dict(rules, date_from=date_from, date_to=date_to)
+    query = AggregateQuery(rules, model_columns) if aggregate else RangeQuery(rules, model_columns)
+
+    if replica:
+        with replica_reads():
+            return read_range(query)
+    return read_range(query)
+
+
+def read_range(query):
+    with transaction.atomic(using=read_alias()):
+        return database_name(), data_version()[0], list(query.queryset())
+
+
+def compare_rows(order_fields, a, b):
+    # -1, 0 or 1 as row a comes before, with or after row b in the order of order_fields
+    for field, descending in order_fields:
+        x = a[field]
+        y = b[field]
+        if x != y:
+            order = -1 if x < y else 1
+            return -order if descending else order
+    return 0
+
+
+def cursor_row(order_fields, values, like):
+    # the cursor values of a page as a row, with the types of the values of row like
+    row = {}
+    for (field, descending), value in zip(order_fields, values):
+        if isinstance(like[field], Decimal):
+            value = Decimal(str(value))
+        elif isinstance(like[field], date):
+            year, month, day = value.split('-')
+            value = date(int(year), int(month), int(day))
+        row[field] = value
+    return row
+
+
+def merge_runs(query, runs):
+    # k-way merge of the sorted runs of the ranges, cut to the rows one query would have returned
+    order_key = functools.cmp_to_key(functools.partial(compare_rows, query.order_fields()))
+    rows = heapq.merge(*runs, key=order_key)
+    if query.rules['limit'] is not None:
+        rows = itertools.islice(rows, query.rules['limit'] + 1)
+    return list(rows)
+
+
+def combine_partial(function, total, value):
+    # two partial aggregates of a group combined, the sum, minimum and maximum of a range without rows are None
+    if total is None:
+        return value
+    if value is None:
+        return total
+    if function in ['sum', 'count']:
+        return total + value
+    if function == 'min':
+        return min(total, value)
+    return max(total, value)
+
+
+def combine_aggregates(query, runs):
+    # the groups of the partial aggregates of the ranges, sorted and paged the way AggregateQuery does it in the database
+    rules = query.rules
+    partial = partial_aggregates(rules)
+
+    groups = {}
+    for rows in runs:
+        for row in rows:
+            key = tuple(row[c] for c in rules['group'])
+            totals = groups.get(key)
+            if totals is None:
+                groups[key] = dict(row)
+                continue
+            for function, column in partial:
+                name = query.aggregate_name(function, column)
+                totals[name] = combine_partial(function, totals[name], row[name])
+
+    combined = []
+    for totals in groups.values():
+        row = {c: totals[c] for c in rules['group']}
+        for function, column in rules['agg']:
+            name = query.aggregate_name(function, column)
+            if function == 'avg':
+                row[name] = None if totals['count'] == 0 else float(totals[query.aggregate_name('sum', column)]) / totals['count']
+            else:
+                row[name] = totals[name]
+        for metric in query.metric_columns():
+            numerator, denominator = ClicksInfo.derived_metrics[metric]
+            if totals['sum_' + numerator] is None:
+                row['group_' + metric] = None
+            else:
+                row['group_' + metric] = ClicksInfo.ratio(totals['sum_' + numerator], totals['sum_' + denominator])
+        combined.append(row)
+
+    order_fields = query.order_fields()
+    combined.sort(key=functools.cmp_to_key(functools.partial(compare_rows, order_fields)))
+
+    if rules['cursor'] is not None and len(combined) > 0:
+        after = cursor_row(order_fields, rules['cursor'], combined[0])
+        combined = [row for row in combined if compare_rows(order_fields, row, after) > 0]
+
+    if rules['limit'] is not None:
+        combined = combined[:rules['limit'] + 1]
+    return combined
+
+
+def query_rows(query):
+    # the rows of a compiled query, scanned by the worker processes when it is large enough, otherwise in this thread
+    ranges = parallel_ranges(query)
+    if ranges is None:
+        return list(query.queryset())
+
+    name = database_name()
+    version = data_version()[0]
+    aggregate = isinstance(query, AggregateQuery)
+    rules = worker_rules(query)
+    replica = read_alias() != DEFAULT_DB_ALIAS
+
+    try:
+        futures = [
+                   executor().submit(scan_range, aggregate, rules, query.model_columns, start.timetuple()[:3], end.timetuple()[:3], replica)
+                   for start, end in ranges
+                   ]
+        results = [future.result() for future in futures]
+    except BrokenProcessPool:
+        reset_executor()
+        return list(query.queryset())
+
+    if any(range_name != name or range_version != version for range_name, range_version, rows in results):
+        # a worker read another database, or the data changed while the ranges were read
+        return list(query.queryset())
+
+    runs = [rows for range_name, range_version, rows in results]
+    if aggregate:
+        return combine_aggregates(query, runs)
+    return merge_runs(query, runs)
@@ -0,0 +1,146 @@
+from datetime import date
+
+from django.db.models import F, Value, Count, Min, Max, DateField
+from django.db.models.functions import Least, Greatest
+from django.utils import timezone
+
+from .models import ClicksInfo, ClicksInfoPartition
+
+
+'''
+monthly partitions of the clicks info rows
+
+the catalog (ClicksInfoPartition) holds one entry per month with rows, with its row count, first and last date, and a version
+which is bumped every time the rows of the month change
+LoadDB counts the rows it adds into the entries of their months, inside the chunk's transaction, and refuses rows for read only months
+
+the catalog is what lets the numpy engine keep every month as its own partition: a request only scans the partitions
+its date_from and date_to overlap, and a data change only reloads the partitions whose version changed
+on the database, the date index already confines every date range to the rows of its months
+
+old months are frozen with the compact_partitions command: they become read only, so their partitions never change again
+on sqlite this is enforced by triggers on the clicks info table (see create_read_only_triggers), so no insert, update
+or delete of a row of a read only month gets through, whether it comes from a model, a queryset or raw sql
+the model signals (see handler/signals.py) reject saves and deletes earlier, with a ValueError instead of an IntegrityError
+
+sqlite has no storage of its own per month, so compacting is a VACUUM and ANALYZE of the whole database file
+'''
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+
+def refresh_partitions(dates):
+    # recounts the catalog entries of the months holding dates, and bumps their versions
+    for month in sorted({month_start(day) for day in dates}):
+        stats = ClicksInfo.objects.filter(date__gte=month, date__lt=next_month(month)).aggregate(
+                                                                                                  rows=Count('id'),
+                                                                                                  first_date=Min('date'),
+                                                                                                  last_date=Max('date'),
+                                                                                                  )
+
+        if stats['rows'] == 0:
+            ClicksInfoPartition.objects.filter(month=month).delete()
+            continue
+
+        updated = ClicksInfoPartition.objects.filter(month=month).update(version=F('version') + 1, **stats)
+        if updated == 0:
+            ClicksInfoPartition.objects.create(month=month, **stats)
+
+
+def add_to_partitions(added, dates):
+    '''
+    counts the clicks info rows added into the catalog entries of their months, and bumps the versions of the months holding dates
+
+    LoadDB only adds rows or changes the values of loaded ones (a row's date is part of what identifies it),
+    so the entries are brought up to date from the added rows alone, without recounting the months
+    '''
+    stats = {}
+    for row in added:
+        month = stats.setdefault(month_start(row.date), {'rows': 0, 'first_date': row.date, 'last_date': row.date})
+        month['rows'] += 1
+        month['first_date'] = min(month['first_date'], row.date)
+        month['last_date'] = max(month['last_date'], row.date)
+
+    for month in sorted({month_start(day) for day in dates} | set(stats)):
+        entry = ClicksInfoPartition.objects.filter(month=month)
+        if month not in stats:
+            entry.update(version=F('version') + 1)
+            continue
+
+        added_stats = stats[month]
+        updated = entry.update(
+                               version=F('version') + 1,
+                               rows=F('rows') + added_stats['rows'],
+                               first_date=Least('first_date', Value(added_stats['first_date'], output_field=DateField())),
+                               last_date=Greatest('last_date', Value(added_stats['last_date'], output_field=DateField())),
+                               )
+        if updated == 0:
+            ClicksInfoPartition.objects.create(month=month, **added_stats)
+
+
+def read_only_triggers():
+    # the sql of the triggers aborting every change of a clicks info row of a read only month, for its old and its new date
+    read_only = "EXISTS (SELECT 1 FROM {partitions} WHERE read_only AND month = date({{row}}.date, 'start of month'))".format(partitions=ClicksInfoPartition._meta.db_table)
+    triggers = {
+                'insert': read_only.format(row='NEW'),
+                'update': read_only.format(row='OLD') + ' OR ' + read_only.format(row='NEW'),
+                'delete': read_only.format(row='OLD'),
+                }
+
+    return [
+            "CREATE TRIGGER IF NOT EXISTS {table}_read_only_{event} BEFORE {event} ON {table} WHEN {condition} "
+            "BEGIN SELECT RAISE(ABORT, 'Rows of read only months can not be changed'); END".format(table=ClicksInfo._meta.db_table, event=event, condition=condition)
+            for event, condition in triggers.items()
+            ]
+
+
+def create_read_only_triggers(connection):
+    '''
+    creates the read only triggers on an sqlite database, if they are not there yet
+
+    called after every migrate (see handler/signals.py), since a migration which alters the clicks info table rebuilds it without them
+    '''
+    if connection.vendor != 'sqlite':
+        return
+
+    tables = connection.introspection.table_names()
+    if ClicksInfo._meta.db_table not in tables or ClicksInfoPartition._meta.db_table not in tables:
+        # migrated back to before the catalog
+        return
+
+    with connection.cursor() as cursor:
+        for sql in read_only_triggers():
+            cursor.execute(sql)
+
+
+def read_only_months(dates):
+    # the months holding dates which are read only
+    months = {month_start(day) for day in dates}
+    return set(ClicksInfoPartition.objects.filter(month__in=months, read_only=True).values_list('month', flat=True))
+
+
+def catalog():
+    # (month, version) of every partition, in month order
+    return list(ClicksInfoPartition.objects.order_by('month').values_list('month', 'version'))
+
+
+def freeze_partitions(before):
+    # makes every month before the month of before read only, returns the months frozen
+    months = list(ClicksInfoPartition.objects.filter(month__lt=month_start(before), read_only=False).values_list('month', flat=True))
+    ClicksInfoPartition.objects.filter(month__in=months).update(read_only=True, compacted=timezone.now())
+    return months
+
+
+def thaw_partitions():
+    # makes every read only month writable again, returns the months thawed
+    months = list(ClicksInfoPartition.objects.filter(read_only=True).order_by('month').values_list('month', flat=True))
+    ClicksInfoPartition.objects.filter(month__in=months).update(read_only=False)
+    return months
@@ -0,0 +1,56 @@
+from collections.abc import Mapping
+from datetime import date
+
+from .caching import canonical_rules
+from .pagination import query_shape
+
+
+def freeze(value):
+    # immutable copy of a validated rule value, lists become tuples
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class QueryPlan(Mapping):
+    '''
+    the compiled, immutable form of an api_flags string
+
+    it reads like the validated rules dictionary (plan['group'], plan['limit'] and so on), so every layer which takes rules
+    takes a plan, but none of them can change it, which is what makes it safe to share between requests:
+
+    columns -> frozenset, since only membership matters (the output order comes from the model columns)
+    group, sorted, include_only, agg, cursor -> tuples, their order matters
+    date_from, date_to -> (year, month, day) tuples, and date_from_date / date_to_date as dates
+
+    key is the canonical json of the rules (see canonical_rules), the same for every flag string producing the same result,
+    so it can be used as a cache key by any layer, and shape is the query_shape the cursors of the plan carry
+    '''
+
+    def __init__(self, rules):
+        self._rules = {name: freeze(value) for name, value in rules.items()}
+        self._rules['columns'] = frozenset(rules['columns'])
+
+        self.date_from_date = date(*rules['date_from'])
+        self.date_to_date = date(*rules['date_to'])
+
+        self.key = canonical_rules(self)
+        self.shape = query_shape(self)
+
+    def __getitem__(self, name):
+        return self._rules[name]
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, QueryPlan) and self.key == other.key
+
+    def __repr__(self):
+        return 'QueryPlan({})'.format(self.key)
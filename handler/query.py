@@ -0,0 +1,185 @@
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q, F, Window, FloatField
+from django.db.models.functions import FirstValue
+
+from .models import ClicksInfo
+from .pagination import keyset_predicate
+
+
+class RulesQuery:
+    '''
+    compiles a validated rules dictionary into a single ClicksInfo queryset
+
+    the following rules are executed by the database instead of in python:
+
+    1. date_from and date_to <- WHERE date BETWEEN date_from AND date_to
+    2. sorted <- ORDER BY sorted column, with id as a tiebreaker to keep the order of equal rows stable
+    3. columns <- only the requested columns are selected
+    4. include_only <- every token becomes an OR of equality predicates over the requested columns
+    5. limit and cursor <- a keyset predicate on the order columns, and LIMIT
+
+    include_only compares tokens with the values as the api formats them, so a token is only compared with a typed column
+    if formatting the column value could produce exactly that token (e.g. 494 matches clicks 494, but 0494 matches nothing)
+    money is returned, compared and grouped as the text the source wrote (spend_text and revenue_text), and only sorted by its value
+
+    the derived metrics (cpi, roas and ctr) are stored with every row, so they are selected, sorted and compared like any other column
+
+    top and streamed requests with group are ordered by the first row of their group, so the database returns the groups in the
+    order they first appear, the same order grouped_rows puts the rows of any other request in (paged requests can't use group)
+    '''
+
+    # columns calculated from the other columns, stored with every row, but calculated per group by agg requests
+    derived_columns = list(ClicksInfo.derived_metrics)
+
+    # the table the query reads, sent back in the X-Clicks-Info-Source header
+    source = 'clicks_info'
+
+    def __init__(self, rules, model_columns):
+        self.rules = rules
+        self.model_columns = model_columns
+
+    def date_bound(self, date_tuple):
+        return date(*date_tuple)
+
+    def fetch_columns(self):
+        # columns to select, in output column order so the output keys keep their usual order
+        # money is selected as its text, the value the api returns
+        fetch = [ClicksInfo.api_field(c) for c in self.output_columns()]
+
+        if self.rules['limit'] is not None:
+            # the order columns of the last row of a page become the next cursor
+            for field, descending in self.order_fields():
+                if field not in fetch:
+                    fetch.append(field)
+
+        return fetch
+
+    def groups_by_first_row(self):
+        # top and streamed requests can't hold all rows to group them by first appearance, so the database orders them by group
+        return len(self.rules['group']) > 0 and (self.rules['limit'] is not None or self.rules['format'] != 'json')
+
+    def output_columns(self):
+        # the columns of the returned rows, in order, starting with id when every one of ClicksInfo.id_columns is requested
+        columns = [c for c in self.model_columns if c in self.rules['columns']]
+        if all(c in columns for c in ClicksInfo.id_columns):
+            columns = ['id'] + columns
+        return columns
+
+    def order_fields(self):
+        # list of (field, descending) pairs the rows are ordered by, ending with id so the order is total
+        sort_column, direction = self.rules['sorted']
+        descending = direction == 'descending'
+
+        order_fields = []
+        if self.groups_by_first_row():
+            # the sort value and id of the first row of the group, the same for every row of a group and different for every group
+            order_fields = [('group_first_value', descending), ('group_first_id', False)]
+
+        return order_fields + [(sort_column, descending), ('id', False)]
+
+    def first_row_annotations(self):
+        # the group_first_value and group_first_id order fields, window functions over the rows of every group in sorted order
+        sort_column, direction = self.rules['sorted']
+        sort_order = F(sort_column).desc() if direction == 'descending' else F(sort_column).asc()
+
+        def first_value(field, output_field):
+            return Window(FirstValue(field, output_field=output_field), partition_by=[F(ClicksInfo.api_field(c)) for c in self.rules['group']], order_by=[sort_order, F('id').asc()])
+
+        # money is compared as a float, django casts a decimal window function in a way sqlite can't parse
+        sort_field = ClicksInfo._meta.get_field(sort_column)
+        if sort_field.get_internal_type() == 'DecimalField':
+            sort_field = FloatField()
+
+        return {
+                'group_first_value': first_value(sort_column, sort_field),
+                'group_first_id': first_value('id', ClicksInfo._meta.pk),
+                }
+
+    def order_field(self, name):
+        # the model field the values of an order field are compared with, which turns cursor values back into them
+        return ClicksInfo._meta.get_field(name)
+
+    def token_value(self, token, column):
+        # the value a column must hold to be formatted as the token, or None if no value of the column formats as the token
+        if column in ClicksInfo.text_columns:
+            # money is returned as the text the source wrote, which can be any number
+            try:
+                Decimal(token)
+            except InvalidOperation:
+                return None
+            return token
+
+        field = ClicksInfo._meta.get_field(column)
+        internal_type = field.get_internal_type()
+
+        try:
+            if internal_type == 'DateField':
+                year, month, day = token.split('-')
+                value = date(int(year), int(month), int(day))
+            elif internal_type == 'IntegerField':
+                value = int(token)
+            elif internal_type == 'FloatField':
+                value = float(token)
+            else:
+                return token
+        except ValueError:
+            return None
+
+        if ClicksInfo.api_format(value) != token:
+            return None
+        return value
+
+    def token_predicate(self, token, columns):
+        # a row matches a token if any of its requested columns is equal to the token
+        predicate = Q(pk__in=[])
+        for c in columns:
+            value = self.token_value(token, c)
+            if value is not None:
+                predicate |= Q(**{ClicksInfo.api_field(c): value})
+        return predicate
+
+    def token_columns(self):
+        # the columns include_only tokens are compared with, every requested column
+        return list(self.rules['columns'])
+
+    def filtered_queryset(self):
+        # the rows matching date_from, date_to and include_only, before any sorting or projection
+        rules = self.rules
+
+        queryset = ClicksInfo.objects.filter(
+                                             date__gte=self.date_bound(rules['date_from']),
+                                             date__lte=self.date_bound(rules['date_to']),
+                                             )
+
+        # include_only
+        token_columns = self.token_columns()
+        for token in rules['include_only']:
+            queryset = queryset.filter(self.token_predicate(token, token_columns))
+
+        return queryset
+
+    def queryset(self):
+        rules = self.rules
+
+        queryset = self.filtered_queryset()
+
+        # sorted (and group for top and streamed requests)
+        if self.groups_by_first_row():
+            queryset = queryset.annotate(**self.first_row_annotations())
+        order_fields = self.order_fields()
+        queryset = queryset.order_by(*[('-' if descending else '') + field for field, descending in order_fields])
+
+        # limit and cursor
+        if rules['cursor'] is not None:
+            queryset = queryset.filter(keyset_predicate(order_fields, rules['cursor']))
+
+        # columns
+        queryset = queryset.values(*self.fetch_columns())
+
+        if rules['limit'] is not None:
+            # one row more than the limit tells if there is a next page
+            queryset = queryset[:rules['limit'] + 1]
+
+        return queryset
@@ -0,0 +1,179 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import msgpack
+except ImportError:
+    # msgpack is only needed for the application/msgpack responses
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    # pyarrow is only needed for the arrow responses
+    pyarrow = None
+
+from .models import ClicksInfo
+from .aggregation import AggregateQuery
+
+
+'''
+compact response formats, chosen with the Accept header
+
+the default json response is a list of rows, each a dict of column name -> value formatted as a string
+the formats here send the same rows column by column instead (column name -> list of values),
+with the numbers as real numbers, so the names are sent once and clients read whole columns without parsing strings:
+
+application/vnd.clicks-info.columns+json <- {"date": ["2017-06-15", ...], "clicks": [211, ...], ...}
+application/msgpack <- the same columns as MessagePack
+application/vnd.apache.arrow.stream <- an Arrow IPC stream of one record batch, dates as date32 and strings dictionary encoded
+                                       (pandas: pyarrow.ipc.open_stream(body).read_pandas())
+
+paged responses keep their {"next": ..., "results": ...} shape, with the columns under results,
+arrow has no room for next, so it is sent in the schema metadata instead
+dates stay yyyy-mm-dd strings in json and msgpack, which have no date type
+'''
+
+# the python type of every model column's values
+column_types = {}
+for field in ClicksInfo._meta.get_fields():
+    internal_type = field.get_internal_type()
+    if internal_type == 'DateField':
+        column_types[field.name] = 'date'
+    elif internal_type in ['IntegerField', 'AutoField']:
+        column_types[field.name] = 'int'
+    elif internal_type in ['DecimalField', 'FloatField']:
+        column_types[field.name] = 'float'
+    else:
+        column_types[field.name] = 'str'
+
+
+def column_type(name):
+    # 'int', 'float', 'date' or 'str', for a model column or an aggregate output column such as sum_clicks or count
+    if name == 'count' or name.startswith('count_'):
+        return 'int'
+
+    function, _, column = name.partition('_')
+    if function in AggregateQuery.aggregate_functions and column in column_types:
+        if function == 'avg':
+            return 'float'
+        # sum, min and max keep the type of the column
+        return column_types[column]
+
+    return column_types.get(name, 'str')
+
+
+def typed_value(value, kind):
+    # the api formatted string back as the number it was formatted from
+    if value is None:
+        return None
+    if kind == 'int':
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    return value
+
+
+def typed_columns(rows, names=None):
+    # dict of column name -> list of typed values, names are the output columns (needed when there are no rows)
+    if names is None:
+        names = list(rows[0]) if len(rows) > 0 else []
+
+    columns = {}
+    for name in names:
+        kind = column_type(name)
+        columns[name] = [typed_value(row[name], kind) for row in rows]
+    return columns
+
+
+def columnar_data(data, names=None):
+    # the data of a response with its rows turned into columns, anything else (such as errors) is left as is
+    if isinstance(data, list):
+        return typed_columns(data, names)
+    if isinstance(data, dict) and 'results' in data and isinstance(data['results'], list):
+        columnar = dict(data)
+        columnar['results'] = typed_columns(data['results'], names)
+        return columnar
+    return data
+
+
+def output_columns(renderer_context):
+    # the output columns the view put in the renderer context, None outside of a clicks info request
+    view = (renderer_context or {}).get('view')
+    return getattr(view, 'output_columns', None)
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    media_type = 'application/vnd.clicks-info.columns+json'
+    format = 'columns'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(columnar_data(data, output_columns(renderer_context)), accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(columnar_data(data, output_columns(renderer_context)), use_bin_type=True)
+
+
+class ArrowRenderer(BaseRenderer):
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    # the arrow types of the numerical columns, dates and strings are converted on their own
+    arrow_types = {
+                   'int': 'int64',
+                   'float': 'float64',
+                   }
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        next_url = None
+        if isinstance(data, dict):
+            next_url = data['next']
+            data = data['results']
+
+        arrays = []
+        columns = typed_columns(data, output_columns(renderer_context))
+        for name, values in columns.items():
+            kind = column_type(name)
+            if kind == 'date':
+                # the yyyy-mm-dd strings are cast to dates by arrow
+                array = pyarrow.array(values, type=pyarrow.string()).cast(pyarrow.date32())
+            elif kind == 'str':
+                # channel, country and os have few distinct values, so they are sent as dictionary codes (categoricals in pandas)
+                array = pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+            else:
+                array = pyarrow.array(values, type=getattr(pyarrow, self.arrow_types[kind])())
+            arrays.append(array)
+
+        metadata = {}
+        if next_url is not None:
+            metadata['next'] = next_url
+        table = pyarrow.Table.from_arrays(arrays, names=list(columns), metadata=metadata)
+
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+def compact_renderers():
+    # the renderers of the compact formats, msgpack and arrow only when their packages are installed
+    renderers = [ColumnarJSONRenderer]
+    if msgpack is not None:
+        renderers.append(MessagePackRenderer)
+    if pyarrow is not None:
+        renderers.append(ArrowRenderer)
+    return renderers
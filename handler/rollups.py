@@ -0,0 +1,242 @@
+import calendar
+
+from django.db.models import Q, F, Sum, Count
+from django.db.models.functions import TruncMonth, Coalesce
+
+from .models import ClicksInfo, DailyChannelRollup, DailyCountryRollup, MonthlyChannelRollup
+from .aggregation import AggregateQuery
+from .partitions import month_start, next_month
+
+
+'''
+pre-aggregated rollup tables
+
+a rollup holds the totals (rows, impressions, clicks, installs, spend and revenue) of every period and dimension value,
+e.g. DailyCountryRollup holds one row per date and country
+LoadDB adds the rows of every chunk it inserts or updates to the rollup rows they fall in, inside the chunk's transaction,
+so the rollups always agree with ClicksInfo, and a load only touches the rollup rows of its rows, not whole periods
+
+an agg request is answered from a rollup when the rollup holds everything it needs (see rollup_for), otherwise from ClicksInfo
+the raw table already holds one row per date, channel, country and os, so there is no rollup at that grain
+'''
+
+# the rollups in the order they are tried, the fewest rows per period first
+ROLLUPS = [MonthlyChannelRollup, DailyChannelRollup, DailyCountryRollup]
+
+# the aggregates a rollup can answer, a sum of sums is a sum and a count is the sum of the rows column
+rollup_functions = ['sum', 'count']
+
+measures = ['impressions', 'clicks', 'installs', 'spend', 'revenue']
+
+# the date_from and date_to of a request without them
+earliest = (1000, 1, 1)
+latest = (3000, 12, 30)
+
+
+def rollup_columns(rollup):
+    # the clicks info columns a rollup can be grouped by and filtered on
+    if rollup.period_field == 'date':
+        return ['date'] + rollup.dimensions
+    return list(rollup.dimensions)
+
+
+def period_start(rollup, day):
+    if rollup.period_field == 'month':
+        return month_start(day)
+    return day
+
+
+def refresh_rollup(rollup, dates=None):
+    # recomputes the rows of the periods holding dates (every period if dates is None) from the clicks info rows
+    queryset = ClicksInfo.objects.all()
+    stale = rollup.objects.all()
+
+    if dates is not None:
+        periods = sorted({period_start(rollup, day) for day in dates})
+        if len(periods) == 0:
+            return
+
+        if rollup.period_field == 'month':
+            terms = [Q(date__gte=month, date__lt=next_month(month)) for month in periods]
+            predicate = terms[0]
+            for term in terms[1:]:
+                predicate |= term
+            queryset = queryset.filter(predicate)
+        else:
+            queryset = queryset.filter(date__in=periods)
+        stale = stale.filter(**{rollup.period_field + '__in': periods})
+
+    stale.delete()
+
+    if rollup.period_field == 'month':
+        queryset = queryset.annotate(period=TruncMonth('date'))
+    else:
+        queryset = queryset.annotate(period=F('date'))
+
+    # the totals are named total_* since the clicks info columns already use the plain names
+    totals = queryset.values('period', *rollup.dimensions).annotate(
+                                                                    total_rows=Count('id'),
+                                                                    **{'total_' + c: Sum(c) for c in measures}
+                                                                    )
+
+    rows = []
+    for total in totals:
+        values = {rollup.period_field: total['period'], 'rows': total['total_rows']}
+        for c in rollup.dimensions:
+            values[c] = total[c]
+        for c in measures:
+            values[c] = total['total_' + c]
+        rows.append(rollup(**values))
+
+    rollup.objects.bulk_create(rows)
+
+
+def refresh_rollups(dates=None):
+    # brings every rollup up to date with the clicks info rows of dates (or of every date)
+    for rollup in ROLLUPS:
+        refresh_rollup(rollup, dates)
+
+
+def rollup_key(rollup, row):
+    # the (period, dimension values...) of the rollup row a clicks info row is summed into
+    return (period_start(rollup, row.date),) + tuple(getattr(row, c) for c in rollup.dimensions)
+
+
+def add_to_rollup(rollup, added, removed):
+    '''
+    applies clicks info rows added and removed to the rollup rows they are summed into, without reading ClicksInfo
+
+    the totals of every rollup row the rows fall in are changed by the rows' values (the rows column by their count),
+    rollup rows which are left with no rows are deleted, and new ones are created
+    '''
+    deltas = {}
+    for sign, rows in [(1, added), (-1, removed)]:
+        for row in rows:
+            delta = deltas.setdefault(rollup_key(rollup, row), dict.fromkeys(['rows'] + measures, 0))
+            delta['rows'] += sign
+            for c in measures:
+                delta[c] += sign * getattr(row, c)
+
+    if len(deltas) == 0:
+        return
+
+    # the rollup rows of the changed periods, keyed like the deltas
+    periods = {key[0] for key in deltas}
+    existing = {}
+    for rollup_row in rollup.objects.filter(**{rollup.period_field + '__in': periods}):
+        existing[(getattr(rollup_row, rollup.period_field),) + tuple(getattr(rollup_row, c) for c in rollup.dimensions)] = rollup_row
+
+    created = []
+    changed = []
+    emptied = []
+    for key, delta in deltas.items():
+        rollup_row = existing.get(key)
+        if rollup_row is None:
+            values = dict(zip([rollup.period_field] + rollup.dimensions, key))
+            rollup_row = rollup(**values, **dict.fromkeys(['rows'] + measures, 0))
+
+        for c in delta:
+            setattr(rollup_row, c, getattr(rollup_row, c) + delta[c])
+
+        if rollup_row.rows == 0:
+            if rollup_row.pk is not None:
+                emptied.append(rollup_row.pk)
+        elif rollup_row.pk is None:
+            created.append(rollup_row)
+        else:
+            changed.append(rollup_row)
+
+    rollup.objects.filter(pk__in=emptied).delete()
+    rollup.objects.bulk_update(changed, ['rows'] + measures, batch_size=500)
+    rollup.objects.bulk_create(created)
+
+
+def add_to_rollups(added, removed=[]):
+    # applies the clicks info rows added and removed (e.g. the old values of updated rows) to every rollup
+    for rollup in ROLLUPS:
+        add_to_rollup(rollup, added, removed)
+
+
+def covers(rollup, rules, query):
+    # True if the agg request can be answered from the rollup alone
+    columns = rollup_columns(rollup)
+
+    if any(c not in columns for c in rules['group']):
+        return False
+
+    if any(function not in rollup_functions for function, column in rules['agg']):
+        return False
+
+    if rollup.period_field == 'month':
+        # only whole months
+        if rules['date_from'] != earliest and rules['date_from'][2] != 1:
+            return False
+        if rules['date_to'] != latest:
+            year, month, day = rules['date_to']
+            if day != calendar.monthrange(year, month)[1]:
+                return False
+
+    # include_only tokens may only be able to match the columns the rollup keeps
+    token_columns = query.token_columns()
+    for token in rules['include_only']:
+        for c in token_columns:
+            if c not in columns and query.token_value(token, c) is not None:
+                return False
+
+    return True
+
+
+def rollup_for(rules, model_columns):
+    # the first rollup which covers an agg request, or None if it has to be answered from ClicksInfo
+    if len(rules['agg']) == 0:
+        return None
+
+    query = AggregateQuery(rules, model_columns)
+    for rollup in ROLLUPS:
+        if covers(rollup, rules, query):
+            return rollup
+    return None
+
+
+class RollupQuery(AggregateQuery):
+    '''
+    an AggregateQuery answered from a rollup instead of ClicksInfo
+
+    the rollup columns have the same names as the clicks info columns, so grouping, the derived metrics, ordering and the cursor work unchanged,
+    only the row filter and the aggregates differ
+    '''
+
+    def __init__(self, rules, model_columns, rollup):
+        super().__init__(rules, model_columns)
+        self.rollup = rollup
+        self.source = rollup.source
+
+    def aggregates(self):
+        # dict of output name -> aggregate expression, in the order they were requested
+        aggregates = {}
+        for function, column in self.rules['agg']:
+            if function == 'count':
+                # the sum of no rows is null, but their count is 0, the same as Count returns
+                expression = Coalesce(Sum('rows'), 0)
+            else:
+                expression = Sum(column)
+            aggregates[self.aggregate_name(function, column)] = expression
+
+        return aggregates
+
+    def filtered_queryset(self):
+        rules = self.rules
+        period = self.rollup.period_field
+
+        queryset = self.rollup.objects.filter(**{
+                                                 period + '__gte': self.date_bound(rules['date_from']),
+                                                 period + '__lte': self.date_bound(rules['date_to']),
+                                                 })
+
+        # include_only, covers made sure no token can match a column outside of the rollup
+        columns = rollup_columns(self.rollup)
+        stored_columns = [c for c in rules['columns'] if c in columns]
+        for token in rules['include_only']:
+            queryset = queryset.filter(self.token_predicate(token, stored_columns))
+
+        return queryset
@@ -0,0 +1,79 @@
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, post_migrate
+from django.dispatch import receiver, Signal
+from django.utils import timezone
+
+from .models import ClicksInfo, DataVersion
+from .rollups import refresh_rollups
+from .partitions import refresh_partitions, read_only_months, create_read_only_triggers
+
+# sent once a change of the clicks info rows is committed, with the new version and the dates whose rows changed
+# (None when they are not known), caches and anything else built from the rows can listen to it to refresh
+data_changed = Signal(providing_args=['version', 'dates'])
+
+# the DataVersion row holding the counter
+VERSION_ID = 1
+
+
+def data_version():
+    # returns the current (version, updated) pair, version 0 if the rows never changed since the counter was added
+    row = DataVersion.objects.filter(pk=VERSION_ID).values_list('version', 'updated').first()
+    if row is None:
+        return 0, None
+    return row
+
+
+def bump_data_version(dates=None):
+    # increment the version, and tell everyone listening to data_changed once the transaction commits
+    now = timezone.now()
+    updated = DataVersion.objects.filter(pk=VERSION_ID).update(version=F('version') + 1, updated=now)
+    if updated == 0:
+        DataVersion.objects.get_or_create(pk=VERSION_ID, defaults={'version': 1, 'updated': now})
+    
+    version = data_version()[0]
+    transaction.on_commit(lambda: data_changed.send(sender=DataVersion, version=version, dates=dates))
+    return version
+
+
+@receiver(pre_save, sender=ClicksInfo)
+def remember_date(sender, instance, **kwargs):
+    # a saved row may move to another date, whose rollups need refreshing as well
+    instance._saved_date = ClicksInfo.objects.filter(pk=instance.pk).values_list('date', flat=True).first() if instance.pk else None
+    
+    dates = [day for day in [instance.date, instance._saved_date] if day is not None]
+    if len(read_only_months(dates)) > 0:
+        raise ValueError('Rows of read only months can not be changed')
+
+
+@receiver(pre_save, sender=ClicksInfo)
+def calculate_metrics(sender, instance, **kwargs):
+    # the derived metrics and the money text always agree with the values being saved
+    instance.calculate_metrics()
+    instance.calculate_text()
+
+
+@receiver(pre_delete, sender=ClicksInfo)
+def protect_read_only(sender, instance, **kwargs):
+    if len(read_only_months([instance.date])) > 0:
+        raise ValueError('Rows of read only months can not be deleted')
+
+
+@receiver(post_save, sender=ClicksInfo)
+@receiver(post_delete, sender=ClicksInfo)
+def clicks_info_changed(sender, instance, **kwargs):
+    # single row saves and deletes go through the model signals
+    # bulk loads do not send them, so LoadDB refreshes the rollups and bumps the version itself
+    dates = {instance.date}
+    if getattr(instance, '_saved_date', None) is not None:
+        dates.add(instance._saved_date)
+    refresh_rollups(dates)
+    refresh_partitions(dates)
+    bump_data_version(dates)
+
+
+@receiver(post_migrate)
+def protect_read_only_months(sender, using, **kwargs):
+    # the database refuses every change of the rows of read only months, see create_read_only_triggers
+    if sender.name == 'handler':
+        create_read_only_triggers(connections[using])
@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed for the numpy engine
+    np = None
+
+
+'''
+memory mapped snapshots of the columnar table
+
+a snapshot is a directory of .npy files, one fixed width binary array per column (categorical columns as int32 codes),
+plus the dictionary of every categorical column, the partition offsets and the inverted index, written by the
+export_snapshot command
+
+workers open the arrays with mmap_mode='r', so the snapshot is read straight from the page cache, shared by every worker
+on the machine: opening it takes milliseconds and no memory of its own, and the numpy engine reads the mapped buffers
+(slices are views into the mapping, only the selected rows of a request are ever copied)
+
+every export goes to its own directory, snapshot-<data version>, and the CURRENT file (replaced atomically) names the latest one,
+so workers never see a half written snapshot, and workers still mapping an older one keep reading it until they reload
+a snapshot is only used while its data version is the current one, after that the table is loaded from the database again,
+until the process which changed the data exports the next one (see refresh_snapshot in handler/columnar.py)
+'''
+
+CURRENT = 'CURRENT'
+
+
+def write_array(directory, name, array):
+    np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(array), allow_pickle=False)
+
+
+def read_array(directory, name):
+    return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r', allow_pickle=False)
+
+
+def write_snapshot(table, path):
+    # writes the table (and its inverted index) as a new snapshot under path, and makes it the current one
+    os.makedirs(path, exist_ok=True)
+
+    name = 'snapshot-{}'.format(table.version)
+    directory = os.path.join(path, name)
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    write_array(temporary, 'id', table.ids)
+    for c, array in table.columns.items():
+        write_array(temporary, c, array)
+    for c, dictionary in table.dictionaries.items():
+        write_array(temporary, 'dictionary_' + c, dictionary)
+
+    write_array(temporary, 'months', table.months)
+    write_array(temporary, 'month_ends', table.month_ends)
+    write_array(temporary, 'offsets', table.offsets)
+
+    index = table.inverted_index()
+    for c in index.indexed_columns:
+        write_array(temporary, 'index_keys_' + c, index.sorted_keys[c])
+        write_array(temporary, 'index_positions_' + c, index.positions[c])
+
+    meta = {
+            'version': table.version,
+            'rows': len(table),
+            'columns': list(table.columns),
+            'dictionaries': list(table.dictionaries),
+            'indexed_columns': list(index.indexed_columns),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+    with open(os.path.join(temporary, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(temporary, directory)
+
+    # point CURRENT at the new snapshot, atomically
+    with open(os.path.join(path, CURRENT + '.tmp'), 'w') as current_file:
+        current_file.write(name)
+    os.replace(os.path.join(path, CURRENT + '.tmp'), os.path.join(path, CURRENT))
+
+    # older snapshots are no longer current, workers which still map them keep their files open until they reload
+    for entry in os.listdir(path):
+        if entry.startswith('snapshot-') and entry != name:
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+
+    return directory
+
+
+def has_snapshot(path):
+    # True if a snapshot was ever exported under path
+    return os.path.exists(os.path.join(path, CURRENT))
+
+
+def read_snapshot(path, version):
+    # the mapped arrays of the current snapshot under path, or None if there is no snapshot of this data version
+    try:
+        with open(os.path.join(path, CURRENT)) as current_file:
+            directory = os.path.join(path, current_file.read().strip())
+        with open(os.path.join(directory, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+    if meta['version'] != version:
+        return None
+
+    try:
+        arrays = {
+                  'id': read_array(directory, 'id'),
+                  'columns': {c: read_array(directory, c) for c in meta['columns']},
+                  'dictionaries': {c: read_array(directory, 'dictionary_' + c) for c in meta['dictionaries']},
+                  'months': read_array(directory, 'months'),
+                  'month_ends': read_array(directory, 'month_ends'),
+                  'offsets': read_array(directory, 'offsets'),
+                  'index_keys': {c: read_array(directory, 'index_keys_' + c) for c in meta['indexed_columns']},
+                  'index_positions': {c: read_array(directory, 'index_positions_' + c) for c in meta['indexed_columns']},
+                  }
+    except (OSError, ValueError):
+        # the snapshot was replaced while it was being opened, the database is read instead
+        return None
+
+    return arrays
@@ -1,3 +1,1262 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest.mock
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from . import columnar, database, renderers
+from .load_db import LoadDB
+from .partitions import freeze_partitions, refresh_partitions
+from .rollups import ROLLUPS, measures, refresh_rollups
+from .metrics import Histogram
+from .models import ClicksInfo, ClicksInfoPartition, LoadWatermark
+from .caching import ResultCache, SingleFlight, single_flight
+from .pagination import encode_cursor, decode_cursor
+from .database import REPLICA, ReadReplicaRouter, replica_reads
+from .views import ViewClicksInfo
+from .aggregation import AggregateQuery
+from .asgi import ClicksInfoASGI
+from .parallel import RangeQuery, combine_aggregates, merge_runs, query_rows, split_dates
+from .signals import data_version
+from .snapshot import read_snapshot
 
 # Create your tests here.
+
+
+@override_settings(CLICKS_INFO_SNAPSHOT=None)
+class ClicksInfoTestCase(TestCase):
+    # a few days of rows in two months, as the source has them
+    source_rows = [
+                   ['2017-05-17', 'adcolony', 'US', 'android', '19887', '494', '76', '148.2', '149.04'],
+                   ['2017-05-17', 'adcolony', 'US', 'ios', '13886', '336', '60', '100.8', '210.24'],
+                   ['2017-05-17', 'apple_search_ads', 'DE', 'ios', '3180', '118', '25', '50.0', '20.0'],
+                   ['2017-05-18', 'facebook', 'DE', 'ios', '3369', '69', '15', '43643', '0.0'],
+                   ['2017-05-18', 'facebook', 'GB', 'android', '3450', '51', '4', '12.5', '0.0'],
+                   ['2017-05-31', 'adcolony', 'GB', 'android', '2000', '40', '0', '10.0', '5.5'],
+                   ['2017-06-01', 'adcolony', 'US', 'android', '21000', '500', '80', '150.25', '160.0'],
+                   ['2017-06-01', 'facebook', 'US', 'ios', '9000', '211', '30', '75.0', '90.75'],
+                   ['2017-06-02', 'apple_search_ads', 'US', 'ios', '4000', '130', '20', '40.0', '35.0'],
+                   ['2017-06-03', 'facebook', 'DE', 'android', '3000', '60', '10', '25.0', '12.0'],
+                   ]
+
+    def setUp(self):
+        # results are cached by data version, which starts over in every test, and so does the numpy engine's table
+        caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+        single_flight.clear()
+        columnar._table = None
+        self.load(self.source_rows)
+
+    def load(self, rows, source='test.csv'):
+        # loads rows with LoadDB, without its progress output
+        with contextlib.redirect_stdout(io.StringIO()):
+            return LoadDB(source).insert_chunks([rows])
+
+    def get(self, api_flags, status=200, **headers):
+        response = self.client.get('/clicks_info/' + api_flags, **headers)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def rows(self, api_flags):
+        return json.loads(self.get(api_flags).content.decode('utf-8'))
+
+    def plan(self, api_flags):
+        rules, errors = ViewClicksInfo.compile_plan(api_flags)
+        self.assertIsNone(errors)
+        return rules
+
+    def counted_run_rules(self):
+        # patches run_rules to count the executed requests
+        calls = []
+        run_rules = ViewClicksInfo.run_rules
+
+        def counted(view, rules):
+            calls.append(rules.key)
+            return run_rules(view, rules)
+
+        patcher = unittest.mock.patch.object(ViewClicksInfo, 'run_rules', counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def walk(self, api_flags):
+        # every page of a paged request, following next until the last page
+        pages = []
+        url = '/clicks_info/' + api_flags
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            page = json.loads(response.content.decode('utf-8'))
+            pages.append(page['results'])
+            url = page['next']
+        return pages
+
+
+class QueryTests(ClicksInfoTestCase):
+    def values(self, api_flags, column):
+        return [row[column] for row in self.rows(api_flags)]
+
+    def test_date_range_is_inclusive(self):
+        rows = self.rows('date_from=2017-05-18&date_to=2017-06-01&sorted=date,ascending&columns=date,clicks')
+        self.assertEqual([row['date'] for row in rows], ['2017-05-18', '2017-05-18', '2017-05-31', '2017-06-01', '2017-06-01'])
+        # equal dates keep the order the rows were loaded in
+        self.assertEqual([row['clicks'] for row in rows], ['69', '51', '40', '500', '211'])
+
+    def test_sorted_by_value(self):
+        self.assertEqual(self.values('sorted=clicks,ascending&columns=clicks', 'clicks'), ['40', '51', '60', '69', '118', '130', '211', '336', '494', '500'])
+        self.assertEqual(self.values('sorted=revenue,descending&columns=revenue', 'revenue')[:3], ['210.24', '160.0', '149.04'])
+        self.assertEqual(self.values('sorted=channel,descending&columns=channel', 'channel')[0], 'facebook')
+
+    def test_columns_keep_the_model_order(self):
+        self.assertEqual({tuple(row) for row in self.rows('columns=revenue,date')}, {('date', 'revenue')})
+
+    def test_include_only(self):
+        # every token must be one of the values of a row
+        self.assertEqual(self.values('include_only=US,ios&columns=channel,country,os,clicks&sorted=clicks,descending', 'clicks'), ['336', '211', '130'])
+        # a token is compared with the values as they are returned
+        self.assertEqual(self.values('include_only=494', 'clicks'), ['494'])
+        self.assertEqual(self.values('include_only=50.0', 'spend'), ['50.0'])
+        self.assertEqual(self.rows('include_only=0494'), [])
+        self.assertEqual(self.rows('include_only=50'), [])
+        # only with the requested columns
+        self.assertEqual(self.rows('include_only=US&columns=channel'), [])
+
+    def test_cpi(self):
+        rows = self.rows('cpi=true&columns=spend,installs&sorted=installs,ascending')[:2]
+        # no installs counts as one install
+        self.assertEqual(rows, [{'installs': '0', 'spend': '10.0', 'cpi': '10.0'}, {'installs': '4', 'spend': '12.5', 'cpi': '3.125'}])
+
+
+class OutputTests(ClicksInfoTestCase):
+    # the rows look the way they did when every column was stored as the source's string
+    def test_money_as_the_source_wrote_it(self):
+        for engine in ['sql', 'numpy']:
+            with self.settings(CLICKS_INFO_ENGINE=engine):
+                self.assertEqual(self.rows('include_only=43643&columns=channel,spend'), [{'date': '2017-05-18', 'channel': 'facebook', 'spend': '43643'}])
+                self.assertEqual(self.rows('include_only=43643.0&columns=channel,spend'), [])
+                self.assertEqual([row['spend'] for row in self.rows('sorted=spend,descending&columns=spend')][:3], ['43643', '150.25', '148.2'])
+
+    def test_saved_money_gets_its_text(self):
+        row = ClicksInfo.objects.get(spend_text='43643')
+        row.save()
+        self.assertEqual(ClicksInfo.objects.get(pk=row.pk).spend_text, '43643')
+
+        row.spend = Decimal('12.5')
+        row.save()
+        self.assertEqual(ClicksInfo.objects.get(pk=row.pk).spend_text, '12.5')
+
+    def test_reload_brings_back_the_text(self):
+        # the same value written another way is still a change to the row
+        changed = list(self.source_rows[3])
+        changed[7] = '43643.00'
+        self.assertEqual(self.load([changed])['rows_updated'], 1)
+        self.assertEqual(self.rows('include_only=43643.00&columns=spend')[0]['spend'], '43643.00')
+
+    def test_id_with_every_column(self):
+        ids = list(ClicksInfo.objects.order_by('-date', 'id').values_list('id', flat=True)[:2])
+        for engine in ['sql', 'numpy']:
+            with self.settings(CLICKS_INFO_ENGINE=engine):
+                rows = self.rows('cpi=true&top=2')
+                self.assertEqual([row['id'] for row in rows], ids)
+                self.assertEqual(list(rows[0])[:2], ['id', 'date'])
+                self.assertNotIn('id', self.rows('cpi=true&columns=date,channel&top=1')[0])
+                self.assertNotIn('id', self.rows('top=1')[0])
+
+        body = b''.join(self.get('cpi=true&format=ndjson&sorted=date,descending').streaming_content).decode('utf-8')
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()][:2], ids)
+
+
+class PlanTests(ClicksInfoTestCase):
+    def test_plans_are_reused(self):
+        plan = self.plan('group=channel&sorted=clicks,descending&top=5')
+        self.assertIs(self.plan('group=channel&sorted=clicks,descending&top=5'), plan)
+        self.assertEqual(ViewClicksInfo.compile_plan('cpi=maybe'), ViewClicksInfo.compile_plan('cpi=maybe'))
+
+    def test_plans_can_not_be_changed(self):
+        plan = self.plan('group=channel&include_only=US')
+        with self.assertRaises(TypeError):
+            plan['limit'] = 10
+        self.assertEqual(plan['group'], ('channel',))
+        self.assertEqual(plan['columns'], frozenset(['date', 'channel', 'country', 'os', 'impressions', 'clicks', 'installs', 'spend', 'revenue']))
+
+    def test_same_result_same_key(self):
+        plan = self.plan('columns=clicks,channel&include_only=US,ios&sorted=clicks,ascending')
+        self.assertEqual(self.plan('sorted=clicks,ascending&include_only=ios,US,ios&columns=channel,clicks&cpi=false&date_to=latest'), plan)
+        for api_flags in ['columns=clicks,channel&include_only=US,ios&sorted=clicks,descending', 'columns=clicks,channel&include_only=US&sorted=clicks,ascending', 'columns=clicks,channel&include_only=US,ios&sorted=clicks,ascending&top=3']:
+            self.assertNotEqual(self.plan(api_flags).key, plan.key, api_flags)
+
+
+class ValidationTests(ClicksInfoTestCase):
+    def errors(self, api_flags):
+        # the errors are sent as a json string
+        response = self.get(api_flags, status=400)
+        return json.loads(json.loads(response.content.decode('utf-8')))
+
+    def test_every_error_is_listed(self):
+        errors = self.errors('date_from=2017-05&columns=nope&sorted=clicks,up&cpi=maybe')
+        self.assertEqual([error.split(' ')[0] for error in errors.values()], ['date_from', 'columns', 'sorted', 'cpi'])
+
+    def test_wrong_flags(self):
+        for api_flags in ['date_to=2017-02-30', 'date_from=2017-13-01', 'date_from=yesterday', 'group=nope', 'metrics=cac', 'agg=median:clicks', 'agg=sum',
+                          'agg=sum:channel', 'agg=sum:cpi', 'format=xml', 'format=csv&top=2', 'top=2&limit=2']:
+            self.assertEqual(len(self.errors(api_flags)), 1, api_flags)
+
+    def test_flags_which_can_not_be_parsed(self):
+        for api_flags in ['x', 'cpi', 'cpi=true&top']:
+            self.assertEqual(self.get(api_flags, status=400).content, b'')
+
+
+@override_settings(CLICKS_INFO_SNAPSHOT=None)
+class MigrationTests(TransactionTestCase):
+    # the string rows of the database before 0008, as the source wrote them
+    string_rows = [
+                   ['2017-05-17', 'adcolony', 'US', 'android', '19887', '494', '76', '43612', '149.04'],
+                   ['2017-05-18', 'facebook', 'DE', 'ios', '3369', '69', '15', '50.0', '0'],
+                   ]
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+
+    def test_money_keeps_the_source_text(self):
+        apps = self.migrate(('handler', '0006_clicksinfo_cpi'))
+        OldClicksInfo = apps.get_model('handler', 'ClicksInfo')
+        columns = ['date', 'channel', 'country', 'os', 'impressions', 'clicks', 'installs', 'spend', 'revenue']
+        for row in self.string_rows:
+            OldClicksInfo.objects.create(cpi='0', **dict(zip(columns, row)))
+
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('handler')[0]
+        self.migrate(latest)
+
+        response = self.client.get('/clicks_info/include_only=43612&columns=spend,revenue')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), [{'date': '2017-05-17', 'spend': '43612', 'revenue': '149.04'}])
+        self.assertEqual(list(ClicksInfo.objects.order_by('id').values_list('spend_text', 'revenue_text')), [('43612', '149.04'), ('50.0', '0')])
+
+        # and back again
+        apps = self.migrate(('handler', '0006_clicksinfo_cpi'))
+        OldClicksInfo = apps.get_model('handler', 'ClicksInfo')
+        self.assertEqual(list(OldClicksInfo.objects.order_by('id').values_list('spend', 'revenue')), [('43612', '149.04'), ('50.0', '0')])
+        self.migrate(latest)
+
+
+class AggregateTests(ClicksInfoTestCase):
+    def test_grouped_totals(self):
+        rows = self.rows('agg=count,sum:clicks&group=channel&sorted=channel,ascending&include_only=US&columns=country')
+        self.assertEqual(rows, [
+                                {'channel': 'adcolony', 'count': '3', 'sum_clicks': '1330'},
+                                {'channel': 'apple_search_ads', 'count': '1', 'sum_clicks': '130'},
+                                {'channel': 'facebook', 'count': '1', 'sum_clicks': '211'},
+                                ])
+
+    def test_empty_range_from_clicks_info(self):
+        # an ungrouped aggregate of no rows is one row, a count of 0 and null for everything else
+        response = self.get('agg=count,sum:clicks,avg:spend,min:date&date_from=2030-01-01&include_only=ios&columns=os&cpi=true')
+        self.assertEqual(response['X-Clicks-Info-Source'], 'clicks_info')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), [{'count': '0', 'sum_clicks': None, 'avg_spend': None, 'min_date': None, 'cpi': None}])
+
+    def test_empty_range_from_rollup(self):
+        response = self.get('agg=count,sum:clicks&date_from=2030-01-01&metrics=roas')
+        self.assertTrue(response['X-Clicks-Info-Source'].startswith('rollup_'))
+        self.assertEqual(json.loads(response.content.decode('utf-8')), [{'count': '0', 'sum_clicks': None, 'roas': None}])
+
+    def test_empty_range_grouped(self):
+        self.assertEqual(self.rows('agg=count&group=channel&date_from=2030-01-01'), [])
+
+    def test_combine_empty_ranges(self):
+        # the partial aggregates of the ranges of a parallel scan, one of them without rows
+        rules = self.plan('agg=count,sum:clicks,min:clicks,avg:spend&metrics=cpi')
+        query = AggregateQuery(rules, ViewClicksInfo.model_columns)
+
+        empty = {'count': 0, 'sum_clicks': None, 'min_clicks': None, 'sum_spend': None, 'sum_installs': None}
+        full = {'count': 2, 'sum_clicks': 30, 'min_clicks': 10, 'sum_spend': 5.0, 'sum_installs': 2}
+
+        combined = combine_aggregates(query, [[empty], [full], [empty]])
+        self.assertEqual(combined, [{'count': 2, 'sum_clicks': 30, 'min_clicks': 10, 'avg_spend': 2.5, 'group_cpi': 2.5}])
+
+        combined = combine_aggregates(query, [[empty], [empty]])
+        self.assertEqual(combined, [{'count': 0, 'sum_clicks': None, 'min_clicks': None, 'avg_spend': None, 'group_cpi': None}])
+
+
+class RollupTests(ClicksInfoTestCase):
+    def source(self, api_flags):
+        return self.get(api_flags)['X-Clicks-Info-Source']
+
+    def clicks_info_rows(self, api_flags):
+        # the rows of the request answered from clicks_info, without any rollup or cached result
+        caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+        single_flight.clear()
+        with unittest.mock.patch('handler.views.rollup_for', return_value=None):
+            response = self.get(api_flags)
+        self.assertEqual(response['X-Clicks-Info-Source'], 'clicks_info')
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_smallest_rollup_holding_the_request(self):
+        sources = {
+                   'agg=sum:clicks&group=channel': 'rollup_monthly_channel',
+                   'agg=count&group=channel&date_from=2017-05-01&date_to=2017-05-31': 'rollup_monthly_channel',
+                   'agg=count&group=channel&date_from=2017-05-17': 'rollup_daily_channel',
+                   'agg=sum:spend&group=date,channel&columns=channel&include_only=facebook': 'rollup_daily_channel',
+                   'agg=count,sum:installs&group=country&columns=country&include_only=US': 'rollup_daily_country',
+                   # the tokens are compared with every requested column, here with channel and os too
+                   'agg=count&group=country&include_only=US': 'clicks_info',
+                   # functions, groups and include_only tokens which need the rows
+                   'agg=avg:clicks&group=channel': 'clicks_info',
+                   'agg=max:spend': 'clicks_info',
+                   'agg=sum:clicks&group=os': 'clicks_info',
+                   'agg=sum:clicks&group=channel&columns=channel,os&include_only=ios': 'clicks_info',
+                   'agg=sum:clicks&group=channel&columns=channel,clicks&include_only=494': 'clicks_info',
+                   }
+        for api_flags, source in sources.items():
+            self.assertEqual(self.source(api_flags), source, api_flags)
+
+    def test_same_rows_as_clicks_info(self):
+        requests = [
+                    'agg=count,sum:clicks,sum:spend&group=channel&sorted=channel,ascending',
+                    'agg=sum:revenue&group=date,channel&sorted=revenue,descending&metrics=roas&date_from=2017-05-18',
+                    'agg=count,sum:installs&group=country&columns=country&sorted=country,ascending&include_only=US&cpi=true',
+                    'agg=count&date_from=2017-06-01&date_to=2017-06-30',
+                    ]
+        for api_flags in requests:
+            self.assertNotEqual(self.source(api_flags), 'clicks_info')
+            self.assertEqual(self.rows(api_flags), self.clicks_info_rows(api_flags), api_flags)
+
+    def test_rollups_follow_the_loaded_rows(self):
+        changed = list(self.source_rows[0])
+        changed[5] = '1000'
+        self.load([changed, ['2017-06-04', 'facebook', 'US', 'android', '6000', '120', '8', '16.0', '8.5']])
+
+        api_flags = 'agg=count,sum:clicks&group=channel&sorted=channel,ascending'
+        self.assertEqual(self.rows(api_flags), [
+                                                {'channel': 'adcolony', 'count': '4', 'sum_clicks': '1876'},
+                                                {'channel': 'apple_search_ads', 'count': '2', 'sum_clicks': '248'},
+                                                {'channel': 'facebook', 'count': '5', 'sum_clicks': '511'},
+                                                ])
+        self.assertEqual(self.rows(api_flags), self.clicks_info_rows(api_flags))
+
+    def test_chunks_add_up_to_a_refresh(self):
+        def totals():
+            return {rollup: sorted(rollup.objects.values_list(rollup.period_field, *rollup.dimensions, 'rows', *measures)) for rollup in ROLLUPS}
+
+        def partitions():
+            return list(ClicksInfoPartition.objects.order_by('month').values_list('month', 'rows', 'first_date', 'last_date'))
+
+        # a changed row, and new rows in months which are already loaded, one chunk each
+        changed = list(self.source_rows[4])
+        changed[7] = '20.25'
+        chunks = [[changed], [['2017-05-01', 'facebook', 'GB', 'ios', '100', '10', '1', '2.5', '1.0']], [['2017-06-30', 'vungle', 'US', 'ios', '100', '10', '1', '2.5', '1.0']]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            LoadDB('test.csv').insert_chunks(chunks)
+
+        loaded_totals = totals()
+        loaded_partitions = partitions()
+        self.assertEqual(loaded_partitions[0][1:], (7, datetime.date(2017, 5, 1), datetime.date(2017, 5, 31)))
+
+        # recomputing everything from the rows changes nothing
+        refresh_rollups()
+        refresh_partitions(ClicksInfo.objects.values_list('date', flat=True))
+        self.assertEqual(totals(), loaded_totals)
+        self.assertEqual(partitions(), loaded_partitions)
+
+
+class LoaderTests(ClicksInfoTestCase):
+    # rows which are not in source_rows, the last day of the source and the day after it
+    new_rows = [
+                ['2017-06-03', 'adcolony', 'US', 'ios', '5000', '100', '12', '24.0', '30.0'],
+                ['2017-06-04', 'facebook', 'US', 'android', '6000', '120', '8', '16.0', '8.5'],
+                ]
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def csv_source(self, rows):
+        path = os.path.join(self.directory, 'source.csv')
+        with open(path, 'a', newline='') as csv_file:
+            csv.writer(csv_file).writerows(rows)
+        return path
+
+    def sqlite_source(self, rows):
+        path = os.path.join(self.directory, 'source.sqlite3')
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS clicksinfo (date, channel, country, os, impressions, clicks, installs, spend, revenue)')
+            conn.executemany('INSERT INTO clicksinfo VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.close()
+        return path
+
+    def load_source(self, path, incremental=True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return LoadDB(path, chunk_size=3, incremental=incremental).load_db()
+
+    def counts(self, status):
+        return [status[name] for name in ['rows_read', 'rows_inserted', 'rows_updated', 'rows_skipped']]
+
+    def test_loaded_rows_are_not_loaded_again(self):
+        self.assertEqual(self.counts(self.load(self.source_rows)), [10, 0, 0, 10])
+        self.assertEqual(ClicksInfo.objects.count(), 10)
+
+    def test_changed_rows_are_updated(self):
+        changed = list(self.source_rows[5])
+        changed[6] = '4'
+        self.assertEqual(self.counts(self.load([changed] + self.new_rows)), [3, 2, 1, 0])
+        self.assertEqual(ClicksInfo.objects.count(), 12)
+
+        # the derived metrics of the row are calculated again
+        self.assertEqual(self.rows('include_only=2017-05-31&columns=date,installs&cpi=true'), [{'date': '2017-05-31', 'installs': '4', 'cpi': '2.5'}])
+
+    def test_the_last_of_the_same_row_is_loaded(self):
+        row = list(self.new_rows[0])
+        changed = list(row)
+        changed[5] = '101'
+        self.assertEqual(self.counts(self.load([row, changed])), [2, 1, 0, 1])
+        self.assertEqual(self.rows('include_only=2017-06-03,adcolony&columns=date,channel,clicks'), [{'date': '2017-06-03', 'channel': 'adcolony', 'clicks': '101'}])
+
+    def test_incremental_sqlite_source(self):
+        path = self.sqlite_source(self.source_rows)
+        self.assertEqual(self.counts(self.load_source(path)), [10, 0, 0, 10])
+
+        # only the rows after the largest rowid loaded are read
+        self.sqlite_source(self.new_rows)
+        self.assertEqual(self.counts(self.load_source(path)), [2, 2, 0, 0])
+        self.assertEqual(self.counts(self.load_source(path)), [0, 0, 0, 0])
+
+        watermark = LoadWatermark.objects.get(source=os.path.abspath(path))
+        self.assertEqual((watermark.last_rowid, watermark.rows), (12, 12))
+
+        # a full load reads every row again
+        self.assertEqual(self.counts(self.load_source(path, incremental=False)), [12, 0, 0, 12])
+
+    def test_incremental_csv_source(self):
+        path = self.csv_source(self.source_rows)
+        self.load_source(path)
+
+        # the rows of the latest date loaded are read again, with the rows after it
+        self.csv_source(self.new_rows)
+        self.assertEqual(self.counts(self.load_source(path)), [3, 2, 0, 1])
+        self.assertEqual(str(LoadWatermark.objects.get(source=os.path.abspath(path)).last_date), '2017-06-04')
+        self.assertEqual(ClicksInfo.objects.count(), 12)
+
+    def test_results_follow_the_loaded_rows(self):
+        before = self.get('agg=count')
+        self.assertEqual(json.loads(before.content.decode('utf-8')), [{'count': '10'}])
+
+        self.load(self.new_rows)
+        after = self.get('agg=count')
+        self.assertEqual(json.loads(after.content.decode('utf-8')), [{'count': '12'}])
+        self.assertNotEqual(before['ETag'], after['ETag'])
+
+
+class EngineTests(ClicksInfoTestCase):
+    # the numpy engine returns the same rows as the database
+    requests = [
+                'sorted=date,descending',
+                'sorted=spend,ascending&cpi=true',
+                'sorted=channel,ascending&columns=channel,clicks',
+                'date_from=2017-05-18&date_to=2017-06-02&sorted=revenue,descending&metrics=roas,ctr',
+                'include_only=US,ios',
+                'include_only=DE&include_only=android&columns=country,os,installs',
+                'include_only=494',
+                'include_only=50.0,2017-05-17',
+                'include_only=nothing',
+                'include_only=3.125&cpi=true',
+                'group=channel&sorted=clicks,descending',
+                'group=os,country&sorted=date,ascending&cpi=true',
+                'group=spend&columns=channel',
+                'top=4&sorted=installs,descending',
+                'top=3&group=country&sorted=impressions,ascending',
+                'columns=date&sorted=clicks,ascending&include_only=2017-06-01',
+                ]
+
+    def engine_rows(self, engine, api_flags):
+        with self.settings(CLICKS_INFO_ENGINE=engine):
+            return self.rows(api_flags)
+
+    def test_same_rows(self):
+        for api_flags in self.requests:
+            self.assertEqual(self.engine_rows('numpy', api_flags), self.engine_rows('sql', api_flags), api_flags)
+
+    def test_same_pages(self):
+        for api_flags in ['limit=3', 'limit=4&sorted=country,ascending&include_only=ios', 'limit=2&sorted=cpi,descending&columns=channel&cpi=true']:
+            pages = {}
+            for engine in ['sql', 'numpy']:
+                with self.settings(CLICKS_INFO_ENGINE=engine):
+                    pages[engine] = self.walk(api_flags)
+            self.assertEqual(pages['numpy'], pages['sql'], api_flags)
+
+    def test_loaded_rows_reach_the_table(self):
+        self.engine_rows('numpy', 'top=1')
+        self.load([['2017-07-01', 'facebook', 'FR', 'ios', '100', '10', '1', '2.0', '3.0']])
+        self.assertEqual(self.engine_rows('numpy', 'include_only=FR&columns=country'), [{'date': '2017-07-01', 'country': 'FR'}])
+
+
+class PaginationTests(ClicksInfoTestCase):
+    def test_pages_add_up_to_the_whole_result(self):
+        for api_flags in ['sorted=clicks,descending', 'sorted=channel,ascending&columns=channel,clicks', 'sorted=date,ascending&include_only=US']:
+            pages = self.walk(api_flags + '&limit=3')
+            self.assertTrue(all(len(page) <= 3 for page in pages))
+            self.assertEqual([row for page in pages for row in page], self.rows(api_flags))
+
+    def test_agg_pages_add_up_to_the_whole_result(self):
+        api_flags = 'agg=sum:spend,count&group=channel,os&sorted=spend,descending&include_only=ios'
+        pages = self.walk(api_flags + '&limit=2')
+        self.assertEqual([row for page in pages for row in page], self.rows(api_flags))
+
+    def test_cursor_of_another_request(self):
+        page = self.rows('limit=2&sorted=clicks,descending')
+        cursor = page['next'].split('cursor=')[1]
+        self.get('limit=2&sorted=clicks,ascending&cursor=' + cursor, status=400)
+        self.get('cursor=' + cursor, status=400)
+
+    def test_changed_cursor_values(self):
+        # a cursor with the right shape, but values which don't fit the order of the request
+        page = self.rows('limit=2')
+        shape, values = decode_cursor(page['next'].split('cursor=')[1])
+
+        for forged in [[], [values[0]], values + [1], 7, {'date': values[0]}, [None, None], ['nodate', values[1]], [values[0], 10 ** 30], [values[0], True], [values[0], 'x']]:
+            response = self.get('limit=2&cursor=' + encode_cursor(shape, forged), status=400)
+            self.assertIn('cursor is incorrect', response.content.decode('utf-8'))
+
+        # a valid date written another way is still the same cursor
+        year, month, day = values[0].split('-')
+        self.assertEqual(self.rows('limit=2&cursor=' + encode_cursor(shape, ['{}-{}-{}'.format(year, int(month), int(day)), str(values[1])])), self.rows('limit=2&cursor=' + encode_cursor(shape, values)))
+
+    def test_changed_agg_cursor_values(self):
+        api_flags = 'limit=1&agg=sum:spend&group=channel&metrics=cpi&sorted=cpi,descending'
+        shape, values = decode_cursor(self.rows(api_flags)['next'].split('cursor=')[1])
+        for forged in [['x', 'adcolony'], [float('inf'), 'adcolony'], [1.5]]:
+            self.get(api_flags + '&cursor=' + encode_cursor(shape, forged), status=400)
+
+        # an ungrouped agg is a single page, without an order a cursor has nothing to continue from
+        for api_flags in ['agg=count&limit=1', 'agg=sum:clicks&limit=1&sorted=country,ascending']:
+            for forged in [[], ['x']]:
+                response = self.get(api_flags + '&cursor=' + encode_cursor(self.plan(api_flags).shape, forged), status=400)
+                self.assertIn('cursor is incorrect', response.content.decode('utf-8'))
+
+    def test_limit_and_top_sizes(self):
+        with self.settings(CLICKS_INFO_MAX_LIMIT=1000):
+            self.assertEqual(len(self.rows('limit=1000')['results']), len(self.source_rows))
+            self.assertEqual(len(self.rows('top=0003')), 3)
+            for api_flags in ['limit=1001', 'top=1001', 'limit=99999999999999999999999', 'limit=0', 'top=-1', 'limit=\u00b2', 'limit=1,2', 'top=2&limit=2']:
+                self.get(api_flags, status=400)
+
+
+class BatchTests(ClicksInfoTestCase):
+    def post(self, queries, status=200):
+        response = self.client.post('/clicks_info/batch', json.dumps(queries), content_type='application/json')
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_entries_are_the_single_responses(self):
+        queries = ['group=channel&agg=sum:clicks&sorted=clicks,descending', 'limit=3&sorted=clicks,ascending', 'include_only=US&cpi=true&top=2']
+        entries = self.post(queries)['results']
+        self.assertEqual([entry['status'] for entry in entries], [200] * 3)
+        for api_flags, entry in zip(queries, entries):
+            self.assertEqual(entry['data'], self.rows(api_flags))
+        # next urls of a page point at the single request endpoint
+        self.assertTrue(entries[1]['data']['next'].startswith('http://testserver/clicks_info/'))
+
+    def test_rule_objects(self):
+        entries = self.post([
+                             {'include_only': ['US', 'ios'], 'sorted': 'clicks,descending', 'cpi': True, 'top': 2},
+                             {'group': ['channel'], 'agg': ['count', 'sum:clicks'], 'sorted': ['channel', 'ascending']},
+                             ])['results']
+        self.assertEqual(entries[0]['data'], self.rows('include_only=US,ios&sorted=clicks,descending&cpi=true&top=2'))
+        self.assertEqual(entries[1]['data'], self.rows('group=channel&agg=count,sum:clicks&sorted=channel,ascending'))
+
+    def test_values_which_are_not_flags(self):
+        # values which would be read as more flags or values are refused, not split
+        for query in [{'include_only': 'US&cpi=true'}, {'include_only': ['US,ios']}, {'include_only': 'US=1'}, {'top&cpi': 2}, 7, None]:
+            entry = self.post([query, 'top=1'])['results']
+            self.assertEqual([entry[0]['status'], entry[1]['status']], [400, 200], query)
+
+    def test_failing_query_does_not_fail_the_others(self):
+        entries = self.post(['sorted=nothing', 'top=1&format=csv', 'top=1'])['results']
+        self.assertEqual([entry['status'] for entry in entries], [400, 400, 200])
+        self.assertIn('sorted', json.dumps(entries[0]['errors']))
+
+    def test_body(self):
+        self.assertEqual(len(self.post({'queries': ['top=1', 'top=2']})['results']), 2)
+        self.post({'query': ['top=1']}, status=400)
+        with self.settings(CLICKS_INFO_BATCH_LIMIT=2):
+            self.post(['top=1'] * 3, status=400)
+
+    def test_same_rules_execute_once(self):
+        calls = self.counted_run_rules()
+        entries = self.post(['top=2&cpi=true', {'cpi': True, 'top': 2}, 'top=3'])['results']
+        self.assertEqual(entries[0], entries[1])
+        self.assertEqual(len(calls), 2)
+
+
+class GroupOrderTests(ClicksInfoTestCase):
+    # group keeps the rows of every group together, the groups in the order they first appear
+    grouped = ['group=channel&sorted=clicks,descending', 'group=os,country&sorted=spend,ascending&columns=clicks', 'group=country&sorted=date,ascending&include_only=ios', 'group=cpi&sorted=cpi,descending']
+
+    def test_groups_in_order_of_first_appearance(self):
+        rows = self.rows('group=channel&sorted=clicks,descending&columns=channel,clicks')
+        self.assertEqual([row['channel'] for row in rows], ['adcolony'] * 4 + ['facebook'] * 4 + ['apple_search_ads'] * 2)
+        self.assertEqual([row['clicks'] for row in rows[:4]], ['500', '494', '336', '40'])
+
+    def test_top_is_the_start_of_the_whole_result(self):
+        for engine in ['sql', 'numpy']:
+            with self.settings(CLICKS_INFO_ENGINE=engine):
+                for api_flags in self.grouped:
+                    rows = self.rows(api_flags)
+                    for top in [1, 3, 5, 20]:
+                        self.assertEqual(self.rows(api_flags + '&top={}'.format(top)), rows[:top], (engine, api_flags, top))
+
+    def test_streamed_in_the_same_order(self):
+        for api_flags in self.grouped:
+            body = b''.join(self.get(api_flags + '&format=ndjson').streaming_content).decode('utf-8')
+            self.assertEqual([json.loads(line) for line in body.splitlines()], self.rows(api_flags))
+
+    def test_no_pages_of_groups(self):
+        self.get('group=channel&limit=2', status=400)
+        self.get('group=channel&agg=count&limit=2')
+
+
+class StreamTests(ClicksInfoTestCase):
+    def body(self, api_flags):
+        response = self.get(api_flags)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson_is_the_json_rows(self):
+        for api_flags in ['sorted=spend,descending&cpi=true', 'include_only=ios&columns=channel,clicks', 'agg=count,sum:clicks&group=country&sorted=clicks,descending', 'include_only=nothing']:
+            response, body = self.body(api_flags + '&format=ndjson')
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in body.splitlines()], self.rows(api_flags))
+
+    def test_csv(self):
+        response, body = self.body('format=csv&columns=country,clicks&sorted=clicks,descending&include_only=DE')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(body, 'country,clicks\r\nDE,118\r\nDE,69\r\nDE,60\r\n')
+
+    def test_csv_of_no_rows_is_the_header(self):
+        response, body = self.body('format=csv&agg=count&group=channel&date_from=2030-01-01')
+        self.assertEqual(body, 'channel,count\r\n')
+
+    def test_streamed_requests_are_not_paged(self):
+        self.get('format=csv&limit=2', status=400)
+        self.get('format=xml', status=400)
+
+
+class SingleFlightTests(ClicksInfoTestCase):
+    def run_together(self, flight, result_cache, function, count=10):
+        # count threads asking for the same result at once, returns what each one got
+        results = [None] * count
+
+        def request(position):
+            try:
+                results[position] = flight.run(result_cache, function)
+            except ValueError as e:
+                results[position] = e
+
+        threads = [threading.Thread(target=request, args=(position,)) for position in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_execute_once(self):
+        flight = SingleFlight()
+        calls = []
+
+        def execute():
+            calls.append(1)
+            time.sleep(0.2)
+            return [{'clicks': '1'}], None
+
+        results = self.run_together(flight, ResultCache(self.plan('top=1'), 1), execute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [([{'clicks': '1'}], None)] * 10)
+
+        # the result is kept for a moment, until it is cleared
+        flight.run(ResultCache(self.plan('top=1'), 1), execute)
+        self.assertEqual(len(calls), 1)
+        flight.clear()
+        flight.run(ResultCache(self.plan('top=1'), 1), execute)
+        self.assertEqual(len(calls), 2)
+
+        # another data version is another result
+        flight.run(ResultCache(self.plan('top=1'), 2), execute)
+        self.assertEqual(len(calls), 3)
+
+    def test_failure_is_not_shared(self):
+        flight = SingleFlight()
+        calls = []
+
+        def execute():
+            calls.append(1)
+            time.sleep(0.1)
+            if len(calls) == 1:
+                raise ValueError('interrupted')
+            return [{'clicks': '1'}], None
+
+        results = self.run_together(flight, ResultCache(self.plan('top=2'), 1), execute)
+        # only the request which executed first fails, one of the waiting ones executes again for the others
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sum(isinstance(result, ValueError) for result in results), 1)
+        self.assertEqual(results.count(([{'clicks': '1'}], None)), 9)
+
+    def test_retain_0_keeps_nothing(self):
+        flight = SingleFlight()
+        calls = []
+        with self.settings(CLICKS_INFO_SINGLE_FLIGHT_RETAIN=0):
+            for run in range(3):
+                flight.run(ResultCache(self.plan('top=1'), 1), lambda: calls.append(1) or ([], None))
+        self.assertEqual(len(calls), 3)
+
+
+class ResultCacheTests(ClicksInfoTestCase):
+    def test_not_modified(self):
+        response = self.get('group=channel&sorted=clicks,descending')
+        etag = response['ETag']
+
+        not_modified = self.get('group=channel&sorted=clicks,descending', status=304, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['ETag'], etag)
+
+        # another result, or the same result after the data changed, is sent again
+        self.get('group=channel&sorted=clicks,ascending', HTTP_IF_NONE_MATCH=etag)
+        self.load([['2017-07-01', 'facebook', 'FR', 'ios', '100', '10', '1', '2.0', '3.0']])
+        self.assertNotEqual(self.get('group=channel&sorted=clicks,descending', HTTP_IF_NONE_MATCH=etag)['ETag'], etag)
+
+    def test_same_result_same_etag(self):
+        # flag order, spelled out defaults and the order of columns do not change the result
+        etags = {self.get(api_flags)['ETag'] for api_flags in ['columns=channel,clicks&sorted=clicks,descending', 'sorted=clicks,descending&columns=clicks,channel', 'columns=clicks,channel&sorted=clicks,descending&cpi=false&date_from=earliest']}
+        self.assertEqual(len(etags), 1)
+
+    def test_every_representation_has_its_etag(self):
+        json_etag = self.get('top=2')['ETag']
+        columns_etag = self.get('top=2', HTTP_ACCEPT='application/vnd.clicks-info.columns+json')['ETag']
+        self.assertNotEqual(json_etag, columns_etag)
+        self.get('top=2', status=304, HTTP_ACCEPT='application/vnd.clicks-info.columns+json', HTTP_IF_NONE_MATCH=columns_etag)
+        self.get('top=2', HTTP_IF_NONE_MATCH=columns_etag)
+
+    def test_results_are_executed_once(self):
+        calls = self.counted_run_rules()
+        first = self.rows('include_only=US&sorted=spend,ascending')
+        self.assertEqual(self.rows('sorted=spend,ascending&include_only=US'), first)
+        self.assertEqual(len(calls), 1)
+
+        # a data change executes the request again
+        self.load([['2017-07-01', 'facebook', 'US', 'ios', '100', '10', '1', '2.0', '3.0']])
+        self.assertEqual(len(self.rows('include_only=US&sorted=spend,ascending')), len(first) + 1)
+        self.assertEqual(len(calls), 2)
+
+    @override_settings(CLICKS_INFO_CACHE_MAX_ROWS=3, CLICKS_INFO_SINGLE_FLIGHT_RETAIN=0)
+    def test_large_results_are_not_cached(self):
+        calls = self.counted_run_rules()
+        for run in range(2):
+            self.assertEqual(len(self.rows('include_only=ios&date_from=2017-06-01')), 2)
+            self.assertEqual(len(self.rows('include_only=US')), 5)
+        self.assertEqual(len(calls), 3)
+
+        # they still have their etag
+        etag = self.get('include_only=US')['ETag']
+        self.get('include_only=US', status=304, HTTP_IF_NONE_MATCH=etag)
+
+
+class TimingTests(ClicksInfoTestCase):
+    def server_timing(self, response):
+        # stage -> (milliseconds, description)
+        stages = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *parameters = entry.split(';')
+            values = dict(parameter.split('=', 1) for parameter in parameters)
+            stages[name] = (float(values['dur']), values.get('desc'))
+        return stages
+
+    def test_server_timing(self):
+        stages = self.server_timing(self.get('include_only=US&sorted=clicks,descending'))
+        self.assertEqual(list(stages), ['compile', 'cache', 'query', 'execute', 'render', 'total'])
+        self.assertEqual(stages['query'][1], '"rows_out=5"')
+        self.assertEqual(stages['execute'][1], '"rows_in=5 rows_out=5"')
+        self.assertTrue(all(milliseconds >= 0 for milliseconds, description in stages.values()))
+        self.assertGreaterEqual(stages['total'][0], stages['query'][0])
+
+        # a cached result skips the query
+        self.assertNotIn('query', self.server_timing(self.get('include_only=US&sorted=clicks,descending')))
+
+    def count(self, text, stage, shape):
+        line = 'clicks_info_stage_seconds_count{{stage="{}",shape="{}"}} '.format(stage, shape)
+        for metric in text.splitlines():
+            if metric.startswith(line):
+                return int(metric[len(line):])
+        return 0
+
+    def test_prometheus_metrics(self):
+        before = self.client.get('/metrics').content.decode('utf-8')
+        shape = 'group:country,sorted:clicks,include_only'
+        for include_only in ['US', 'DE']:
+            self.get('group=country&sorted=clicks,ascending&include_only=' + include_only)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        after = response.content.decode('utf-8')
+        self.assertEqual(self.count(after, 'total', shape) - self.count(before, 'total', shape), 2)
+        self.assertEqual(self.count(after, 'query', shape) - self.count(before, 'query', shape), 2)
+        self.assertIn('clicks_info_stage_seconds_bucket{{stage="query",shape="{}",le="+Inf"}}'.format(shape), after)
+        self.assertIn('clicks_info_stage_seconds_quantile{{stage="total",shape="{}",quantile="0.99"}}'.format(shape), after)
+        self.assertIn('clicks_info_stage_rows_out_total{{stage="query",shape="{}"}}'.format(shape), after)
+
+    def test_quantiles_from_the_buckets(self):
+        histogram = Histogram()
+        for seconds in [0.0002] * 50 + [0.02] * 45 + [3.0] * 5:
+            histogram.observe(seconds, 10, 1)
+        self.assertEqual(histogram.quantile(0.5), 0.0005)
+        self.assertAlmostEqual(histogram.quantile(0.95), 0.025)
+        self.assertAlmostEqual(histogram.quantile(0.99), 5.0 - 2.5 * 0.2)
+        self.assertEqual((histogram.count, histogram.rows_in, histogram.rows_out), (100, 1000, 100))
+
+
+class PartitionTests(ClicksInfoTestCase):
+    def may_row(self):
+        return ClicksInfo.objects.get(date='2017-05-17', channel='adcolony', os='ios')
+
+    def test_freeze(self):
+        self.assertEqual(freeze_partitions(datetime.date(2017, 6, 15)), [datetime.date(2017, 5, 1)])
+        self.assertEqual(list(ClicksInfoPartition.objects.order_by('month').values_list('month', 'read_only')), [(datetime.date(2017, 5, 1), True), (datetime.date(2017, 6, 1), False)])
+        # frozen months stay frozen
+        self.assertEqual(freeze_partitions(datetime.date(2017, 6, 15)), [])
+
+    def test_read_only_rows_are_rejected(self):
+        freeze_partitions(datetime.date(2017, 6, 1))
+
+        # by LoadDB
+        may = ['2017-05-20', 'facebook', 'US', 'ios', '100', '10', '1', '2.0', '3.0']
+        june = ['2017-06-20', 'facebook', 'US', 'ios', '100', '10', '1', '2.0', '3.0']
+        status = self.load([may, june])
+        self.assertEqual((status['rows_inserted'], status['rows_rejected']), (1, 1))
+
+        # by the model signals
+        row = self.may_row()
+        row.clicks = 1
+        with self.assertRaises(ValueError), transaction.atomic():
+            row.save()
+        with self.assertRaises(ValueError), transaction.atomic():
+            row.delete()
+
+        # by the database, for queryset changes and raw sql
+        changes = [
+                   lambda: ClicksInfo.objects.filter(date__lt='2017-06-01').update(clicks=1),
+                   lambda: ClicksInfo.objects.filter(date='2017-06-01').update(date='2017-05-30'),
+                   lambda: ClicksInfo.objects.filter(pk=row.pk)._raw_delete(ClicksInfo.objects.db),
+                   lambda: connection.cursor().execute("INSERT INTO handler_clicksinfo (date, channel, country, os, impressions, clicks, installs, spend, revenue, spend_text, revenue_text, cpi, roas, ctr) VALUES ('2017-05-21', 'x', 'US', 'ios', 1, 1, 1, 1, 1, '1', '1', 1, 1, 1)"),
+                   ]
+        for change in changes:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                change()
+        self.assertEqual(self.may_row().clicks, 336)
+        self.assertEqual(ClicksInfo.objects.filter(date__lt='2017-06-01').count(), 6)
+
+        # the writable months still change
+        self.assertEqual(ClicksInfo.objects.filter(date__gte='2017-06-01').update(clicks=1), 5)
+
+
+class CompactionTests(TransactionTestCase):
+    def test_compact_partitions(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            LoadDB('test.csv').insert_chunks([ClicksInfoTestCase.source_rows])
+
+        out = io.StringIO()
+        call_command('compact_partitions', '--keep-months', '1', stdout=out)
+        self.assertEqual(out.getvalue(), 'Froze 1 months: 2017-05\nCompacted the database\n')
+        self.assertIsNotNone(ClicksInfoPartition.objects.get(month='2017-05-01').compacted)
+
+        with self.assertRaises(IntegrityError):
+            ClicksInfo.objects.filter(date='2017-05-17').update(clicks=1)
+
+        out = io.StringIO()
+        call_command('compact_partitions', '--keep-months', '3', stdout=out)
+        self.assertEqual(out.getvalue(), 'Nothing to freeze\n')
+
+        # thawed months can change again, and be flushed at the end of the test
+        out = io.StringIO()
+        call_command('compact_partitions', '--thaw', stdout=out)
+        self.assertEqual(out.getvalue(), 'Thawed 1 months: 2017-05\n')
+        self.assertEqual(ClicksInfo.objects.filter(date='2017-05-17').update(clicks=1), 3)
+
+
+class SnapshotTests(TransactionTestCase):
+    requests = ['sorted=spend,descending&cpi=true', 'include_only=ios&columns=channel,clicks&sorted=clicks,ascending', 'group=country&sorted=revenue,descending', 'limit=3&sorted=date,ascending']
+
+    def setUp(self):
+        caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+        single_flight.clear()
+        columnar._table = None
+        self.addCleanup(setattr, columnar, '_table', None)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        self.load(ClicksInfoTestCase.source_rows)
+
+    def load(self, rows):
+        with contextlib.redirect_stdout(io.StringIO()):
+            LoadDB('test.csv').insert_chunks([rows])
+
+    def rows(self, api_flags, engine):
+        caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+        single_flight.clear()
+        with self.settings(CLICKS_INFO_ENGINE=engine):
+            response = self.client.get('/clicks_info/' + api_flags)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def export(self):
+        out = io.StringIO()
+        call_command('export_snapshot', '--path', self.path, stdout=out)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        with self.settings(CLICKS_INFO_SNAPSHOT=self.path):
+            self.assertTrue(self.export().startswith('Wrote 10 rows of data version {} to '.format(data_version()[0])))
+
+            # the engine maps the snapshot named by CURRENT
+            table = columnar.columnar_table()
+            self.assertIsInstance(table.ids, columnar.np.memmap)
+            for api_flags in self.requests:
+                self.assertEqual(self.rows(api_flags, 'numpy'), self.rows(api_flags, 'sql'), api_flags)
+
+    @override_settings(CLICKS_INFO_SNAPSHOT_REFRESH=False)
+    def test_snapshot_of_another_version(self):
+        with self.settings(CLICKS_INFO_SNAPSHOT=self.path):
+            self.export()
+            self.load([['2017-06-04', 'facebook', 'US', 'android', '6000', '120', '8', '16.0', '8.5']])
+
+            # the snapshot is older than the data, the table is loaded from the database
+            self.assertIsNone(read_snapshot(self.path, data_version()[0]))
+            table = columnar.columnar_table()
+            self.assertNotIsInstance(table.ids, columnar.np.memmap)
+            self.assertEqual(len(table), 11)
+            for api_flags in self.requests:
+                self.assertEqual(self.rows(api_flags, 'numpy'), self.rows(api_flags, 'sql'), api_flags)
+
+    def test_exported_again_after_a_change(self):
+        with self.settings(CLICKS_INFO_SNAPSHOT=self.path):
+            # nothing is exported before the first export
+            self.load([['2017-06-04', 'facebook', 'US', 'android', '6000', '120', '8', '16.0', '8.5']])
+            self.assertFalse(os.path.exists(os.path.join(self.path, 'CURRENT')))
+
+            self.export()
+            self.load([['2017-06-05', 'facebook', 'US', 'android', '6000', '120', '8', '16.0', '8.5']])
+            self.assertIsNotNone(read_snapshot(self.path, data_version()[0]))
+
+            table = columnar.columnar_table()
+            self.assertIsInstance(table.ids, columnar.np.memmap)
+            self.assertEqual(len(table), 12)
+            self.assertEqual(self.rows('date_from=2017-06-05', 'numpy'), self.rows('date_from=2017-06-05', 'sql'))
+
+
+class DerivedMetricTests(ClicksInfoTestCase):
+    def test_metrics_flag(self):
+        rows = self.rows('metrics=roas,ctr&top=2&sorted=roas,descending&columns=spend,revenue,clicks,impressions')
+        self.assertEqual(rows, [
+                                {'impressions': '13886', 'clicks': '336', 'spend': '100.8', 'revenue': '210.24', 'roas': '2.085714285714286', 'ctr': '0.024197032982860436'},
+                                {'impressions': '9000', 'clicks': '211', 'spend': '75.0', 'revenue': '90.75', 'roas': '1.21', 'ctr': '0.023444444444444445'},
+                                ])
+
+    def test_zero_denominator_counts_as_one(self):
+        self.load([['2017-06-05', 'vungle', 'US', 'ios', '0', '0', '0', '0', '4.5']])
+        self.assertEqual(self.rows('include_only=vungle&metrics=cpi,roas,ctr&columns=channel'), [{'date': '2017-06-05', 'channel': 'vungle', 'cpi': '0.0', 'roas': '4.5', 'ctr': '0.0'}])
+
+    def test_metrics_are_columns(self):
+        # as columns, sorted and include_only, without the metrics flag
+        self.assertEqual(self.rows('columns=channel,roas&sorted=ctr,ascending&top=2'), [
+                                                                                                  {'channel': 'facebook', 'roas': '0.0', 'ctr': '0.014782608695652174'},
+                                                                                                  {'channel': 'adcolony', 'roas': '0.55', 'ctr': '0.02'},
+                                                                                                  ])
+        self.assertEqual(self.rows('include_only=1.21&columns=channel,roas'), [{'date': '2017-06-01', 'channel': 'facebook', 'roas': '1.21'}])
+
+    def test_group_metrics_are_ratios_of_the_totals(self):
+        rows = self.rows('agg=sum:spend&group=channel&metrics=roas,ctr&sorted=channel,ascending')
+        self.assertEqual(rows[0], {'channel': 'adcolony', 'sum_spend': '409.25', 'roas': '1.2822968845448992', 'ctr': '0.02413118912158949'})
+        self.assertEqual([row['channel'] for row in rows], ['adcolony', 'apple_search_ads', 'facebook'])
+
+    def test_saved_rows_keep_their_metrics(self):
+        row = ClicksInfo.objects.get(date='2017-06-01', channel='facebook')
+        row.revenue = Decimal('150')
+        row.save()
+        self.assertEqual(self.rows('include_only=2017-06-01,facebook&metrics=roas&columns=channel'), [{'date': '2017-06-01', 'channel': 'facebook', 'roas': '2.0'}])
+
+    def test_wrong_metrics(self):
+        response = self.get('metrics=cpm', status=400)
+        self.assertIn('metrics is incorrect', response.content.decode('utf-8'))
+
+
+@unittest.skipIf(renderers.msgpack is None or renderers.pyarrow is None, 'needs msgpack and pyarrow')
+class RendererTests(ClicksInfoTestCase):
+    requests = [
+                'sorted=spend,descending&cpi=true&metrics=roas',
+                'agg=count,sum:spend,avg:clicks,min:date&group=channel&sorted=channel,ascending',
+                'include_only=nothing&columns=channel,clicks',
+                ]
+
+    def assertSameRows(self, columns, rows, api_flags):
+        # the columns hold the values of the json rows, in the same order, as numbers where the json has numeric strings
+        names = list(rows[0]) if len(rows) > 0 else list(columns)
+        self.assertEqual(list(columns), names, api_flags)
+        for name in names:
+            values = columns[name]
+            self.assertEqual(len(values), len(rows), api_flags)
+            for value, row in zip(values, rows):
+                if isinstance(value, (int, float)):
+                    self.assertEqual(value, float(row[name]), api_flags)
+                else:
+                    self.assertEqual(None if value is None else str(value), row[name], api_flags)
+
+    def test_msgpack(self):
+        for api_flags in self.requests:
+            response = self.get(api_flags, HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            columns = renderers.msgpack.unpackb(response.content, raw=False)
+            self.assertSameRows(columns, self.rows(api_flags), api_flags)
+        self.assertEqual(self.rows('include_only=nothing&columns=channel,clicks'), [])
+        self.assertEqual(columns, {'date': [], 'channel': [], 'clicks': []})
+
+    def test_arrow(self):
+        for api_flags in self.requests:
+            response = self.get(api_flags, HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+            table = renderers.pyarrow.ipc.open_stream(response.content).read_all()
+            self.assertSameRows(table.to_pydict(), self.rows(api_flags), api_flags)
+
+        table = renderers.pyarrow.ipc.open_stream(self.get('top=1', HTTP_ACCEPT='application/vnd.apache.arrow.stream').content).read_all()
+        self.assertEqual(str(table.schema.field('date').type), 'date32[day]')
+        self.assertEqual(table.column('clicks').to_pylist(), [int(self.rows('top=1')[0]['clicks'])])
+
+    def test_pages_keep_next(self):
+        page = self.rows('limit=4')
+        columns = renderers.msgpack.unpackb(self.get('limit=4', HTTP_ACCEPT='application/msgpack').content, raw=False)
+        self.assertEqual(columns['next'], page['next'])
+        self.assertSameRows(columns['results'], page['results'], 'limit=4')
+
+        reader = renderers.pyarrow.ipc.open_stream(self.get('limit=4', HTTP_ACCEPT='application/vnd.apache.arrow.stream').content)
+        self.assertEqual(reader.schema.metadata[b'next'].decode('utf-8'), page['next'])
+
+
+class ASGITests(ClicksInfoTestCase):
+    def setUp(self):
+        super().setUp()
+        # a wsgi application answering with the path, which notes how many requests run at once
+        self.calls = []
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def application(self, environ, start_response):
+        with self.lock:
+            self.calls.append(environ['PATH_INFO'])
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode('utf-8')]
+
+    def scope(self, path, *headers):
+        return {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [(b'host', b'testserver')] + list(headers)}
+
+    def serve(self, scopes, threads=8):
+        # sends the requests at once, returns the status and body each one got
+        application = ClicksInfoASGI(self.application, threads=threads)
+        self.addCleanup(application.pool.shutdown)
+
+        async def request(scope):
+            messages = [{'type': 'http.request', 'body': b''}]
+            sent = []
+
+            async def receive():
+                if len(messages) > 0:
+                    return messages.pop()
+                # the client stays connected
+                await asyncio.Event().wait()
+
+            async def send(message):
+                sent.append(message)
+
+            await application(scope, receive, send)
+            return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+        async def requests():
+            return await asyncio.gather(*[request(scope) for scope in scopes])
+
+        return asyncio.run(requests())
+
+    def test_identical_requests_execute_once(self):
+        responses = self.serve([self.scope('/clicks_info/top=1')] * 5)
+        self.assertEqual(responses, [(200, b'/clicks_info/top=1')] * 5)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_requests_of_users_are_not_shared(self):
+        scopes = [
+                  self.scope('/clicks_info/top=1', (b'cookie', b'sessionid=a')),
+                  self.scope('/clicks_info/top=1', (b'cookie', b'sessionid=b')),
+                  self.scope('/clicks_info/top=1', (b'authorization', b'Basic YTpi')),
+                  self.scope('/admin/'),
+                  self.scope('/admin/'),
+                  self.scope('/clicks_info/top=1&format=csv'),
+                  self.scope('/clicks_info/top=1&format=csv'),
+                  ]
+        responses = self.serve(scopes)
+        self.assertEqual([body for status, body in responses], [scope['path'].encode('utf-8') for scope in scopes])
+        self.assertEqual(len(self.calls), len(scopes))
+
+    def test_threads_are_bounded(self):
+        scopes = [self.scope('/clicks_info/top={}'.format(top)) for top in range(1, 7)]
+        responses = self.serve(scopes, threads=2)
+        self.assertEqual([status for status, body in responses], [200] * 6)
+        self.assertEqual(len(self.calls), 6)
+        self.assertEqual(self.most_running, 2)
+
+
+class DatabaseTests(ClicksInfoTestCase):
+    def sqlite_connection(self, alias, name):
+        # a new connection of the default database's settings to another sqlite file
+        wrapper = DatabaseWrapper(dict(connection.settings_dict, NAME=name), alias)
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA ' + name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas_of_new_connections(self):
+        path = os.path.join(tempfile.mkdtemp(), 'pragmas.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        wrapper = self.sqlite_connection('default', path)
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), settings.CLICKS_INFO_SQLITE_PRAGMAS['cache_size'])
+
+    def test_replica_is_read_only(self):
+        path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        sqlite3.connect(path).execute('CREATE TABLE t (x integer)')
+
+        # the replica can't switch the journal mode, so it is left alone, and writes fail
+        wrapper = self.sqlite_connection(REPLICA, 'file:{}?mode=ro'.format(path))
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'delete')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)
+        with self.assertRaises(OperationalError):
+            with wrapper.cursor() as cursor:
+                cursor.execute('INSERT INTO t VALUES (1)')
+
+    def test_router(self):
+        router = ReadReplicaRouter()
+        self.assertIsNone(router.db_for_read(ClicksInfo))
+        with replica_reads():
+            # without a replica configured everything stays on the default database
+            self.assertIsNone(router.db_for_read(ClicksInfo))
+
+        with unittest.mock.patch('handler.database.has_replica', return_value=True):
+            self.assertIsNone(router.db_for_read(ClicksInfo))
+            with replica_reads():
+                with replica_reads():
+                    self.assertEqual(router.db_for_read(ClicksInfo), REPLICA)
+                self.assertEqual(router.db_for_read(ClicksInfo), REPLICA)
+                self.assertIsNone(router.db_for_write(ClicksInfo))
+            self.assertIsNone(router.db_for_read(ClicksInfo))
+
+        self.assertFalse(router.allow_migrate(REPLICA, 'handler'))
+        self.assertIsNone(router.allow_migrate('default', 'handler'))
+
+    def test_views_read_from_the_replica(self):
+        aliases = []
+        read_alias = database.read_alias
+
+        def recorded():
+            aliases.append(read_alias())
+            return 'default'
+
+        with unittest.mock.patch('handler.database.has_replica', return_value=True):
+            with unittest.mock.patch.object(ReadReplicaRouter, 'db_for_read', lambda router, model, **hints: recorded()):
+                self.rows('include_only=US')
+        self.assertIn(REPLICA, aliases)
+
+
+class InThread:
+    # an executor running the workers' scans in the test's thread, on the test database
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        future.set_result(function(*args))
+        return future
+
+
+@override_settings(CLICKS_INFO_PARALLEL_WORKERS=3, CLICKS_INFO_PARALLEL_ROWS=1)
+class ParallelTests(ClicksInfoTestCase):
+    requests = [
+                'sorted=clicks,descending',
+                'sorted=spend,ascending&columns=spend,channel&limit=4',
+                'sorted=date,descending&include_only=ios&columns=os,clicks',
+                'agg=count,sum:spend,avg:clicks,max:date&group=country&sorted=spend,descending&metrics=cpi',
+                'agg=count,min:revenue&group=channel,os&sorted=revenue,ascending&limit=2',
+                ]
+
+    def single_query_rows(self, api_flags):
+        # the rows of the request scanned in one query
+        caches[getattr(settings, 'CLICKS_INFO_CACHE', 'default')].clear()
+        single_flight.clear()
+        with self.settings(CLICKS_INFO_PARALLEL_WORKERS=1):
+            return self.rows(api_flags)
+
+    def test_merged_runs_are_one_query(self):
+        for api_flags in self.requests[:3]:
+            query = ViewClicksInfo().compile_query(self.plan(api_flags))
+            ranges, rows = split_dates(query.date_bound(query.rules['date_from']), query.date_bound(query.rules['date_to']), 3)
+            self.assertEqual(len(ranges), 3)
+
+            runs = [list(RangeQuery(dict(query.rules, date_from=start.timetuple()[:3], date_to=end.timetuple()[:3]), query.model_columns).queryset()) for start, end in ranges]
+            merged = merge_runs(query, runs)
+            # the ranges also select the order columns
+            single = list(query.queryset())
+            self.assertEqual([{c: row[c] for c in single[0]} for row in merged], single, api_flags)
+
+    def test_in_memory_database_is_one_query(self):
+        # the test database is in memory, worker processes would open the real one
+        with unittest.mock.patch('handler.parallel.executor', side_effect=AssertionError('no workers')):
+            for api_flags in self.requests:
+                query = ViewClicksInfo().compile_query(self.plan(api_flags))
+                self.assertEqual(query_rows(query), list(query.queryset()), api_flags)
+
+    def test_ranges_of_the_same_database(self):
+        name = connection.settings_dict['NAME']
+        with unittest.mock.patch('handler.parallel.executor', return_value=InThread()):
+            with unittest.mock.patch('handler.parallel.database_name', return_value=name):
+                with unittest.mock.patch('handler.parallel.merge_runs', wraps=merge_runs) as merged, unittest.mock.patch('handler.parallel.combine_aggregates', wraps=combine_aggregates) as combined:
+                    for api_flags in self.requests:
+                        self.assertEqual(self.rows(api_flags), self.single_query_rows(api_flags), api_flags)
+                    self.assertEqual((merged.call_count, combined.call_count), (3, 2))
+
+            # a worker which read another database is not merged, the request is scanned in one query
+            with unittest.mock.patch('handler.parallel.database_name', side_effect=[name, name, 'db.sqlite3', name, name]):
+                with unittest.mock.patch('handler.parallel.merge_runs') as merged:
+                    query = ViewClicksInfo().compile_query(self.plan(self.requests[0]))
+                    self.assertEqual(query_rows(query), list(query.queryset()))
+                    merged.assert_not_called()
@@ -1,8 +1,10 @@
 from django.urls import path
 
-from .views import ViewClicksInfo
+from .views import ViewClicksInfo, ViewClicksInfoBatch, ViewMetrics
 
 urlpatterns = [
+    path('clicks_info/batch', ViewClicksInfoBatch.as_view()),
     path('clicks_info/<str:api_flags>', ViewClicksInfo.as_view()),
     path('clicks_info', ViewClicksInfo.as_view()),
+    path('metrics', ViewMetrics.as_view()),
 ]
\ No newline at end of file
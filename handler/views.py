@@ -1,24 +1,63 @@
 from django.shortcuts import render
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.http import StreamingHttpResponse, HttpResponse
+from django.views import View
+from django.db import transaction
 
 from .models import ClicksInfo
+from .query import RulesQuery
+from .aggregation import AggregateQuery
+from .rollups import RollupQuery, rollup_for
+from .columnar import ColumnarEngine, columnar_table
+from .caching import ResultCache, single_flight
+from .plan import QueryPlan
+from .pagination import query_shape, encode_cursor, decode_cursor, cursor_value, typed_cursor
+from .signals import data_version
+from .metrics import StageTimer, stage_metrics, metrics_shape
+from .renderers import compact_renderers
+from .database import replica_reads, read_alias
+from .parallel import query_rows
 #from .serializers import ClicksInfoSerializer
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
 from rest_framework import status
 
+import csv
+import functools
+import itertools
 import json
+import operator
 
 from datetime import date
-#import datetime
+
 
 class ViewClicksInfo(APIView):
     name = 'View clicks info'
     description = 'Shows clicks database info based on API flags'
     
-    model_columns = ['date','channel','country','os','impressions','clicks','installs','spend','revenue', 'cpi']
+    model_columns = ['date','channel','country','os','impressions','clicks','installs','spend','revenue', 'cpi', 'roas', 'ctr']
+    
+    numerical_columns = ['date', 'impressions', 'clicks', 'installs', 'spend', 'revenue', 'cpi', 'roas', 'ctr']
+    
+    # streamed formats and their content types
+    stream_content_types = {
+                            'ndjson': 'application/x-ndjson',
+                            'csv': 'text/csv',
+                            }
+    
+    # rows fetched from the database cursor at a time while streaming
+    stream_chunk_size = 2000
+    
+    # json (and the browsable api), plus the compact columnar formats chosen with the Accept header (see handler/renderers.py)
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + compact_renderers()
     
-    numerical_columns = ['date', 'impressions', 'clicks', 'installs', 'spend', 'revenue', 'cpi']
+    # the columns of the rows being returned, for the columnar renderers
+    output_columns = None
 
     '''
     API FLAGS:
@@ -29,11 +68,22 @@ class ViewClicksInfo(APIView):
     group=date,channel,country,os,impressions,clicks,installs,spend,revenue
     sorted=column_name,ascending or descending
     cpi=true or false
+    metrics=cpi,roas,ctr <- the derived metrics to add to the columns, roas = revenue / spend and ctr = clicks / impressions
     include_only=any string
+    agg=function:column,function:column <- function is sum, count, avg, min or max, and count can also be used without a column
+    limit=number of rows per page <- not with group, unless agg is used
+    cursor=the cursor of the next page, as returned in next
+    top=number of rows <- only the first rows, in the same order as without top
+    format=json, ndjson or csv <- ndjson and csv are streamed
     
     divider: &
     '''
     
+    def dispatch(self, request, *args, **kwargs):
+        # every read of the request goes to the read replica, if there is one (see handler/database.py)
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
+    
     def api_parser(self, api_flags):
         # parses api string and returns dictionary of rules by which to organize the data being requested
         
@@ -45,7 +95,13 @@ class ViewClicksInfo(APIView):
                 'group':[],
                 'sorted':['date','descending'],
                 'cpi':['false'],
-                'include_only':[]
+                'metrics':[],
+                'include_only':[],
+                'agg':[],
+                'limit':[],
+                'cursor':[],
+                'top':[],
+                'format':['json']
                 }
         
         # if api_flags is blank, return default view and True status for no problems with URL
@@ -59,6 +115,10 @@ class ViewClicksInfo(APIView):
                 
                 flags = [flag.split('=') for flag in flags]
                 
+                # a flag without a value can't be parsed
+                if any(len(flag) < 2 for flag in flags):
+                    return {}, False
+                
                 flags = [(flag[0], flag[1].split(',')) for flag in flags]
                 
                 # try to create rules dict based on parsed flags, if key doesn't exist - return empty dict and False status
@@ -98,6 +158,8 @@ class ViewClicksInfo(APIView):
                 # if it is not - add to errors
                 year,month,day = rules['date_from'][0].split('-')
                 rules['date_from'] = (int(year), int(month), int(day))
+                # and a real date, not 2017-13-45
+                date(*rules['date_from'])
             except:
                 errors[error_counter] = 'date_from is in wrong format. Format expected is yyyy-mm-dd or the word earliest. Requested format is {}'.format(rules['date_from'][0])
                 error_counter += 1
@@ -111,6 +173,8 @@ class ViewClicksInfo(APIView):
                 # if it is not - add to errors
                 year,month,day = rules['date_to'][0].split('-')
                 rules['date_to'] = (int(year), int(month), int(day))
+                # and a real date, not 2017-13-45
+                date(*rules['date_to'])
             except:
                 errors[error_counter] = 'date_to is in wrong format. Format expected is yyyy-mm-dd or the word latest. Requested format is {}'.format(rules['date_to'][0])
                 error_counter += 1
@@ -146,6 +210,15 @@ class ViewClicksInfo(APIView):
             if rules['sorted'][0] not in rules['columns']:
                 rules['columns'].append(rules['sorted'][0])
         
+        # validate metrics
+        # the derived metrics are requested like columns, cpi can also be requested with cpi=true
+        for item in rules['metrics']:
+            if item not in ClicksInfo.derived_metrics:
+                errors[error_counter] = 'metrics is incorrect. Format expected is derived metric names separated by comma. Metrics must be of the following: {}. Requested metrics is {}'.format(list(ClicksInfo.derived_metrics), item)
+                error_counter += 1
+            elif item not in rules['columns']:
+                rules['columns'].append(item)
+        
         # validate cpi
         if rules['cpi'][0] not in ['true','false']:
             # incorrect cpi argument
@@ -164,8 +237,94 @@ class ViewClicksInfo(APIView):
                     rules['cpi'] = True
                 else:
                     rules['cpi'] = False
+        
+        # every derived metric which ended up in the columns
+        rules['metrics'] = [c for c in ClicksInfo.derived_metrics if c in rules['columns']]
 
+        # validate agg
+        # every item is function:column, or just count
+        aggregates = []
+        for item in rules['agg']:
+            function, _, column = item.partition(':')
+            if column == '':
+                column = None
+            
+            if function not in AggregateQuery.aggregate_functions:
+                errors[error_counter] = 'agg is incorrect. Format expected is function:column separated by comma, where function is one of {}. Requested agg is {}'.format(list(AggregateQuery.aggregate_functions), item)
+                error_counter += 1
+            elif column is None and function != 'count':
+                errors[error_counter] = 'agg is incorrect. Only count can be used without a column. Requested agg is {}'.format(item)
+                error_counter += 1
+            elif (column is not None and column not in self.model_columns) or column in ClicksInfo.derived_metrics:
+                errors[error_counter] = 'agg is incorrect. Columns must be of the following: {}, and the derived metrics are calculated per group with cpi=true or metrics. Requested agg is {}'.format([c for c in self.model_columns if c not in ClicksInfo.derived_metrics], item)
+                error_counter += 1
+            elif function in ['sum', 'avg'] and column not in AggregateQuery.summable_columns:
+                errors[error_counter] = 'agg is incorrect. Only the columns {} can be summed or averaged. Requested agg is {}'.format(AggregateQuery.summable_columns, item)
+                error_counter += 1
+            else:
+                aggregates.append((function, column))
+        rules['agg'] = aggregates
+        
         # include_only is a special argument and does not undergo validation, as it allows flexibly inputting any string at all
+        
+        # validate limit
+        max_limit = getattr(settings, 'CLICKS_INFO_MAX_LIMIT', 100000)
+        if len(rules['limit']) == 0:
+            rules['limit'] = None
+        elif self.page_size(rules['limit'], max_limit) is None:
+            errors[error_counter] = 'limit is incorrect. Format expected is a whole number from 1 to {}. Requested limit is {}'.format(max_limit, rules['limit'][0])
+            error_counter += 1
+        elif len(rules['group']) > 0 and len(rules['agg']) == 0:
+            # the groups are in the order they first appear among all the rows, which a page can't know
+            errors[error_counter] = 'limit is incorrect. limit can not be used together with group, unless agg is used. Use top for the first rows of the groups, or agg to page through the groups'
+            error_counter += 1
+        else:
+            rules['limit'] = self.page_size(rules['limit'], max_limit)
+        
+        # validate top
+        # top=n returns the same rows as the first page of limit=n, so it runs as a limit, without returning the next page
+        if len(rules['top']) == 0:
+            rules['top'] = False
+        elif rules['limit'] is not None:
+            errors[error_counter] = 'top is incorrect. top can not be used together with limit'
+            error_counter += 1
+        elif self.page_size(rules['top'], max_limit) is None:
+            errors[error_counter] = 'top is incorrect. Format expected is a whole number from 1 to {}. Requested top is {}'.format(max_limit, rules['top'][0])
+            error_counter += 1
+        else:
+            rules['limit'] = self.page_size(rules['top'], max_limit)
+            rules['top'] = True
+        
+        # validate format
+        if len(rules['format']) != 1 or (rules['format'][0] not in self.stream_content_types and rules['format'][0] != 'json'):
+            errors[error_counter] = 'format is incorrect. Format expected is json, ndjson or csv. Requested format is {}'.format(rules['format'][0])
+            error_counter += 1
+        elif rules['format'][0] != 'json' and rules['limit'] is not None:
+            errors[error_counter] = 'format is incorrect. ndjson and csv stream every row, and can not be used with limit or top'
+            error_counter += 1
+        else:
+            rules['format'] = rules['format'][0]
+        
+        # validate cursor
+        # a cursor must come from a previous page of the same request, so it can only be checked once everything else is valid
+        if len(rules['cursor']) == 0:
+            rules['cursor'] = None
+        elif error_counter == 0:
+            try:
+                shape, values = decode_cursor(rules['cursor'][0])
+            except ValueError:
+                shape, values = None, None
+            
+            if rules['limit'] is None or rules['top'] == True or shape != query_shape(rules):
+                errors[error_counter] = 'cursor is incorrect. A cursor can only be used with limit, and with the same flags as the request it was returned by. Requested cursor is {}'.format(rules['cursor'][0])
+                error_counter += 1
+            else:
+                # the shape matches, but the values of the cursor may still have been changed
+                try:
+                    rules['cursor'] = typed_cursor(self.compile_query(rules), values)
+                except ValueError:
+                    errors[error_counter] = 'cursor is incorrect. The cursor values do not match the order of the request. Requested cursor is {}'.format(rules['cursor'][0])
+                    error_counter += 1
                     
         # if there were any errors - return error dict and False validation status.
         if error_counter > 0:
@@ -174,192 +333,437 @@ class ViewClicksInfo(APIView):
             # otherwise - return validated rules dictionary and True validation status
             return rules, True
     
-    def group_models(self, models, grouping_columns):
-        grouped_models_set = []
+    def page_size(self, values, max_limit):
+        # the number of a limit or top flag, or None if it is not a single whole number from 1 to max_limit
+        # (a longer number than max_limit is rejected before it is converted, so a huge one costs nothing)
+        if len(values) != 1 or not values[0].isdecimal() or len(values[0].lstrip('0')) > len(str(max_limit)):
+            return None
+        size = int(values[0])
+        if size < 1 or size > max_limit:
+            return None
+        return size
+    
+    @classmethod
+    @functools.lru_cache(maxsize=getattr(settings, 'CLICKS_INFO_PLAN_CACHE_SIZE', 1024))
+    def compile_plan(cls, api_flags):
+        # parses and validates an api_flags string into an immutable QueryPlan
+        '''
+        the result only depends on the string, so the last CLICKS_INFO_PLAN_CACHE_SIZE strings are kept in an lru cache,
+        and a repeated URL skips parsing and validation entirely
         
-        groups = {}
-
-        for model_obj in models:
-            # get the grouping attributes
-            attributes = []
-            for col in grouping_columns:
-                attribute = model_obj[col]
-                attributes.append(attribute)
-            
-            # add the attribute(s) to the groups dictionary as keys
-            # if that key already exists = instead add the model_obj to the group under that key
-            key = '-'.join(attributes)
-            if key in groups:
-                groups[key].append(model_obj)
-            else:
-                groups[key] = [model_obj]
+        returns (plan, None) for valid flags, (None, errors) if validation failed, and (None, None) if the flags could not be parsed
+        '''
+        view = cls()
         
-        # the groups dictionary should now have all the grouped model objects
-        # the information is not being summed, as this will lead to the loss of information in requested columns that are not in the grouping columns
+        rules, parsing_status = view.api_parser(api_flags)
+        if parsing_status == False:
+            return None, None
         
-        # create a new models set based on the groups
-        for key in groups:
-            grouped_models_set.extend(groups[key])
-
-        # return new models set, that is grouped
-        return grouped_models_set
+        rules, validation_status = view.rules_validator(rules)
+        if validation_status == False:
+            return None, rules
+        
+        return QueryPlan(rules), None
+    
+    def formatters(self, columns):
+        # (output column, field it is read from, formatting function) of every output column
+        return [(c, ClicksInfo.api_field(c), ClicksInfo.api_formatter(ClicksInfo.api_field(c))) for c in columns]
     
-    def exclude_columns(self, models, columns):
-        excluded_column_models = []
+    def output_rows(self, models, columns):
+        # generator of the output rows, one dict per model holding only the output columns (see RulesQuery.output_columns), already formatted as strings
+        # (the database only returns output columns, plus the order columns of paged requests, which are simply not copied)
+        formatters = self.formatters(columns)
         
         for model_obj in models:
-            for c in self.model_columns:
-                if c not in columns:
-                    del model_obj[c]
-                    # I am also not interested in id, if it is still there
-                    try:
-                        del model_obj['id']
-                    except:
-                        pass
-            excluded_column_models.append(model_obj)
+            yield {c: format_value(model_obj[field]) for c, field, format_value in formatters}
+    
+    def project_rows(self, models, columns):
+        # the output rows, each one put in place of its model as soon as it is built, so the model can be freed right away
+        for position, row in enumerate(self.output_rows(models, columns)):
+            models[position] = row
+        return models
+    
+    def grouped_rows(self, models, columns, grouping_columns):
+        # the output rows with the rows of every group together, the groups in the order they first appear
+        # rows within a group keep their order, so every group is still sorted by the sorted column
+        # the information is not being summed, as this will lead to the loss of information in requested columns that are not in the grouping columns
+        formatters = self.formatters(columns)
+        group_key = operator.itemgetter(*[ClicksInfo.api_field(c) for c in grouping_columns])
+        
+        groups = {}
+        for position, model_obj in enumerate(models):
+            row = {c: format_value(model_obj[field]) for c, field, format_value in formatters}
+            models[position] = row
             
-        return excluded_column_models
+            key = group_key(model_obj)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [row]
+            else:
+                group.append(row)
+        
+        return list(itertools.chain.from_iterable(groups.values()))
+    
+    def aggregate_rows(self, models):
+        # the groups of an agg query formatted as strings
+        # the per group derived metrics are selected as group_cpi, group_roas and group_ctr, since the model already has those fields
+        renamed = {'group_' + metric: metric for metric in ClicksInfo.derived_metrics}
+        return [{renamed.get(key, key): ClicksInfo.api_format(value) for key, value in model_obj.items()} for model_obj in models]
+    
+    def compile_query(self, rules):
+        # compile the date_from, date_to, sorted, columns, include_only, limit and cursor rules into a single database query
+        # see RulesQuery (and AggregateQuery for agg) for how each rule is translated
+        if len(rules['agg']) > 0:
+            # agg requests are answered from the smallest rollup holding everything they need, if there is one
+            rollup = rollup_for(rules, self.model_columns)
+            if rollup is not None:
+                return RollupQuery(rules, self.model_columns, rollup)
+            return AggregateQuery(rules, self.model_columns)
+        return RulesQuery(rules, self.model_columns)
+    
+    def timed(self, stage, function, *args):
+        # runs function(*args) as a stage of the request's timer, or just runs it if the view is used outside of a request
+        timer = getattr(self, 'timer', None)
+        if timer is None:
+            return function(*args)
+        return timer.run(stage, function, *args)
     
     def execute_rules(self, rules, models):
         # executes rules dictionary
         '''
         the executioner is meant to be robust even in the case of mismatched flags
         
-        EXECUTION ORDER:
+        the models are the rows returned by compile_query, which are already filtered by date_from, date_to and include_only,
+        sorted, limited to the requested page, and only contain the requested columns (cpi and the other derived metrics are stored with the rows)
+        
+        if agg is requested, the models are already one row per group, and are only formatted
+        
+        every other request runs in a single pass over the models, which creates one output dict per row:
         
-        1. date_from and date_to
-        2. cpi
-        3. sorted
-        4. group
-        5. columns
-        6. include_only <- special case, due to flexibility of input
+        1. columns <- only the output columns are copied, which drops the order columns of paged requests
+           (the requested columns, after id when every column the api had before the typed schema is requested, as it always was)
+        2. formatting of the typed values as strings, money is the text the source wrote
+        3. group <- the rows of every group are collected together
         '''
         
-        # execute date_from and date_to
-        # init indices list of which indeces represent the model objects that fit between date_from and date_to
-        indeces=[]
-        for index in range(len(models)):
-            model_object = models[index]
-            
-            year,month,day = model_object['date'].split('-')
-            
-            # convert to date format for comparison
-            low_date = date(rules['date_from'][0], rules['date_from'][1], rules['date_from'][2])
-            high_date = date(rules['date_to'][0], rules['date_to'][1], rules['date_to'][2])
-            model_date = date(int(year),int(month),int(day))
-            
-            # check if model date between date_from and date_to
-            if low_date <= model_date <= high_date:
-                indeces.append(index)
-
-        # only get models fulfilling date_from and date_to
-        models = [models[index] for index in indeces]
-        
-        # execute cpi
-        if rules['cpi'] == True:
-            for model_object in models:
-                spend = model_object['spend']
-                installs = model_object['installs']
-                
-                # account for 0 installs possibility to avoid division by zero
-                if int(installs) == 0:
-                    installs = 1
-                
-                # cpi = spend / installs
-                cpi = float(spend) / int(installs)
-
-                model_object['cpi'] = str(cpi)
-        
-        # execute sorted
-        if rules['sorted'][1] == 'ascending':
-            reverse = False
-        elif rules['sorted'][1] == 'descending':
-            reverse = True
-        
-        if rules['sorted'][0] in self.numerical_columns:
-            # if it's numerical, the attribute must be converted first to an appropriate data format
-            if rules['sorted'][0] == 'date':
-                # if it's a date - format the date to a tuple of three integers in the lambda
-                models.sort(key = lambda obj:  (int(obj[rules['sorted'][0]].split('-')[0]) , int(obj[rules['sorted'][0]].split('-')[1]) , int(obj[rules['sorted'][0]].split('-')[2])) , reverse = reverse)
-            
-            elif rules['sorted'][0] == 'spend' or rules['sorted'][0] == 'revenue' or rules['sorted'][0] == 'cpi':
-                # if it's one of the float values - format to float
-                models.sort(key = lambda obj: float(obj[rules['sorted'][0]]), reverse = reverse)
-                
-            else:
-                # if it's one of the integer values - format to integer
-                models.sort(key = lambda obj: int(obj[rules['sorted'][0]]), reverse = reverse)
-        else:
-            models.sort(key = lambda obj: obj[rules['sorted'][0]], reverse = reverse)
+        if len(rules['agg']) > 0:
+            # the database already grouped, aggregated and sorted the rows
+            return self.timed('execute', self.aggregate_rows, models)
+        
+        columns = RulesQuery(rules, self.model_columns).output_columns()
         
-        # execute group
         # only group if there are grouping columns specified
         if len(rules['group']) > 0:
-            models = self.group_models(models, rules['group'])
+            return self.timed('execute', self.grouped_rows, models, columns, rules['group'])
+        
+        # rules execution complete - return queryset
+        return self.timed('execute', self.project_rows, models, columns)
+    
+    def run_rules(self, rules):
+        # executes the rules with the engine selected by the CLICKS_INFO_ENGINE setting
+        '''
+        sql <- the database filters, sorts and selects the columns, and execute_rules does the rest in python
+        numpy <- the whole table is cached in memory as numpy columns, and every rule runs as array operations (see ColumnarEngine)
         
-        # execute columns
-        models = self.exclude_columns(models, rules['columns'])
+        agg requests always run on the database, since it already returns one row per group
         
-        # execute include_only
-        if len(rules['include_only']) > 0:
-            models = self.include_only(models, rules['include_only'])
+        returns the rows, and the order values of the last row if there is a next page (None otherwise)
+        '''
+        engine = getattr(settings, 'CLICKS_INFO_ENGINE', 'sql')
         
-        # rules execution complete - return queryset
-        return models
+        if engine == 'numpy' and len(rules['agg']) == 0:
+            return self.timed('numpy', self.columnar_engine().execute, rules, self.model_columns)
+        
+        # load only the requested rows and columns, as value dicts
+        # (date_from, date_to, include_only and sorted all run inside this query, split across processes for large scans, see handler/parallel.py)
+        query = self.compile_query(rules)
+        models = self.timed('query', query_rows, query)
+        
+        next_values = None
+        if rules['limit'] is not None and len(models) > rules['limit']:
+            # the query fetched one row more than the limit, so there is a next page, starting after the last row of this one
+            models = models[:rules['limit']]
+            next_values = [cursor_value(models[-1][field]) for field, descending in query.order_fields()]
+        
+        return self.execute_rules(rules, models), next_values
     
-    def include_only(self, models, include_only_list):
-        # will go over the models and check if they contain all the items in the include_only_list
-        # if they do not - remove them from queryset
-
-        # convert include_only_list into dict of booleans
-        incl_dict = {}
-        for item in include_only_list:
-            incl_dict[item] = False
-        
-        indeces=[]
-        for index in range(len(models)):
-            model_obj = models[index]
-            # make local_incl_dict as copy of the baseline incl_dict
-            local_incl_dict = incl_dict.copy()
-            
-            # iterate over each item and mark in local_incl_dict if True
-            for item in include_only_list:     
-                for key in model_obj:
-                    # count if the item occurs in the model_obj
-                    if model_obj[key] == item:
-                        local_incl_dict[item] = True
-            
-            # if all items in local_incl_dict are True - append this index
-            append_index = all(value == True for value in local_incl_dict.values())
-
-            if append_index == True:
-                indeces.append(index)
-
-        # return only models subscribing to include_only
-        models = [models[index] for index in indeces]
-        return models
+    def columnar_engine(self):
+        # the numpy engine, on the cached table of the current data version
+        return ColumnarEngine(self.timed('table', columnar_table))
+    
+    def stream_rows(self, rules, query):
+        # generator of the executed rows, reading stream_chunk_size rows at a time from the database cursor
+        # the rows of every group arrive together, in the order the groups first appear, so every row is output as it is read
+        # the rows are read after the view returned, while the response is sent, so the replica is chosen here again
+        with replica_reads():
+            models = query.queryset().iterator(chunk_size=self.stream_chunk_size)
+            if len(rules['agg']) > 0:
+                yield from self.aggregate_rows(models)
+            else:
+                yield from self.output_rows(models, query.output_columns())
+    
+    def stream(self, rules):
+        # generator of the response body of a streamed format, one line per row
+        query = self.compile_query(rules)
+        rows = self.stream_rows(rules, query)
+        
+        if rules['format'] == 'ndjson':
+            for row in rows:
+                yield json.dumps(row, separators=(',', ':')) + '\n'
+        
+        elif rules['format'] == 'csv':
+            line = CSVLine()
+            writer = csv.writer(line)
             
+            columns = query.output_columns()
+            yield writer.writerow(columns)
+            for row in rows:
+                yield writer.writerow([row[c] for c in columns])
+    
+    def next_url(self, request, api_flags, rules, next_values):
+        # url of the next page, the same flags with the cursor of the next page
+        if next_values is None:
+            return None
+        
+        flags = [flag for flag in api_flags.split('&') if flag != '' and not flag.startswith('cursor=')]
+        flags.append('cursor=' + encode_cursor(rules.shape, next_values))
+        
+        return request.build_absolute_uri(self.flags_path(request, api_flags) + '&'.join(flags))
+    
+    def flags_path(self, request, api_flags):
+        # the path the api flags are appended to, the request path without its flags
+        path = request.path
+        if api_flags != '' and path.endswith(api_flags):
+            path = path[:-len(api_flags)]
+        if not path.endswith('/'):
+            path += '/'
+        return path
+    
     def get(self, request, api_flags=''):
-        # parse api flags  
-        rules, parsing_status = self.api_parser(api_flags)
-
-        if parsing_status == False:
+        # every stage of the request is timed, see finalize_response for where the timings go
+        self.timer = StageTimer()
+        self.shape = 'invalid'
+        
+        # parse and validate api flags, or reuse the plan of the last time the same flags were requested
+        rules, errors = self.timed('compile', self.compile_plan, api_flags)
+        
+        if rules is None and errors is None:
             # parsing failed, return 400 bad request
             return Response(status=status.HTTP_400_BAD_REQUEST)
         
-        # validate rules
-        rules, validation_status = self.rules_validator(rules)
-        
-        if validation_status == False:
+        if rules is None:
             # validation failed, return errors and 400 bad request
-            errors = json.dumps(rules)
+            errors = json.dumps(errors)
             return Response(errors, status=status.HTTP_400_BAD_REQUEST)
         
-        # load models, as value dicts
-        queryset = list(ClicksInfo.objects.all().values())
-       
-        # execute rules
-        queryset = self.execute_rules(rules, queryset)
+        self.shape = metrics_shape(rules)
+        
+        # the table answering the request, a rollup or clicks_info
+        query = self.compile_query(rules)
+        source = query.source
+        self.output_columns = query.output_columns()
+        
+        # the same rules on the same data version always give the same result
+        version, updated = data_version()
+        result_cache = ResultCache(rules, version)
+        etag = result_cache.etag(self.representation(request, rules))
+        last_modified = updated.timestamp() if updated is not None else None
+        
+        # if the client already has this result, return 304 not modified without executing anything
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return self.add_cache_headers(not_modified, etag, last_modified)
+        
+        if rules['format'] != 'json':
+            # streamed formats are never cached, they are sent while the query is still running
+            response = StreamingHttpResponse(self.stream(rules), content_type=self.stream_content_types[rules['format']])
+            if rules['format'] == 'csv':
+                response['Content-Disposition'] = 'attachment; filename="clicks_info.csv"'
+            response['X-Clicks-Info-Source'] = source
+            return self.add_cache_headers(response, etag, last_modified)
+        
+        result = self.timed('cache', result_cache.get)
+        if result is None:
+            # execute rules, once for all the requests needing this result at the same time (see SingleFlight)
+            result = single_flight.run(result_cache, lambda: self.run_rules(rules))
+        queryset, next_values = result
+        
+        if rules['limit'] is not None and rules['top'] == False:
+            # paged requests return the page, and the url of the next page (None on the last page)
+            queryset = {
+                        'next': self.next_url(request, api_flags, rules, next_values),
+                        'results': queryset,
+                        }
 
         # return requested data
-        return Response(queryset)
\ No newline at end of file
+        response = Response(queryset)
+        response['X-Clicks-Info-Source'] = source
+        return self.add_cache_headers(response, etag, last_modified)
+    
+    def representation(self, request, rules):
+        # the format the result is rendered in, None for json (the default representation, whose etag has no suffix)
+        # streamed formats are chosen with the format flag and ignore the Accept header
+        renderer_format = request.accepted_renderer.format
+        if rules['format'] != 'json' or renderer_format == 'json':
+            return None
+        return renderer_format
+    
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        
+        if isinstance(response, Response) and response.status_code >= 400 and not isinstance(response.accepted_renderer, JSONRenderer):
+            # errors are not rows, so they are always sent as json, whatever format was accepted
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = JSONRenderer.media_type
+        
+        timer = getattr(self, 'timer', None)
+        if timer is not None:
+            if isinstance(response, Response):
+                # render the json here rather than after the view returns, so rendering is one of the timed stages
+                self.timed('render', response.render)
+            
+            # streamed responses only include the stages before the first row, the rows are executed while they are sent
+            response['Server-Timing'] = timer.server_timing()
+            stage_metrics.record(self.shape, timer)
+        
+        return response
+    
+    def add_cache_headers(self, response, etag, last_modified):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # the format of the body depends on the Accept header
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class ViewClicksInfoBatch(ViewClicksInfo):
+    name = 'Batch clicks info'
+    description = 'Executes many clicks info requests in one round trip'
+    
+    http_method_names = ['post', 'options']
+    
+    # every entry holds a whole response, so batches are only sent as json
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+    
+    '''
+    POST BODY:
+    
+    a json list of queries, or an object with the list under queries, at most CLICKS_INFO_BATCH_LIMIT queries
+    
+    every query is either an api flags string, the same as in /clicks_info/<api_flags>:
+    "group=channel&sorted=clicks,descending&top=20"
+    or a rule object of flag name -> value, where several values are given as a list or separated by commas:
+    {"group": ["channel"], "sorted": "clicks,descending", "top": 20}
+    
+    the response has one entry per query, in order, and a failing query does not fail the others:
+    {"status": 200, "data": <what /clicks_info/<api_flags> returns>}
+    {"status": 400, "errors": <what went wrong>}
+    
+    SHARED WORK:
+    
+    every query reads the same snapshot of the data, inside one transaction
+    queries with the same canonical rules (see QueryPlan) are executed once, and every query goes through the result cache
+    on the numpy engine every query runs on the same engine, so queries with the same date range and include_only filter the table once
+    '''
+    
+    def flag_value(self, value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+    
+    def flags_string(self, query):
+        # the api flags string of a query, or None if the query is neither a string nor a rule object which can be written as one
+        if isinstance(query, str):
+            return query
+        if not isinstance(query, dict):
+            return None
+        
+        flags = []
+        for name, value in query.items():
+            values = value if isinstance(value, list) else [value]
+            values = [self.flag_value(v) for v in values]
+            
+            # & and = would start another flag or value, and a comma inside one value of a list would split it in two
+            # (a single string value can still list several values separated by commas, the same as in a flags string)
+            if any(c in name for c in '&=,') or any('&' in v or '=' in v for v in values):
+                return None
+            if isinstance(value, list) and any(',' in v for v in values):
+                return None
+            
+            flags.append('{}={}'.format(name, ','.join(values)))
+        return '&'.join(flags)
+    
+    def flags_path(self, request, api_flags):
+        # next urls point at the single request endpoint, /clicks_info/<api_flags>
+        return request.path.rsplit('batch', 1)[0]
+    
+    def columnar_engine(self):
+        # one numpy engine for the whole batch, so the filtered rows are shared between queries
+        if getattr(self, 'batch_engine', None) is None:
+            self.batch_engine = super().columnar_engine()
+        return self.batch_engine
+    
+    def execute_query(self, request, api_flags, version, executed):
+        # executes one query of the batch, returning its response entry
+        if api_flags is None:
+            return {'status': 400, 'errors': {0: 'query is incorrect. Format expected is an api flags string or an object of flags, whose names and values can not contain & or =, and whose lists of values can not contain commas'}}
+        
+        rules, errors = self.timed('compile', self.compile_plan, api_flags)
+        if rules is None and errors is None:
+            return {'status': 400, 'errors': {0: 'query could not be parsed. Requested query is {}'.format(api_flags)}}
+        if rules is None:
+            return {'status': 400, 'errors': errors}
+        if rules['format'] != 'json':
+            return {'status': 400, 'errors': {0: 'format is incorrect. The batch endpoint only returns json'}}
+        
+        # the same rules in a batch are only executed once
+        if rules.key not in executed:
+            result_cache = ResultCache(rules, version)
+            result = self.timed('cache', result_cache.get)
+            if result is None:
+                result = single_flight.run(result_cache, lambda: self.run_rules(rules))
+            executed[rules.key] = result
+        queryset, next_values = executed[rules.key]
+        
+        if rules['limit'] is not None and rules['top'] == False:
+            queryset = {
+                        'next': self.next_url(request, api_flags, rules, next_values),
+                        'results': queryset,
+                        }
+        
+        return {'status': 200, 'data': queryset}
+    
+    def post(self, request):
+        self.timer = StageTimer()
+        self.shape = 'batch'
+        
+        queries = request.data
+        if isinstance(queries, dict):
+            queries = queries.get('queries')
+        
+        batch_limit = getattr(settings, 'CLICKS_INFO_BATCH_LIMIT', 100)
+        if not isinstance(queries, list) or len(queries) > batch_limit:
+            errors = json.dumps({0: 'body is incorrect. Format expected is a json list of at most {} queries, or an object with the list under queries'.format(batch_limit)})
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        # every query of the batch reads the same snapshot of the data
+        with transaction.atomic(using=read_alias()):
+            version, updated = data_version()
+            
+            executed = {}
+            entries = [self.execute_query(request, self.flags_string(query), version, executed) for query in queries]
+        
+        return Response({'results': entries})
+
+
+class ViewMetrics(View):
+    # the stage timing histograms of this process, in the prometheus text format
+    def get(self, request):
+        return HttpResponse(stage_metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class CSVLine:
+    # file-like object for csv.writer, which hands every written line back instead of storing it
+    def write(self, line):
+        return line